@@ -0,0 +1,111 @@
+"""
+WHAT:
+
+CPU inference modes for our fine-tuned GPT-2 models (gpt2_dnd_finetuned / gpt2_crd3_finetuned).
+- eager: plain fp32 PyTorch, what we ran before
+- int8: dynamic int8 quantization (torch.ao.quantization.quantize_dynamic) of the Linear layers
+- compiled: the forward pass compiled with torch.compile
+- int8_compiled: both
+
+Running this file checks perplexity parity on a held-out slice of merged.jsonl and measures tokens/sec for each mode.
+
+WHY
+
+When there is no GPU the pipeline falls back to the CPU, where gpt2-medium is slow per token.
+Most of the time goes into the matrix multiplications of the attention and MLP layers, which int8 kernels do a lot faster.
+
+NOTE: HF GPT-2 implements its attention/MLP projections as Conv1D (a transposed Linear), which quantize_dynamic does not know about.
+So we swap them for equivalent nn.Linear layers first, otherwise only the lm_head would get quantized.
+"""
+
+import os
+
+import torch
+from torch import nn
+from transformers.pytorch_utils import Conv1D
+
+CPU_INFERENCE_MODES = ("eager", "int8", "compiled", "int8_compiled")
+
+# these are read from the environment so the same settings work for the CLI and the API
+CPU_INFERENCE_MODE = os.getenv("DMRAG_CPU_INFERENCE_MODE", "eager")
+TORCH_NUM_THREADS = int(os.getenv("DMRAG_TORCH_NUM_THREADS", "0"))  # 0 keeps the torch default
+TORCH_NUM_INTEROP_THREADS = int(os.getenv("DMRAG_TORCH_NUM_INTEROP_THREADS", "0"))
+
+
+def configure_torch_threads(num_threads: int = TORCH_NUM_THREADS, num_interop_threads: int = TORCH_NUM_INTEROP_THREADS):
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # torch only allows this before any inter-op parallel work has started
+            print("Could not set the number of inter-op threads, torch already started parallel work.")
+
+
+def _conv1d_to_linear(model: nn.Module) -> nn.Module:
+    # Conv1D stores its weight as (in_features, out_features), nn.Linear as (out_features, in_features)
+    for name, module in list(model.named_children()):
+        if isinstance(module, Conv1D):
+            in_features, out_features = module.weight.shape
+            linear = nn.Linear(in_features, out_features)
+            linear.weight.data = module.weight.data.t().contiguous()
+            linear.bias.data = module.bias.data
+            setattr(model, name, linear)
+        else:
+            _conv1d_to_linear(module)
+    return model
+
+
+def prepare_cpu_model(model, mode: str = CPU_INFERENCE_MODE):
+    # returns a model ready for CPU inference in the requested mode
+    # the model is changed in place, we don't want to hold two copies of gpt2-medium in memory
+    if mode not in CPU_INFERENCE_MODES:
+        raise ValueError(f"Unknown CPU inference mode '{mode}', expected one of {CPU_INFERENCE_MODES}")
+
+    model = model.to("cpu").eval()
+
+    if mode in ("int8", "int8_compiled"):
+        _conv1d_to_linear(model)
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    if mode in ("compiled", "int8_compiled"):
+        # we compile the forward only, so the model keeps its HF class and still works with pipeline() and generate()
+        # dynamic=True avoids a recompile for every new sequence length during generation
+        model.forward = torch.compile(model.forward, dynamic=True)
+
+    return model
+
+
+if __name__ == "__main__":
+    import copy
+    from transformers import GPT2LMHeadModel, GPT2Tokenizer
+    from generation_benchmarks import HELDOUT_PATH, load_heldout_texts, perplexity, tokens_per_second
+
+    MODEL_PATH = "gpt2_dnd_finetuned/gpt2_dnd_finetuned"
+    NUM_HELDOUT_TEXTS = 50
+    # we accept a mode if its perplexity is within this fraction of the eager perplexity
+    PARITY_TOLERANCE = 0.05
+
+    configure_torch_threads()
+    print(f"torch threads: {torch.get_num_threads()} intra-op, {torch.get_num_interop_threads()} inter-op")
+
+    tokenizer = GPT2Tokenizer.from_pretrained(MODEL_PATH)
+    base_model = GPT2LMHeadModel.from_pretrained(MODEL_PATH)
+    texts = load_heldout_texts(HELDOUT_PATH, NUM_HELDOUT_TEXTS)
+
+    results = {}
+    for mode in CPU_INFERENCE_MODES:
+        model = prepare_cpu_model(copy.deepcopy(base_model), mode)
+        results[mode] = {
+            "perplexity": perplexity(model, tokenizer, texts),
+            "tokens_per_sec": tokens_per_second(model, tokenizer),
+        }
+
+    eager_ppl = results["eager"]["perplexity"]
+    eager_tps = results["eager"]["tokens_per_sec"]
+    print(f"\n{'mode':<15}{'perplexity':>12}{'rel. diff':>11}{'tokens/s':>10}{'speedup':>9}  parity")
+    for mode, res in results.items():
+        rel_diff = (res["perplexity"] - eager_ppl) / eager_ppl
+        parity = "ok" if abs(rel_diff) <= PARITY_TOLERANCE else "FAILED"
+        print(f"{mode:<15}{res['perplexity']:>12.2f}{rel_diff:>+11.2%}{res['tokens_per_sec']:>10.1f}{res['tokens_per_sec'] / eager_tps:>8.2f}x  {parity}")
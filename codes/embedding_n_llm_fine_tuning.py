@@ -67,12 +67,35 @@ model_name = "gpt2-medium"
 output_dir = "gpt2_dnd_finetuned"
 dataset_path = "dnd_corpus.txt"
 
+# set this to True to train a LoRA adapter instead of a full fine-tune
+# the adapter is a few MB instead of a full copy of gpt2-medium, and the API can serve several adapters on one shared base model
+# (see ADAPTER_REGISTRY in ui/api/model_pool.py)
+use_lora = False
+lora_output_dir = "gpt2_dnd_lora"
+
 tokenizer = GPT2Tokenizer.from_pretrained(model_name)
 tokenizer.pad_token = tokenizer.eos_token
 
 model = GPT2LMHeadModel.from_pretrained(model_name)
 model.resize_token_embeddings(len(tokenizer))
 
+if use_lora:
+    from peft import LoraConfig, get_peft_model
+
+    lora_config = LoraConfig(
+        task_type="CAUSAL_LM",
+        r=16,
+        lora_alpha=32,
+        lora_dropout=0.05,
+        # the attention and mlp projections of gpt-2
+        target_modules=["c_attn", "c_proj", "c_fc"],
+        # gpt-2 uses Conv1D layers, which store their weights transposed compared to nn.Linear
+        fan_in_fan_out=True,
+    )
+    model = get_peft_model(model, lora_config)
+    model.print_trainable_parameters()
+    output_dir = lora_output_dir
+
 dataset = TextDataset(
     tokenizer=tokenizer,
     file_path=dataset_path,
@@ -94,7 +117,8 @@ training_args = TrainingArguments(
     save_total_limit=2,
     prediction_loss_only=True,
     logging_steps=100,
-    learning_rate=5e-5,
+    # the adapter weights start from zero, so they need a higher learning rate than a full fine-tune
+    learning_rate=2e-4 if use_lora else 5e-5,
     warmup_steps=100,
     fp16=torch.cuda.is_available()
 )
@@ -108,8 +132,51 @@ trainer = Trainer(
 
 trainer.train()
 
+# for a LoRA model this only saves the adapter weights and config
 model.save_pretrained(output_dir)
 tokenizer.save_pretrained(output_dir)
 
 
-#-----------------------------------------------------------------------------------------------
\ No newline at end of file
+#-----------------------------------------------------------------------------------------------
+#-------------------------draft_model_fine_tuning (speculative decoding)--------------------------
+# a small draft model for assisted generation (see speculative_decoding.py)
+# we fine tune distilgpt2 on the same dnd_corpus.txt, so its guesses follow the fine-tuned gpt2-medium as closely as possible
+# distilgpt2 uses the same tokenizer as gpt2-medium, which assisted generation needs
+# it is 4x smaller, so this fits on a much smaller GPU than the run above
+
+# it is only trained when DMRAG_TRAIN_DRAFT_MODEL=1 is set, it is only needed for DMRAG_SPECULATIVE_DECODING=1
+train_draft_model = os.getenv("DMRAG_TRAIN_DRAFT_MODEL", "0") == "1"
+
+if train_draft_model:
+    draft_model_name = "distilgpt2"
+    draft_output_dir = "distilgpt2_dnd_draft"
+
+    draft_model = GPT2LMHeadModel.from_pretrained(draft_model_name)
+    draft_model.resize_token_embeddings(len(tokenizer))
+
+    draft_training_args = TrainingArguments(
+        output_dir=draft_output_dir,
+        overwrite_output_dir=True,
+        num_train_epochs=3,
+        per_device_train_batch_size=4,
+        gradient_accumulation_steps=1,
+        save_steps=500,
+        save_total_limit=2,
+        prediction_loss_only=True,
+        logging_steps=100,
+        learning_rate=5e-5,
+        warmup_steps=100,
+        fp16=torch.cuda.is_available()
+    )
+
+    draft_trainer = Trainer(
+        model=draft_model,
+        args=draft_training_args,
+        data_collator=data_collator,
+        train_dataset=dataset
+    )
+
+    draft_trainer.train()
+
+    draft_model.save_pretrained(draft_output_dir)
+    tokenizer.save_pretrained(draft_output_dir)
@@ -0,0 +1,73 @@
+import os
+import random
+import tempfile
+import time
+
+from game_state_manager import CsvBackend, GameStateStore, Player, SqliteBackend
+
+"""
+This file benchmarks the game state backends (DMRAG_GAME_STATE_BACKEND=csv or sqlite)
+Run it with: python game_state_benchmark.py
+
+It replays the same random tool calls (damage, heal, mana, items, weapons) against a store with each backend
+and reports mutations per second, once writing to disk at every turn boundary (how the CLI runs)
+and once writing after every single mutation (the worst case, like the old load/save per call).
+"""
+
+NUM_PLAYERS = 3
+NUM_TURNS = 300
+MUTATIONS_PER_TURN = 3
+
+
+def random_mutations(names, n, rng):
+    mutations = []
+    for _ in range(n):
+        function_name = rng.choice(["damage_player", "heal_player", "restore_mana", "drain_mana", "add_item_to_player", "change_weapon_for_player"])
+        arguments = {"name": rng.choice(names)}
+        if function_name == "add_item_to_player":
+            arguments["item"] = rng.choice(["rope", "torch", "potion"])
+        elif function_name == "change_weapon_for_player":
+            arguments["weapon"] = rng.choice(["sword", "staff", "bow"])
+        else:
+            arguments["amount"] = rng.randint(1, 10)
+        mutations.append((function_name, arguments))
+    return mutations
+
+
+def run(backend, flush_every_mutation):
+    store = GameStateStore(flush_interval=0, backend=backend)
+    store.reset()
+    names = [f"Player{i}" for i in range(NUM_PLAYERS)]
+    for name in names:
+        store.create(Player(name, hp=100, mana=100))
+    store.flush()
+
+    rng = random.Random(0)
+    turns = [random_mutations(names, MUTATIONS_PER_TURN, rng) for _ in range(NUM_TURNS)]
+
+    start = time.perf_counter()
+    for mutations in turns:
+        if flush_every_mutation:
+            for mutation in mutations:
+                store.apply_mutations([mutation])
+                store.flush()
+        else:
+            store.apply_mutations(mutations)
+            store.flush()
+    elapsed = time.perf_counter() - start
+
+    # both backends have to end up with the same game state
+    return NUM_TURNS * MUTATIONS_PER_TURN / elapsed, sorted((p.name, p.hp, p.mana, p.item, p.weapon) for p in backend.read())
+
+
+if __name__ == "__main__":
+    os.chdir(tempfile.mkdtemp())
+
+    print(f"{NUM_PLAYERS} players, {NUM_TURNS} turns, {MUTATIONS_PER_TURN} mutations per turn")
+    print(f"{'backend':<10}{'flush':<16}{'mutations/s':>12}")
+    for flush_every_mutation in (False, True):
+        final_states = {}
+        for name, backend in (("csv", CsvBackend("game_state.csv")), ("sqlite", SqliteBackend("game_state.db", "benchmark"))):
+            rate, final_states[name] = run(backend, flush_every_mutation)
+            print(f"{name:<10}{'every mutation' if flush_every_mutation else 'every turn':<16}{rate:>12.0f}")
+        assert final_states["csv"] == final_states["sqlite"], "the backends ended up with different game states"
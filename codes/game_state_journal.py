@@ -0,0 +1,158 @@
+import bisect
+import json
+import os
+from dataclasses import asdict
+from typing import Dict, List
+
+from game_state_manager import Player, apply_mutation, validate_mutation
+
+"""
+This file is used to keep the history of the game state as an append-only event journal with snapshots
+Note: This is not a runnable file, the journal is attached to the GameStateStore in game_state_manager.py
+
+Why:
+    game_state.csv only ever holds the current state, it is overwritten on every flush.
+    To undo a turn or look at the game state of an earlier turn we need the history,
+    but keeping it as full copies of the state would mean rewriting more and more data every turn.
+
+How:
+    Every change (damage, heal, items, weapons, mana, new players) is appended as one JSON line to game_state_journal.jsonl,
+    together with the turn it happened in. Appending is O(1), nothing already written is ever rewritten.
+    Every SNAPSHOT_EVERY events we also append the full state to game_state_snapshots.jsonl.
+    To get the state at any turn, we load the nearest snapshot at or before that turn and replay the events after it.
+    We keep the byte offsets of the events and snapshots in memory, so we can seek straight to them.
+"""
+
+JOURNAL_PATH = "game_state_journal.jsonl"
+SNAPSHOT_PATH = "game_state_snapshots.jsonl"
+SNAPSHOT_EVERY = int(os.getenv("DMRAG_GAME_STATE_SNAPSHOT_EVERY", "20"))
+
+# events that are not tool calls
+RESTORE_EVENT = "restore"
+UPDATE_EVENT = "update_player"
+DELETE_EVENT = "delete_player"
+
+
+def players_to_json(players: Dict[str, Player]) -> List[dict]:
+    return [asdict(p) for p in players.values()]
+
+
+def players_from_json(rows: List[dict]) -> Dict[str, Player]:
+    return {row["name"]: Player(**row) for row in rows}
+
+
+def replay_event(players: Dict[str, Player], event: dict):
+    function_name, arguments = event["function"], event["args"]
+    if function_name == RESTORE_EVENT:
+        players.clear()
+        players.update(players_from_json(arguments["players"]))
+    elif function_name == UPDATE_EVENT:
+        p = players.get(arguments["name"])
+        if p:
+            for attr, val in arguments["updates"].items():
+                setattr(p, attr, val)
+    elif function_name == DELETE_EVENT:
+        players.pop(arguments["name"], None)
+    elif function_name == "create_player" and "player" in arguments:
+        # players created directly (not through a tool call) are recorded in full
+        players[arguments["name"]] = Player(**arguments["player"])
+    elif validate_mutation(players, function_name, arguments) is None:
+        apply_mutation(players, function_name, arguments)
+
+
+class GameStateJournal:
+    def __init__(self, path: str = JOURNAL_PATH, snapshot_path: str = SNAPSHOT_PATH, snapshot_every: int = SNAPSHOT_EVERY):
+        self.path = path
+        self.snapshot_path = snapshot_path
+        self.snapshot_every = snapshot_every
+        self._events = open(path, "ab+")
+        self._snapshots = open(snapshot_path, "ab+")
+        # (seq, turn, byte offset) of every event, and (turn, seq, byte offset) of every snapshot
+        self._event_index = []
+        self._snapshot_index = []
+        self._load_index()
+
+    def _load_index(self):
+        # a journal from an earlier run is indexed once, so the offsets are known
+        for f, index, key in ((self._events, self._event_index, "event"), (self._snapshots, self._snapshot_index, "snapshot")):
+            f.seek(0)
+            offset = 0
+            for line in f:
+                entry = json.loads(line)
+                if key == "event":
+                    index.append((entry["seq"], entry["turn"], offset))
+                else:
+                    index.append((entry["turn"], entry["seq"], offset))
+                offset += len(line)
+
+    @property
+    def seq(self) -> int:
+        return self._event_index[-1][0] if self._event_index else 0
+
+    @property
+    def last_turn(self) -> int:
+        return self._event_index[-1][1] if self._event_index else 0
+
+    def _write(self, f, entry: dict) -> int:
+        f.seek(0, os.SEEK_END)
+        offset = f.tell()
+        f.write((json.dumps(entry, separators=(",", ":")) + "\n").encode("utf-8"))
+        f.flush()
+        return offset
+
+    def append(self, turn: int, function_name: str, arguments: dict) -> int:
+        seq = self.seq + 1
+        offset = self._write(self._events, {"seq": seq, "turn": turn, "function": function_name, "args": arguments})
+        self._event_index.append((seq, turn, offset))
+        return seq
+
+    def maybe_snapshot(self, turn: int, players: Dict[str, Player]):
+        last_snapshot_seq = self._snapshot_index[-1][1] if self._snapshot_index else 0
+        if self.seq - last_snapshot_seq >= self.snapshot_every:
+            self.snapshot(turn, players)
+
+    def snapshot(self, turn: int, players: Dict[str, Player]):
+        offset = self._write(self._snapshots, {"turn": turn, "seq": self.seq, "players": players_to_json(players)})
+        self._snapshot_index.append((turn, self.seq, offset))
+
+    def _read(self, f, offset: int) -> dict:
+        f.seek(offset)
+        return json.loads(f.readline())
+
+    def state_at(self, turn: int) -> Dict[str, Player]:
+        # the game state at the end of the given turn
+        players: Dict[str, Player] = {}
+        start_seq = 0
+        i = bisect.bisect_right(self._snapshot_index, (turn, float("inf"), float("inf"))) - 1
+        if i >= 0:
+            snapshot = self._read(self._snapshots, self._snapshot_index[i][2])
+            players = players_from_json(snapshot["players"])
+            start_seq = snapshot["seq"]
+
+        j = bisect.bisect_right(self._event_index, (start_seq, float("inf"), float("inf")))
+        for seq, event_turn, offset in self._event_index[j:]:
+            if event_turn > turn:
+                break
+            replay_event(players, self._read(self._events, offset))
+        return players
+
+    def history(self, from_turn: int = 0, to_turn: int = None) -> List[dict]:
+        # the events of a range of turns
+        events = []
+        for seq, event_turn, offset in self._event_index:
+            if event_turn < from_turn:
+                continue
+            if to_turn is not None and event_turn > to_turn:
+                break
+            events.append(self._read(self._events, offset))
+        return events
+
+    def reset(self):
+        for f in (self._events, self._snapshots):
+            f.truncate(0)
+        self._event_index = []
+        self._snapshot_index = []
+
+    def close(self):
+        self._events.close()
+        self._snapshots.close()
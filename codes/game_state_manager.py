@@ -1,6 +1,15 @@
+import atexit
 import csv
-from dataclasses import dataclass, asdict, fields
-from typing import List, Optional
+import json
+import os
+import tempfile
+import threading
+import sqlite3
+import uuid
+from dataclasses import dataclass, asdict, fields, replace
+from typing import Dict, List, Optional, Tuple
+
+from game_state_prompt import SerializedStateCache, fit_to_token_budget, join_fragments, mentioned_names, order_by_mention
 
 """
 This file is used to manage the game state
@@ -15,7 +24,7 @@ Why:
     It is used to create, read, update, and delete players in the game state. 
 
 How:
-    We store the game state in a CSV file.
+    We store the game state in a CSV file, and keep it in memory while the game runs (GameStateStore).
     We have a player class that stores the player information.
     We have several functions to manage the game state.
     Now, how do we know what functions to call from the llm response?
@@ -39,101 +48,503 @@ class Player:
     mana: int = 0
     status: str = "base"
 
-def load_game_state(filename: str = CSV_FILENAME) -> List[Player]:
+def read_game_state_csv(filename: str = CSV_FILENAME) -> List[Player]:
     try:
         with open(filename, mode="r", newline="", encoding="utf-8") as f:
             reader = csv.DictReader(f)
-            players = [Player(**{k: (int(v) if k=="hp" else v) for k,v in row.items()})
+            players = [Player(**{k: (int(v) if k in ("hp", "mana") and v != "" else v) for k,v in row.items()})
                        for row in reader]
     except FileNotFoundError:
         return []
     return players
 
+def write_game_state_csv(players: List[Player], filename: str = CSV_FILENAME):
+    # we write to a temporary file next to the csv and rename it over the old one,
+    # so a crash halfway through a save never leaves a half-written game state behind
+    directory = os.path.dirname(os.path.abspath(filename))
+    fd, tmp_path = tempfile.mkstemp(prefix=".game_state_", suffix=".csv", dir=directory)
+    try:
+        with os.fdopen(fd, mode="w", newline="", encoding="utf-8") as f:
+            writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
+            writer.writeheader()
+            for p in players:
+                writer.writerow(asdict(p))
+        os.replace(tmp_path, filename)
+    except BaseException:
+        os.remove(tmp_path)
+        raise
+
+# where the store persists the players, picked with DMRAG_GAME_STATE_BACKEND (csv or sqlite)
+# the csv file is a single file per game, so two sessions on one machine overwrite each other's game_state.csv
+# the sqlite backend keeps all sessions in one database (game_state.db), keyed by session, and only writes the players that changed
+
+GAME_STATE_BACKENDS = ("csv", "sqlite")
+GAME_STATE_BACKEND = os.getenv("DMRAG_GAME_STATE_BACKEND", "csv")
+GAME_STATE_DB = os.getenv("DMRAG_GAME_STATE_DB", "game_state.db")
+# one session per CLI run unless a session (e.g. a campaign name) is given, so concurrent runs don't share players
+GAME_STATE_SESSION = os.getenv("DMRAG_GAME_STATE_SESSION", f"session-{uuid.uuid4().hex[:8]}")
+
+class CsvBackend:
+    def __init__(self, filename: str = CSV_FILENAME):
+        self.filename = filename
+
+    def read(self) -> List[Player]:
+        return read_game_state_csv(self.filename)
+
+    def write(self, players: List[Player], changed: List[Player], deleted: List[str]):
+        # a csv can only be rewritten as a whole
+        write_game_state_csv(players, self.filename)
+
+    def reset(self):
+        if os.path.exists(self.filename):
+            os.remove(self.filename)
+
+class SqliteBackend:
+    def __init__(self, db_path: str = GAME_STATE_DB, session_id: str = GAME_STATE_SESSION):
+        self.db_path = db_path
+        self.session_id = session_id
+        # the store serializes access with its lock, the connection is shared with the background flusher
+        self.conn = sqlite3.connect(db_path, check_same_thread=False, isolation_level=None)
+        # WAL lets other sessions read while one session writes
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("PRAGMA synchronous=NORMAL")
+        self.conn.execute(
+            "CREATE TABLE IF NOT EXISTS players ("
+            " session_id TEXT NOT NULL, name TEXT NOT NULL, character_class TEXT, race TEXT, weapon TEXT,"
+            " item TEXT, hp INTEGER, mana INTEGER, status TEXT,"
+            " PRIMARY KEY (session_id, name))"  # the primary key is the index for player lookups
+        )
+
+    def _row(self, p: Player) -> tuple:
+        # the csv backend stores everything as text, the same goes for e.g. an item list here
+        values = asdict(p)
+        return (self.session_id,) + tuple(
+            values[k] if k in ("hp", "mana") or isinstance(values[k], str) else str(values[k]) for k in FIELDNAMES
+        )
+
+    def read(self) -> List[Player]:
+        rows = self.conn.execute(
+            f"SELECT {', '.join(FIELDNAMES)} FROM players WHERE session_id = ? ORDER BY rowid", (self.session_id,)
+        ).fetchall()
+        return [Player(**dict(zip(FIELDNAMES, row))) for row in rows]
+
+    def get(self, name: str) -> Optional[Player]:
+        row = self.conn.execute(
+            f"SELECT {', '.join(FIELDNAMES)} FROM players WHERE session_id = ? AND name = ?", (self.session_id, name)
+        ).fetchone()
+        return Player(**dict(zip(FIELDNAMES, row))) if row else None
+
+    def write(self, players: List[Player], changed: List[Player], deleted: List[str]):
+        # all the changes since the last flush go in one transaction
+        placeholders = ", ".join("?" for _ in range(len(FIELDNAMES) + 1))
+        updates = ", ".join(f"{k} = excluded.{k}" for k in FIELDNAMES if k != "name")
+        with self.conn:
+            self.conn.execute("BEGIN")
+            self.conn.executemany(
+                "DELETE FROM players WHERE session_id = ? AND name = ?", [(self.session_id, name) for name in deleted]
+            )
+            self.conn.executemany(
+                f"INSERT INTO players (session_id, {', '.join(FIELDNAMES)}) VALUES ({placeholders})"
+                f" ON CONFLICT (session_id, name) DO UPDATE SET {updates}",
+                [self._row(p) for p in changed],
+            )
+
+    def reset(self):
+        with self.conn:
+            self.conn.execute("DELETE FROM players WHERE session_id = ?", (self.session_id,))
+
+# the game state is read on every turn and changed by most narrations,
+# so instead of reading and rewriting the csv every time we keep the players in memory (indexed by name)
+# and write them back in the background (write-behind): every few seconds if something changed,
+# at turn boundaries (flush_game_state), and when the program exits
+
+FLUSH_INTERVAL_SECONDS = float(os.getenv("DMRAG_GAME_STATE_FLUSH_SECONDS", "5"))
+# every change is also appended to an event journal (game_state_journal.py), which gives us history, undo and time-travel
+USE_GAME_STATE_JOURNAL = os.getenv("DMRAG_GAME_STATE_JOURNAL", "1") == "1"
+# how many GPT-2 tokens the game state may take up in the prompt
+GAME_STATE_TOKEN_BUDGET = int(os.getenv("DMRAG_GAME_STATE_TOKEN_BUDGET", "256"))
+
+class GameStateStore:
+    def __init__(self, filename: str = CSV_FILENAME, flush_interval: float = FLUSH_INTERVAL_SECONDS, journal=None, backend=None):
+        self.filename = filename
+        self.backend = backend or CsvBackend(filename)
+        self.flush_interval = flush_interval
+        self.journal = journal
+        # the turn the changes are recorded under in the journal
+        self.turn = journal.last_turn if journal else 0
+        # the turns the current game state is made of, undo walks back along them
+        # (after a restart every journaled turn counts, the undos of an earlier run are not tracked)
+        self._timeline = list(range(self.turn + 1))
+        self._players: Dict[str, Player] = {}
+        self._loaded = False
+        # what changed since the last flush, so the backend can write only those players
+        self._changed = set()
+        self._deleted = set()
+        # bumped by every change, the serialized game state for the prompt is cached per version
+        self.version = 0
+        self._serialized = SerializedStateCache()
+        self._lock = threading.RLock()
+        self._stop = threading.Event()
+        self._flusher = None
+        if flush_interval > 0:
+            self._flusher = threading.Thread(target=self._flush_periodically, daemon=True)
+            self._flusher.start()
+
+    def _ensure_loaded(self):
+        # the csv is read once, the first time the game state is needed
+        if not self._loaded:
+            self._players = {p.name: p for p in self.backend.read()}
+            self._loaded = True
+            self.version += 1
+
+    def all(self) -> List[Player]:
+        # copies, so callers can't change the game state without going through the store
+        with self._lock:
+            self._ensure_loaded()
+            return [replace(p) for p in self._players.values()]
+
+    def get(self, name: str) -> Optional[Player]:
+        with self._lock:
+            self._ensure_loaded()
+            p = self._players.get(name)
+            return replace(p) if p else None
+
+    def _record(self, function_name: str, arguments: dict):
+        if self.journal:
+            self.journal.append(self.turn, function_name, arguments)
+            self.journal.maybe_snapshot(self.turn, self._players)
+
+    def _mark_changed(self, name: str):
+        self._changed.add(name)
+        self._deleted.discard(name)
+        self.version += 1
+
+    def replace_all(self, players: List[Player]):
+        with self._lock:
+            self._ensure_loaded()
+            names = {p.name for p in players}
+            self._deleted.update(name for name in self._players if name not in names)
+            self._players = {p.name: replace(p) for p in players}
+            self._changed = set(self._players)
+            self.version += 1
+            self._record("restore", {"players": [asdict(p) for p in self._players.values()]})
+
+    def create(self, new_player: Player) -> bool:
+        with self._lock:
+            self._ensure_loaded()
+            if new_player.name in self._players:
+                return False
+            self._players[new_player.name] = replace(new_player)
+            self._mark_changed(new_player.name)
+            self._record("create_player", {"name": new_player.name, "player": asdict(new_player)})
+            return True
+
+    def update(self, name: str, **updates) -> bool:
+        with self._lock:
+            self._ensure_loaded()
+            p = self._players.get(name)
+            if not p:
+                return False
+            valid_fields = {f.name for f in fields(Player)}
+            updates = {attr: val for attr, val in updates.items() if attr in valid_fields}
+            for attr, val in updates.items():
+                setattr(p, attr, val)
+            self._mark_changed(name)
+            self._record("update_player", {"name": name, "updates": updates})
+            return True
+
+    def delete(self, name: str) -> bool:
+        with self._lock:
+            self._ensure_loaded()
+            if self._players.pop(name, None) is None:
+                return False
+            self._changed.discard(name)
+            self._deleted.add(name)
+            self.version += 1
+            self._record("delete_player", {"name": name})
+            return True
+
+    def apply_mutations(self, mutations: List[Tuple[str, Dict]], turn: Optional[int] = None) -> List[bool]:
+        # mutations are (function_name, arguments) pairs, applied in order
+        # invalid calls are skipped (and reported), the others are written to disk together with the next flush
+        # turn is the turn the narration belongs to (the background parser can finish after the next turn started)
+        with self._lock:
+            self._ensure_loaded()
+            current_turn = self.turn
+            if turn is not None:
+                self.turn = turn
+            results = []
+            for function_name, arguments in mutations:
+                error = validate_mutation(self._players, function_name, arguments)
+                if error:
+                    print(f"Skipping {function_name}: {error}")
+                    results.append(False)
+                    continue
+                results.append(apply_mutation(self._players, function_name, arguments))
+                if function_name == "create_player":
+                    p = self._players[arguments["name"]]
+                    print(f"Player created: {p.name}, {p.character_class}, {p.race} with {p.hp} HP and {p.mana} mana, wielding {p.weapon}.")
+                self._mark_changed(arguments["name"])
+                self._record(function_name, arguments)
+            self.turn = max(current_turn, self.turn)
+            return results
+
+    def flush(self) -> bool:
+        # writes the players to the csv if anything changed since the last flush, returns whether it wrote
+        with self._lock:
+            if not self._changed and not self._deleted:
+                return False
+            self.backend.write(
+                list(self._players.values()),
+                [self._players[name] for name in self._changed],
+                list(self._deleted),
+            )
+            self._changed = set()
+            self._deleted = set()
+            return True
+
+    def _fragments(self) -> Dict[str, str]:
+        # one compact JSON object per player, rebuilt only after a change
+        return self._serialized.get(self.version, "fragments", lambda: {
+            name: json.dumps(asdict(p), separators=(",", ":")) for name, p in self._players.items()
+        })
+
+    def serialized(self, user_input: Optional[str] = None, mentioned_only: bool = False,
+                   tokenizer=None, max_tokens: Optional[int] = None) -> str:
+        # the game state for the prompt
+        # mentioned_only: only the players named in user_input (all players if nobody is named)
+        # tokenizer/max_tokens: the players named in user_input first, then the rest of the party, as many as fit
+        with self._lock:
+            self._ensure_loaded()
+            fragments = self._fragments()
+            names = list(fragments)
+
+            if mentioned_only:
+                selected = tuple(mentioned_names(names, user_input) or names)
+                return self._serialized.get(self.version, ("players", selected), lambda: join_fragments([fragments[n] for n in selected]))
+
+            if tokenizer is None or max_tokens is None:
+                return self._serialized.get(self.version, "all", lambda: join_fragments(list(fragments.values())))
+
+            ordered = tuple(order_by_mention(names, user_input))
+            count_tokens = lambda text: len(tokenizer.encode(text))
+            return self._serialized.get(
+                self.version, ("budget", ordered, max_tokens, id(tokenizer)),
+                lambda: fit_to_token_budget([fragments[n] for n in ordered], count_tokens, max_tokens),
+            )
+
+    def begin_turn(self, turn: Optional[int] = None) -> int:
+        # changes after this are recorded under the new turn
+        with self._lock:
+            self.turn = self.turn + 1 if turn is None else turn
+            self._timeline.append(self.turn)
+            return self.turn
+
+    def state_at(self, turn: int) -> List[Player]:
+        # the players at the end of an earlier turn (needs the journal)
+        with self._lock:
+            if not self.journal:
+                raise RuntimeError("The game state history needs the journal (DMRAG_GAME_STATE_JOURNAL=1)")
+            return list(self.journal.state_at(turn).values())
+
+    def undo(self, turns: int = 1) -> int:
+        # goes back to the state at the end of an earlier turn, returns that turn
+        # the undone turns leave the timeline, so undoing again goes back further
+        # the undo itself is recorded as a new event under a turn of its own, the history is never rewritten
+        # (the state at the end of an undone turn can still be looked up with state_at)
+        with self._lock:
+            del self._timeline[max(1, len(self._timeline) - turns):]
+            target_turn = self._timeline[-1]
+            players = self.state_at(target_turn)
+            self.turn += 1
+            self.replace_all(players)
+            return target_turn
+
+    def reset(self):
+        # forgets the players (in memory and on disk), used when a new game starts
+        with self._lock:
+            self._players = {}
+            self._loaded = True
+            self._changed = set()
+            self._deleted = set()
+            self.version += 1
+            self.turn = 0
+            self._timeline = [0]
+            self.backend.reset()
+            if self.journal:
+                self.journal.reset()
+
+    def close(self):
+        self._stop.set()
+        self.flush()
+
+    def _flush_periodically(self):
+        while not self._stop.wait(self.flush_interval):
+            try:
+                self.flush()
+            except OSError as e:
+                print(f"Could not write the game state to {self.filename}: {e}")
+
+_stores: Dict[str, GameStateStore] = {}
+_stores_lock = threading.Lock()
+
+def get_store(filename: str = CSV_FILENAME) -> GameStateStore:
+    with _stores_lock:
+        if filename not in _stores:
+            base = os.path.splitext(filename)[0]
+            if GAME_STATE_BACKEND == "sqlite":
+                # the database is shared, the session keeps this run's players (and journal) apart from other runs
+                backend = SqliteBackend(GAME_STATE_DB, f"{GAME_STATE_SESSION}/{filename}")
+                base = f"{base}_{GAME_STATE_SESSION}"
+            else:
+                backend = CsvBackend(filename)
+            journal = None
+            if USE_GAME_STATE_JOURNAL:
+                from game_state_journal import GameStateJournal
+                journal = GameStateJournal(f"{base}_journal.jsonl", f"{base}_snapshots.jsonl")
+            _stores[filename] = GameStateStore(filename, journal=journal, backend=backend)
+        return _stores[filename]
+
+def flush_game_state():
+    # called at turn boundaries
+    for store in list(_stores.values()):
+        store.flush()
+
+def begin_turn(filename: str = CSV_FILENAME) -> int:
+    return get_store(filename).begin_turn()
+
+def undo_turn(filename: str = CSV_FILENAME) -> int:
+    return get_store(filename).undo()
+
+def reset_game_state(filename: str = CSV_FILENAME):
+    # a new game starts with no players and no history
+    get_store(filename).reset()
+
+atexit.register(flush_game_state)
+
+# the functions below keep their old signatures, but read and write the in-memory store instead of the csv
+
+def load_game_state(filename: str = CSV_FILENAME) -> List[Player]:
+    return get_store(filename).all()
+
+def game_state_prompt(user_input: Optional[str] = None, mentioned_only: bool = False, tokenizer=None,
+                      max_tokens: Optional[int] = None, filename: str = CSV_FILENAME) -> str:
+    # the compact JSON game state for the prompt, cached until the game state changes (see game_state_prompt.py)
+    return get_store(filename).serialized(user_input, mentioned_only, tokenizer, max_tokens)
+
 def save_game_state(players: List[Player], filename: str = CSV_FILENAME):
-    with open(filename, mode="w", newline="", encoding="utf-8") as f:
-        writer = csv.DictWriter(f, fieldnames=FIELDNAMES)
-        writer.writeheader()
-        for p in players:
-            writer.writerow(asdict(p))
+    get_store(filename).replace_all(players)
 
 def find_player(players: List[Player], name: str) -> Optional[Player]:
     return next((p for p in players if p.name == name), None)
 
 def create_player(new_player: Player, filename: str = CSV_FILENAME) -> bool:
-    players = load_game_state(filename)
-    if find_player(players, new_player.name):
-        return False
-    players.append(new_player)
-    save_game_state(players, filename)
-    return True
+    return get_store(filename).create(new_player)
 
 def get_all_players(filename: str = CSV_FILENAME) -> List[Player]:
     return load_game_state(filename)
 
 def get_player(name: str, filename: str = CSV_FILENAME) -> Optional[Player]:
-    return find_player(load_game_state(filename), name)
+    return get_store(filename).get(name)
 
 def update_player(name: str, **updates) -> bool:
-    players = load_game_state()
-    p = find_player(players, name)
-    if not p:
-        return False
-    valid_fields = {f.name for f in fields(Player)}
-    for attr, val in updates.items():
-        if attr in valid_fields:
-            setattr(p, attr, val)
-    save_game_state(players)
-    return True
+    return get_store().update(name, **updates)
 
 def delete_player(name: str, filename: str = CSV_FILENAME) -> bool:
-    players = load_game_state(filename)
-    new_list = [p for p in players if p.name != name]
-    if len(new_list) == len(players):
-        return False
-    save_game_state(new_list, filename)
-    return True
+    return get_store(filename).delete(name)
 
 def add_item_to_player(name: str, item: str) -> bool:
-    return update_player(name, item=item)
+    return apply_tool_call("add_item_to_player", {"name": name, "item": item})
 
 def remove_item_from_player(name: str, item: str) -> bool:
-    return update_player(name, item="")
+    return apply_tool_call("remove_item_from_player", {"name": name, "item": item})
 
 def change_weapon_for_player(name: str, weapon: str) -> bool:
-    return update_player(name, weapon=weapon)
+    return apply_tool_call("change_weapon_for_player", {"name": name, "weapon": weapon})
 
 def heal_player(name: str, amount: int) -> bool:
-    p = get_player(name)
-    if not p:
-        return False
-    new_hp = p.hp + amount
-    return update_player(name, hp=new_hp)
+    return apply_tool_call("heal_player", {"name": name, "amount": amount})
 
 def damage_player(name: str, amount: int) -> bool:
-    p = get_player(name)
-    if not p:
-        return False
-    new_hp = max(0, p.hp - amount)
-    return update_player(name, hp=new_hp)
+    return apply_tool_call("damage_player", {"name": name, "amount": amount})
 
 def restore_mana(name: str, amount: int) -> bool:
-    p = get_player(name)
-    if not p:
-        return False
-    new_mana = p.mana + amount
-    return update_player(name, mana=new_mana)
+    return apply_tool_call("restore_mana", {"name": name, "amount": amount})
 
 def drain_mana(name: str, amount: int) -> bool:
-    p = get_player(name)
-    if not p:
-        return False
-    new_mana = max(0, p.mana - amount)
-    return update_player(name, mana=new_mana)
+    return apply_tool_call("drain_mana", {"name": name, "amount": amount})
 
 def dice_roll(max_value: int) -> int:
     import random
     return random.randint(1, max_value)
 
+# a single llm completion can make several function calls (a fireball hitting three players is three damage_player calls)
+# all the calls are validated and applied to the in-memory players together (GameStateStore.apply_mutations)
+
+AMOUNT_FUNCTIONS = {"heal_player", "damage_player", "restore_mana", "drain_mana"}
+
+def validate_mutation(players: Dict[str, Player], function_name: str, arguments: dict) -> Optional[str]:
+    # returns why the function call can't be applied, or None if it can
+    if not arguments.get("name"):
+        return "missing player name"
+    if function_name == "create_player":
+        return "player already exists" if arguments["name"] in players else None
+    if arguments["name"] not in players:
+        return f"no player named {arguments['name']}"
+    if function_name in AMOUNT_FUNCTIONS:
+        amount = arguments.get("amount")
+        if not isinstance(amount, int) or isinstance(amount, bool) or amount < 0:
+            return f"invalid amount {amount!r}"
+    elif function_name in ("add_item_to_player", "remove_item_from_player"):
+        if not isinstance(arguments.get("item"), str):
+            return "missing item"
+    elif function_name == "change_weapon_for_player":
+        if not isinstance(arguments.get("weapon"), str):
+            return "missing weapon"
+    else:
+        return f"unknown function {function_name}"
+    return None
+
+def apply_mutation(players: Dict[str, Player], function_name: str, arguments: dict) -> bool:
+    # applies one validated function call to the in-memory players (silently, the journal replays it too)
+    if function_name == "create_player":
+        new_player = Player(
+            arguments.get("name"),
+            arguments.get("character_class"),
+            arguments.get("race"),
+            arguments.get("weapon", "Fists"),
+            arguments.get("items", []),
+            hp=arguments.get("hp", 100),
+            mana=arguments.get("mana", 100),
+            status=arguments.get("status", "Base"),
+        )
+        players[new_player.name] = new_player
+        return True
+
+    p = players[arguments["name"]]
+    if function_name == "add_item_to_player":
+        p.item = arguments["item"]
+    elif function_name == "remove_item_from_player":
+        p.item = ""
+    elif function_name == "change_weapon_for_player":
+        p.weapon = arguments["weapon"]
+    elif function_name == "heal_player":
+        p.hp = p.hp + arguments["amount"]
+    elif function_name == "damage_player":
+        p.hp = max(0, p.hp - arguments["amount"])
+    elif function_name == "restore_mana":
+        p.mana = p.mana + arguments["amount"]
+    elif function_name == "drain_mana":
+        p.mana = max(0, p.mana - arguments["amount"])
+    return True
+
+def apply_mutations(mutations: List[Tuple[str, Dict]], filename: str = CSV_FILENAME, turn: Optional[int] = None) -> List[bool]:
+    return get_store(filename).apply_mutations(mutations, turn)
+
+def apply_tool_call(function_name: str, arguments: dict) -> bool:
+    # calls the game state function for one function call made by the llm (see the tools list below)
+    return apply_mutations([(function_name, arguments)])[0]
+
 tools = [
     {
         "type":"function",
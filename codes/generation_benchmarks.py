@@ -0,0 +1,120 @@
+"""
+WHAT:
+
+Shared helpers to measure the GPT-2 DM generator: perplexity over a held-out slice of merged.jsonl and generation speed in tokens/sec.
+
+WHY
+
+Every change to how we run the model (quantization, compiled graphs, other backends) has to be checked twice:
+does it still model the text the same way (perplexity parity) and is it actually faster (tokens/sec).
+Keeping both measurements in one place means every mode is measured the same way.
+
+NOTE: This is not a runnable file, its functions are used by the backend scripts (e.g. cpu_inference.py)
+"""
+
+import json
+import math
+import time
+
+import torch
+
+HELDOUT_PATH = "jsonl_files/merged.jsonl"
+
+# prompts in the same shape as the ones built in the pipeline main loop, used for the speed benchmark
+BENCHMARK_PROMPTS = [
+    "Context: The goblins hide behind the overturned wagon.\nGame state: []\nPlayer: I draw my sword and charge the goblins.\nRespond to player's input using the context and game state. Create a single next narration that is concise.\nDM: ",
+    "Context: The village of Barovia is dark and silent.\nGame state: []\nPlayer: I knock on the door of the tavern.\nRespond to player's input using the context and game state. Create a single next narration that is concise.\nDM: ",
+    "Context: Johan Petry has a quest for you.\nGame state: []\nPlayer: I ask Johan about the reward.\nRespond to player's input using the context and game state. Create a single next narration that is concise.\nDM: ",
+]
+
+
+def load_heldout_texts(jsonl_file: str = HELDOUT_PATH, num_texts: int = 50, min_words: int = 10) -> list[str]:
+    # we take the tail of the file as the held-out slice
+    # the numbers are only compared between modes of the same model, so what matters is that every mode sees the same texts
+    texts = []
+    with open(jsonl_file, "r", encoding="utf-8") as f:
+        for line in f:
+            text = json.loads(line).get("text", "").strip()
+            if len(text.split()) >= min_words:
+                texts.append(text)
+    return texts[-num_texts:]
+
+
+def sliding_window_nll(model, input_ids: torch.Tensor, max_length: int = None, stride: int = 512) -> tuple[float, int]:
+    # returns (summed negative log likelihood, number of predicted tokens) for a single sequence
+    # sequences longer than the model context are scored with a sliding window, where each window only scores
+    # the tokens that the previous window did not score (https://huggingface.co/docs/transformers/perplexity)
+    # we compute the loss from the logits ourselves so this works for any backend that returns .logits
+    max_length = max_length or model.config.n_positions
+    seq_len = input_ids.size(1)
+
+    nll_sum = 0.0
+    n_tokens = 0
+    prev_end = 0
+    for begin in range(0, seq_len, stride):
+        end = min(begin + max_length, seq_len)
+        window = input_ids[:, begin:end]
+        # the first token of a later window has no left context in the window, so it is never scored here
+        score_from = max(prev_end - begin, 1)
+
+        with torch.no_grad():
+            logits = model(input_ids=window, attention_mask=torch.ones_like(window)).logits
+
+        shift_logits = logits[:, score_from - 1:-1, :].float()
+        shift_labels = window[:, score_from:]
+        if shift_labels.numel():
+            nll_sum += torch.nn.functional.cross_entropy(
+                shift_logits.reshape(-1, shift_logits.size(-1)),
+                shift_labels.reshape(-1),
+                reduction="sum",
+            ).item()
+            n_tokens += shift_labels.numel()
+
+        prev_end = end
+        if end == seq_len:
+            break
+
+    return nll_sum, n_tokens
+
+
+def perplexity(model, tokenizer, texts: list[str], stride: int = 512) -> float:
+    # corpus level perplexity (token weighted) over all the texts
+    nll_sum = 0.0
+    n_tokens = 0
+    for text in texts:
+        input_ids = tokenizer(text, return_tensors="pt").input_ids.to(model.device)
+        text_nll, text_tokens = sliding_window_nll(model, input_ids, stride=stride)
+        nll_sum += text_nll
+        n_tokens += text_tokens
+    return math.exp(nll_sum / max(n_tokens, 1))
+
+
+def tokens_per_second(model, tokenizer, prompts: list[str] = None, max_new_tokens: int = 80, warmup: int = 1, **generate_kwargs) -> float:
+    # we use the same sampling settings as generate_model_response in pipeline.py
+    # min_new_tokens makes every run produce the same number of tokens, so runs are comparable
+    prompts = prompts or BENCHMARK_PROMPTS
+    generate_kwargs = {
+        "do_sample": True,
+        "top_p": 0.4,
+        "max_new_tokens": max_new_tokens,
+        "min_new_tokens": max_new_tokens,
+        "pad_token_id": tokenizer.eos_token_id,
+        **generate_kwargs,
+    }
+
+    encoded = [tokenizer(prompt, return_tensors="pt").to(model.device) for prompt in prompts]
+
+    # the first calls pay for lazy initialisation and graph compilation, so they are not timed
+    for enc in encoded[:warmup]:
+        with torch.no_grad():
+            model.generate(**enc, **generate_kwargs)
+
+    generated = 0
+    start = time.perf_counter()
+    for enc in encoded:
+        with torch.no_grad():
+            out = model.generate(**enc, **generate_kwargs)
+        generated += out.shape[1] - enc["input_ids"].shape[1]
+    elapsed = time.perf_counter() - start
+
+    return generated / elapsed
@@ -0,0 +1,93 @@
+"""
+WHAT:
+
+ONNX Runtime backend for our fine-tuned GPT-2 models on CPU.
+The model is exported as a decoder-with-past ONNX graph (past key values are graph inputs/outputs),
+so generation keeps its kv cache like the PyTorch model does.
+
+Export (either of these, the onnx model is written next to the PyTorch model with an "_onnx" suffix):
+    python onnx_backend.py
+    optimum-cli export onnx --model gpt2_dnd_finetuned/gpt2_dnd_finetuned --task text-generation-with-past gpt2_dnd_finetuned/gpt2_dnd_finetuned_onnx
+
+Running this file exports the model if needed, then checks perplexity parity against eager PyTorch
+on a held-out slice of merged.jsonl and compares tokens/sec.
+
+The backend is picked with DMRAG_GENERATION_BACKEND=onnx (default: torch), for the CLI (pipeline.py) and the API (ui/api/model_pool.py).
+
+WHY
+
+For deployments without a GPU, ONNX Runtime's CPU kernels and graph optimizations are faster than eager PyTorch.
+The ORT model goes through the same HF generate(), so sampling (top_p=0.4, max_new_tokens=80) behaves exactly like generate_model_response.
+"""
+
+import os
+
+GENERATION_BACKENDS = ("torch", "onnx")
+GENERATION_BACKEND = os.getenv("DMRAG_GENERATION_BACKEND", "torch")
+ONNX_NUM_THREADS = int(os.getenv("DMRAG_ONNX_NUM_THREADS", "0"))  # 0 lets onnxruntime decide
+
+
+def onnx_model_dir(model_path: str) -> str:
+    return model_path.rstrip("/") + "_onnx"
+
+
+def export_onnx(model_path: str, output_dir: str = None) -> str:
+    # optimum exports the decoder with past key values as graph inputs (text-generation-with-past)
+    from optimum.onnxruntime import ORTModelForCausalLM
+    from transformers import GPT2Tokenizer
+
+    output_dir = output_dir or onnx_model_dir(model_path)
+    model = ORTModelForCausalLM.from_pretrained(model_path, export=True, use_cache=True)
+    model.save_pretrained(output_dir)
+    GPT2Tokenizer.from_pretrained(model_path).save_pretrained(output_dir)
+    print(f"Exported {model_path} to {output_dir}")
+    return output_dir
+
+
+def load_onnx_model(onnx_dir: str, num_threads: int = ONNX_NUM_THREADS):
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForCausalLM
+
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads > 0:
+        session_options.intra_op_num_threads = num_threads
+
+    return ORTModelForCausalLM.from_pretrained(
+        onnx_dir,
+        use_cache=True,
+        provider="CPUExecutionProvider",
+        session_options=session_options,
+    )
+
+
+if __name__ == "__main__":
+    from transformers import GPT2LMHeadModel, GPT2Tokenizer
+    from generation_benchmarks import HELDOUT_PATH, load_heldout_texts, perplexity, tokens_per_second
+
+    MODEL_PATH = "gpt2_dnd_finetuned/gpt2_dnd_finetuned"
+    NUM_HELDOUT_TEXTS = 50
+    # the onnx graph computes the same function as the pytorch model, so we only allow float rounding differences
+    PARITY_TOLERANCE = 0.01
+
+    onnx_dir = onnx_model_dir(MODEL_PATH)
+    if not os.path.isdir(onnx_dir):
+        export_onnx(MODEL_PATH, onnx_dir)
+
+    tokenizer = GPT2Tokenizer.from_pretrained(MODEL_PATH)
+    torch_model = GPT2LMHeadModel.from_pretrained(MODEL_PATH).eval()
+    onnx_model = load_onnx_model(onnx_dir)
+    texts = load_heldout_texts(HELDOUT_PATH, NUM_HELDOUT_TEXTS)
+
+    torch_ppl = perplexity(torch_model, tokenizer, texts)
+    onnx_ppl = perplexity(onnx_model, tokenizer, texts)
+    rel_diff = (onnx_ppl - torch_ppl) / torch_ppl
+
+    torch_tps = tokens_per_second(torch_model, tokenizer)
+    onnx_tps = tokens_per_second(onnx_model, tokenizer)
+
+    print(f"{'backend':<10}{'perplexity':>12}{'tokens/s':>10}")
+    print(f"{'torch':<10}{torch_ppl:>12.2f}{torch_tps:>10.1f}")
+    print(f"{'onnx':<10}{onnx_ppl:>12.2f}{onnx_tps:>10.1f}")
+    print(f"perplexity difference: {rel_diff:+.3%} ({'ok' if abs(rel_diff) <= PARITY_TOLERANCE else 'FAILED'})")
+    print(f"speedup: {onnx_tps / torch_tps:.2f}x")
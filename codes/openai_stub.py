@@ -0,0 +1,104 @@
+import json
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+"""
+This file is a local stand-in for the OpenAI chat completions endpoint, used to benchmark turn latency
+Note: This is not a runnable file, it is used by openai_turn.py
+
+Why:
+    Comparing the three-call and the single-call OpenAI turn against the real API measures mostly network noise,
+    and costs tokens. The stub answers every request after a fixed latency, so the difference between the modes
+    is exactly the number of round trips.
+
+How:
+    A threaded HTTP server on localhost answers POST /v1/chat/completions with canned responses:
+    a structured dm_turn JSON when the request asks for a json_schema response, a tool call when tools are passed,
+    and a plain narration otherwise.
+"""
+
+CANNED_NARRATION = "The goblin staggers back as your blade finds its mark, and the road falls quiet."
+CANNED_TURN = {
+    "dice_roll": {"max_value": 20},
+    "narration": CANNED_NARRATION,
+    "state_changes": [
+        {"function": "damage_player", "name": "John", "amount": 3, "item": None, "weapon": None},
+    ],
+}
+CANNED_TOOL_CALL = {
+    "id": "call_stub",
+    "type": "function",
+    "function": {"name": "damage_player", "arguments": json.dumps({"name": "John", "amount": 3})},
+}
+
+
+def canned_message(request: dict) -> dict:
+    if request.get("response_format", {}).get("type") == "json_schema":
+        return {"role": "assistant", "content": json.dumps(CANNED_TURN)}
+    if request.get("tools"):
+        return {"role": "assistant", "content": None, "tool_calls": [CANNED_TOOL_CALL]}
+    return {"role": "assistant", "content": CANNED_NARRATION}
+
+
+class StubOpenAIServer:
+    def __init__(self, latency_seconds: float = 0.3, host: str = "127.0.0.1", port: int = 0):
+        self.latency_seconds = latency_seconds
+        self.request_count = 0
+        self._lock = threading.Lock()
+        self._server = ThreadingHTTPServer((host, port), self._handler_class())
+        self._thread = threading.Thread(target=self._server.serve_forever, daemon=True)
+
+    @property
+    def base_url(self) -> str:
+        host, port = self._server.server_address[:2]
+        return f"http://{host}:{port}/v1"
+
+    def reset_counts(self):
+        with self._lock:
+            self.request_count = 0
+
+    def _handler_class(self):
+        stub = self
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_POST(self):
+                body = self.rfile.read(int(self.headers.get("Content-Length", 0)))
+                request = json.loads(body or b"{}")
+                with stub._lock:
+                    stub.request_count += 1
+                time.sleep(stub.latency_seconds)
+
+                message = canned_message(request)
+                response = json.dumps({
+                    "id": "chatcmpl-stub",
+                    "object": "chat.completion",
+                    "created": int(time.time()),
+                    "model": request.get("model", "stub"),
+                    "choices": [{
+                        "index": 0,
+                        "message": message,
+                        "finish_reason": "tool_calls" if message.get("tool_calls") else "stop",
+                    }],
+                    "usage": {"prompt_tokens": 0, "completion_tokens": 0, "total_tokens": 0},
+                }).encode()
+
+                self.send_response(200)
+                self.send_header("Content-Type", "application/json")
+                self.send_header("Content-Length", str(len(response)))
+                self.end_headers()
+                self.wfile.write(response)
+
+            def log_message(self, format, *args):
+                # keep the benchmark output clean
+                pass
+
+        return Handler
+
+    def __enter__(self):
+        self._thread.start()
+        return self
+
+    def __exit__(self, exc_type, exc, tb):
+        self._server.shutdown()
+        self._server.server_close()
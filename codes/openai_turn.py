@@ -0,0 +1,201 @@
+"""
+WHAT:
+
+Single-call turn for the OpenAI DM model (model_choice == 3).
+Instead of three sequential OpenAI calls per turn (user_parser for dice, the DM completion, parser for the game state),
+we ask the model once for a structured response with the dice request, the narration and the game state changes,
+and then roll the dice and apply the changes locally.
+
+Running this file replays a session against a local stub of the OpenAI endpoint (openai_stub.py)
+and compares the turn latency of the three-call and the single-call mode.
+
+WHY
+
+With the OpenAI model, the turn latency is almost entirely network round trips, so three calls cost about three times one call.
+The structured output (json_schema, strict) guarantees that the response can be parsed and applied without a second model call.
+"""
+
+import json
+import os
+
+from dice import local_dice_roll, roll_dice, DiceSpec, is_valid_spec
+from game_state_manager import apply_mutations
+
+# the combined mode is switched on with DMRAG_OPENAI_SINGLE_CALL=1
+USE_SINGLE_CALL_TURN = os.getenv("DMRAG_OPENAI_SINGLE_CALL", "0") == "1"
+
+# the game state functions a narration can trigger (players are only created during the setup)
+STATE_CHANGE_FUNCTIONS = [
+    "add_item_to_player",
+    "remove_item_from_player",
+    "change_weapon_for_player",
+    "heal_player",
+    "damage_player",
+    "restore_mana",
+    "drain_mana",
+]
+
+# strict structured outputs need every field to be required, so optional arguments are nullable instead
+COMBINED_TURN_SCHEMA = {
+    "type": "object",
+    "properties": {
+        "dice_roll": {
+            "anyOf": [
+                {
+                    "type": "object",
+                    "properties": {"max_value": {"type": "integer", "description": "Maximum value of the dice, e.g. 20 for a d20"}},
+                    "required": ["max_value"],
+                    "additionalProperties": False,
+                },
+                {"type": "null"},
+            ],
+            "description": "The dice roll the player's input asks for, or null if there is none",
+        },
+        "narration": {"type": "string", "description": "The DM narration for the players"},
+        "state_changes": {
+            "type": "array",
+            "description": "Changes to the players' hp, mana, items or weapons that happen in the narration",
+            "items": {
+                "type": "object",
+                "properties": {
+                    "function": {"type": "string", "enum": STATE_CHANGE_FUNCTIONS},
+                    "name": {"type": "string", "description": "Name of the player"},
+                    "amount": {"type": ["integer", "null"], "description": "Amount for damage, healing and mana changes"},
+                    "item": {"type": ["string", "null"], "description": "Item for item changes"},
+                    "weapon": {"type": ["string", "null"], "description": "New weapon for weapon changes"},
+                },
+                "required": ["function", "name", "amount", "item", "weapon"],
+                "additionalProperties": False,
+            },
+        },
+    },
+    "required": ["dice_roll", "narration", "state_changes"],
+    "additionalProperties": False,
+}
+
+COMBINED_TURN_INSTRUCTIONS = """You are the dungeon master for a D&D game. Here's the context: {context} \n\n
+Here's the current game state of the players: {game_state} \n\n
+Respond to the player's input as the DM.
+Keep your responses extremely concise, and only include the relevant information.
+If the player describes an action, respond with whether it is successful or not, and provide any relevant details of what happened as a result of the action.
+You must give the player information about the game world, and not just respond to their input.
+If the player asks a question, respond with the answer as the DM.
+Try to keep your responses relevant to the context provided.
+
+Answer with a JSON object:
+- dice_roll: if the player's input asks for a dice roll and no roll result is given below, the dice to roll (e.g. max_value 20 for a d20), otherwise null
+- narration: your narration
+- state_changes: every change to a player's hp, mana, items or weapon that happens in your narration, using the players' names from the game state
+{roll_note}"""
+
+
+def build_combined_messages(context, game_state, user_input, roll=None):
+    roll_note = f"\nThe player already rolled a {roll}, narrate the outcome accordingly." if roll is not None else ""
+    return [
+        {
+            "role": "developer",
+            "content": COMBINED_TURN_INSTRUCTIONS.format(context=context, game_state=game_state, roll_note=roll_note),
+        },
+        {"role": "user", "content": user_input},
+    ]
+
+
+def combined_turn_request(context, game_state, user_input):
+    # clear dice rolls are resolved before the call (dice.py), so the narration can use the result
+    handled, roll = local_dice_roll(user_input)
+    request = {
+        "model": "gpt-4.1-nano",
+        "messages": build_combined_messages(context, game_state, user_input, roll if handled else None),
+        "response_format": {
+            "type": "json_schema",
+            "json_schema": {"name": "dm_turn", "strict": True, "schema": COMBINED_TURN_SCHEMA},
+        },
+    }
+    return request, (roll if handled else None)
+
+
+def apply_combined_turn(response_content, local_roll=None):
+    # rolls the dice the model asked for and applies the state changes locally
+    # returns the narration to show the players and the dice result (if any)
+    turn = json.loads(response_content)
+
+    roll = local_roll
+    if roll is None and turn.get("dice_roll"):
+        # the model picks max_value, so it gets the same bounds as the dice we parse ourselves
+        spec = DiceSpec(count=1, sides=turn["dice_roll"]["max_value"])
+        if is_valid_spec(spec):
+            roll = roll_dice(spec).total
+
+    # all the changes of the turn are applied with a single read and write of the game state
+    apply_mutations([
+        (change["function"], {key: value for key, value in change.items() if key != "function" and value is not None})
+        for change in turn.get("state_changes", [])
+    ])
+
+    narration = turn.get("narration", "")
+    if roll is not None and local_roll is None:
+        narration = f"(Player rolled a {roll}.) {narration}"
+    return narration, roll
+
+
+def combined_turn(client, context, game_state, user_input):
+    request, local_roll = combined_turn_request(context, game_state, user_input)
+    completion = client.chat.completions.create(**request)
+    return apply_combined_turn(completion.choices[0].message.content, local_roll)
+
+
+async def combined_turn_async(async_client, context, game_state, user_input):
+    request, local_roll = combined_turn_request(context, game_state, user_input)
+    completion = await async_client.chat.completions.create(**request)
+    return apply_combined_turn(completion.choices[0].message.content, local_roll)
+
+
+if __name__ == "__main__":
+    import tempfile
+    import time
+
+    from openai import OpenAI
+    from game_state_manager import Player, create_player, tools, user_tools
+    from openai_stub import StubOpenAIServer
+
+    STUB_LATENCY_SECONDS = 0.3
+    SESSION = [
+        "I search the wagon for supplies",
+        "I attack the goblin with my sword",
+        "I drink a healing potion",
+        "I ask Sildar about Gundren",
+        "I cast a fireball at the bandits",
+    ]
+    CONTEXT = "Goblins ambush the party on the Triboar Trail."
+
+    # the game state functions write game_state.csv to the working directory, so we replay in a temporary one
+    os.chdir(tempfile.mkdtemp())
+    create_player(Player("John", "Mage", "Half-orc", "Staff", "", hp=20, mana=100))
+    game_state = '[{"name":"John","hp":20,"mana":100}]'
+
+    with StubOpenAIServer(latency_seconds=STUB_LATENCY_SECONDS) as stub:
+        client = OpenAI(base_url=stub.base_url, api_key="stub")
+
+        def three_call_turn(user_input):
+            # the original sequence: dice detection, DM completion, game state parser (each a round trip)
+            client.chat.completions.create(model="gpt-4.1-nano", messages=[{"role": "user", "content": user_input}], tools=user_tools)
+            completion = client.chat.completions.create(model="gpt-4.1-nano", messages=build_combined_messages(CONTEXT, game_state, user_input)[:1] + [{"role": "user", "content": user_input}])
+            narration = completion.choices[0].message.content
+            client.chat.completions.create(model="gpt-4.1-nano", messages=[{"role": "user", "content": narration}], tools=tools)
+
+        def single_call_turn(user_input):
+            combined_turn(client, CONTEXT, game_state, user_input)
+
+        results = {}
+        for mode, run_turn in (("three calls", three_call_turn), ("single call", single_call_turn)):
+            stub.reset_counts()
+            start = time.perf_counter()
+            for user_input in SESSION:
+                run_turn(user_input)
+            elapsed = time.perf_counter() - start
+            results[mode] = (elapsed / len(SESSION), stub.request_count / len(SESSION))
+
+    print(f"stub latency per request: {STUB_LATENCY_SECONDS * 1000:.0f} ms, {len(SESSION)} turns replayed")
+    print(f"{'mode':<14}{'ms/turn':>10}{'calls/turn':>12}")
+    for mode, (seconds_per_turn, calls_per_turn) in results.items():
+        print(f"{mode:<14}{seconds_per_turn * 1000:>10.0f}{calls_per_turn:>12.1f}")
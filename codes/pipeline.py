@@ -52,9 +52,10 @@ from rank_bm25 import BM25Okapi
 from sklearn.preprocessing import normalize
 from sentence_transformers import SentenceTransformer
 
-from openai import OpenAI
+from openai import OpenAI, AsyncOpenAI
 import json
-from dataclasses import asdict
+import time
+import asyncio
 from game_state_manager import (
     create_player,
     get_player,
@@ -66,11 +67,21 @@ from game_state_manager import (
     restore_mana,
     drain_mana,
     dice_roll,
+    apply_mutations,
     Player,
     tools,
     user_tools,
-    load_game_state,
+    game_state_prompt,
+    GAME_STATE_TOKEN_BUDGET,
+    flush_game_state,
+    reset_game_state,
+    begin_turn,
+    undo_turn,
 )
+from dice import dice_stats, local_dice_fraction, local_dice_roll, record_remote_dice_call
+from state_change_gate import STATE_GATE_SHADOW, gate_stats, log_narration, may_change_state
+from openai_turn import USE_SINGLE_CALL_TURN, combined_turn_async
+from state_update_queue import StateUpdateQueue
 
 generate_synthetic_flag = False
 # this flag will be used to generate synthetic ground truths for the model evaluation
@@ -80,8 +91,8 @@ if os.path.exists("raw_gpt2_output.txt"):
     os.remove("raw_gpt2_output.txt")
 if os.path.exists("perplexity_log.txt"):
     os.remove("perplexity_log.txt")
-if os.path.exists("game_state.csv"):
-    os.remove("game_state.csv")
+# removes game_state.csv and its history (game_state_journal.jsonl)
+reset_game_state()
 if os.path.exists("qa_log.txt"):
     os.remove("qa_log.txt")
 
@@ -167,24 +178,63 @@ class HybridRetriever:
 # -------------------------------------
 # 3) RESPONSE GENERATION
 # -------------------------------------
+import math
+import queue
+import threading
+
 from transformers import pipeline, GPT2Tokenizer, GPT2LMHeadModel
 import torch
+from generation_benchmarks import sliding_window_nll
+from cpu_inference import CPU_INFERENCE_MODE, configure_torch_threads, prepare_cpu_model
+from onnx_backend import GENERATION_BACKEND, load_onnx_model, onnx_model_dir
+from speculative_decoding import DRAFT_MODEL_PATH, REPLAY_TURNS_PATH, USE_SPECULATIVE_DECODING, load_draft_model
 
-def generate_model_response(prompt, model, tokenizer, model_choice):
-    dm_generator = pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-        device=0,
-    )
+MAX_NEW_TOKENS = 80
 
-    out = dm_generator(
-        prompt,
-        max_new_tokens=80,
-        do_sample=True,
-        top_p=0.4,
-        pad_token_id=tokenizer.eos_token_id,
-    )[0]["generated_text"]
+def generate_model_response(prompt, model, tokenizer, model_choice, perplexity_logger=None, draft_model=None):
+    input_ids = tokenizer(prompt, return_tensors="pt").input_ids.to(model.device)
+    full_prompt_ids = input_ids
+
+    # gpt-2 only has a 1024 token context, so for long prompts we keep the end of the prompt that still fits with the new tokens
+    max_prompt_tokens = model.config.n_positions - MAX_NEW_TOKENS
+    if input_ids.shape[1] > max_prompt_tokens:
+        input_ids = input_ids[:, -max_prompt_tokens:]
+
+    with torch.no_grad():
+        # we run the prompt (without its last token) through the model ourselves instead of letting generate do it
+        # the logits give us the prompt perplexity for free, and the kv cache is handed to generate,
+        # so the prompt is still processed only once and we don't need a second forward pass for the perplexity log
+        prefix_ids = input_ids[:, :-1]
+        prefix = model(input_ids=prefix_ids, attention_mask=torch.ones_like(prefix_ids), use_cache=True) if input_ids.shape[1] > 1 else None
+
+        generation = model.generate(
+            input_ids,
+            attention_mask=torch.ones_like(input_ids),
+            past_key_values=prefix.past_key_values if prefix is not None else None,
+            max_new_tokens=MAX_NEW_TOKENS,
+            do_sample=True,
+            top_p=0.4,
+            pad_token_id=tokenizer.eos_token_id,
+            # with a draft model, generate switches to assisted generation (see speculative_decoding.py)
+            assistant_model=draft_model,
+            return_dict_in_generate=True,
+            # output_logits gives the raw logits, output_scores would give them after top_p filtering (-inf for most tokens)
+            output_logits=True,
+        )
+
+    generated_ids = generation.sequences[0, input_ids.shape[1]:]
+    out = prompt + tokenizer.decode(generated_ids, skip_special_tokens=True)
+
+    if perplexity_logger is not None:
+        perplexity_logger.submit(
+            prompt,
+            prompt_ids=input_ids[0],
+            prompt_logits=prefix.logits[0] if prefix is not None else None,
+            generated_ids=generated_ids,
+            generated_logits=torch.stack(generation.logits, dim=1)[0],
+            model=model,
+            full_prompt_ids=full_prompt_ids if full_prompt_ids is not input_ids else None,
+        )
 
     # print(out)
 
@@ -224,7 +274,7 @@ def generate_model_response(prompt, model, tokenizer, model_choice):
 # 4) GAME STATE PARSER
 # -------------------------------------
 
-def parser(client, answer):
+def parser(client, answer, turn=None):
     # this function is to parse the model response to check if any changes to the game state were made
     # we make use of OpenAI API function calling for this
     # essentially, we pass it all the CRUD functions we have for the game state (as defined in game_state_manager.py)
@@ -238,68 +288,58 @@ def parser(client, answer):
         tools=tools
     )
 
+    # returns the tool calls that were applied
+    # turn is the turn the narration belongs to, so the game state journal records the changes under it
     tool_calls = completion.choices[0].message.tool_calls
+    apply_tool_calls(tool_calls, turn)
+    return tool_calls or []
 
+def apply_tool_calls(tool_calls, turn=None):
+    # calls the game state functions that the model asked for
+    # all the calls of one completion are applied together, with a single read and write of the game state
     if not tool_calls:
         return
-    
-    for tool_call in tool_calls:
-        function_name = tool_call.function.name
-        arguments = tool_call.function.arguments
-        arguments = json.loads(arguments)
 
-        if function_name == "create_player":
-            player_name = arguments.get("name")
-            player_class = arguments.get("character_class")
-            player_race = arguments.get("race")
-            player_hp = arguments.get("hp", 100)
-            player_mana = arguments.get("mana", 100)
-            player_weapon = arguments.get("weapon", "Fists")
-            player_items = arguments.get("items", [])
-            player_status = arguments.get("status", "Base")
-
-            new_player = Player(
-                player_name,
-                player_class,
-                player_race,
-                player_weapon,
-                player_items,
-                hp=player_hp,
-                mana=player_mana,
-                status=player_status,
-            )
-            
-            success = create_player(new_player)            
-            if success:
-                print(f"Player created: {new_player.name}, {new_player.character_class}, {new_player.race} with {new_player.hp} HP and {new_player.mana} mana, wielding {new_player.weapon}.")
-        elif function_name == "add_item_to_player":
-            add_item_to_player(arguments["name"], arguments["item"])
-        elif function_name == "remove_item_from_player":
-            remove_item_from_player(arguments["name"], arguments["item"])
-        elif function_name == "change_weapon_for_player":
-            change_weapon_for_player(arguments["name"], arguments["weapon"])
-        elif function_name == "damage_player":
-            damage_player(arguments["name"], arguments["amount"])
-        elif function_name == "heal_player":
-            heal_player(arguments["name"], arguments["amount"])
-        elif function_name == "restore_mana":
-            restore_mana(arguments["name"], arguments["amount"])
-        elif function_name == "drain_mana":
-            drain_mana(arguments["name"], arguments["amount"])
+    apply_mutations([
+        (tool_call.function.name, json.loads(tool_call.function.arguments))
+        for tool_call in tool_calls
+    ], turn=turn)
 
 def user_parser(client, answer):
     # this function is similar to the parser function above
     # except this is for user input
     # we use this solely for dice rolls
+    # clear cases (2d6+3, roll for initiative, no dice at all) are answered locally without an API call (see dice.py)
+
+    handled, result = local_dice_roll(answer)
+    if handled:
+        return result
 
+    record_remote_dice_call()
     completion = client.chat.completions.create(
         model="gpt-4.1-nano",
         messages=[{"role": "user", "content": answer}],
         tools=user_tools
     )
 
-    tool_calls = completion.choices[0].message.tool_calls
+    return dice_from_tool_calls(completion.choices[0].message.tool_calls)
+
+async def user_parser_async(async_client, answer):
+    # same as user_parser, with the async OpenAI client
+    handled, result = local_dice_roll(answer)
+    if handled:
+        return result
 
+    record_remote_dice_call()
+    completion = await async_client.chat.completions.create(
+        model="gpt-4.1-nano",
+        messages=[{"role": "user", "content": answer}],
+        tools=user_tools
+    )
+
+    return dice_from_tool_calls(completion.choices[0].message.tool_calls)
+
+def dice_from_tool_calls(tool_calls):
     if not tool_calls:
         return None
     
@@ -313,6 +353,169 @@ def user_parser(client, answer):
         
     return None
 
+# -------------------------------------
+# 4b) CONCURRENT TURN EXECUTION
+# -------------------------------------
+
+# every turn used to run strictly in sequence: retrieval, game state read, dice detection (an OpenAI round trip),
+# generation, and then the state parser (another OpenAI round trip) before the next input was accepted
+# retrieval, the game state read and dice detection don't depend on each other, so we run them concurrently,
+# and the state parser is queued to a background worker (state_update_queue.py) while the players type their next input
+# the next turn only waits for it right before it reads the game state
+
+OPENAI_DM_INSTRUCTIONS = """You are the dungeon master for a D&D game. Here's the context: {context} \n\n
+                                Respond to the player's input as the DM. 
+                                Keep your responses extremely concise, and only include the relevant information. 
+                                Do not include any additional information.
+                                If the player describes an action, respond with whether it is successful or not, and provide any relevant details of what happened as a result of the action.
+                                Remember that you must narrate the game as the DM, and not just respond to the player's input.
+                                You must give the player information about the game world, and not just respond to their input.
+                                If the player asks a question, respond with the answer as the DM.
+                                Try to keep your responses relevant to the context provided.
+                            """
+
+class TurnRunner:
+    def __init__(self, client, async_client, retriever, model_choice, model=None, tokenizer=None,
+                 perplexity_logger=None, draft_model=None, top_k=3, alpha=0.5, state_queue=None, campaign_id="cli"):
+        self.client = client
+        self.async_client = async_client
+        self.retriever = retriever
+        self.model_choice = model_choice
+        self.model = model
+        self.tokenizer = tokenizer
+        self.perplexity_logger = perplexity_logger
+        self.draft_model = draft_model
+        self.top_k = top_k
+        self.alpha = alpha
+        # the state parsers run in turn order on the campaign's background worker
+        self.state_queue = state_queue or StateUpdateQueue()
+        self.campaign_id = campaign_id
+
+    async def _timed(self, timings, stage, awaitable):
+        start = time.perf_counter()
+        result = await awaitable
+        timings[stage] = time.perf_counter() - start
+        return result
+
+    async def _retrieve(self, combined_input):
+        top_chunks = await asyncio.to_thread(self.retriever.hybrid_search, combined_input, self.top_k, self.alpha)
+        return self.retriever.format_context(top_chunks)
+
+    async def _read_game_state(self, user_input):
+        # the game state has to include the changes of the previous turn's narration
+        await self.wait_for_pending()
+        # the serialized game state is cached until a change bumps its version
+        # for GPT-2 it has to fit a token budget, the players named in the input come first
+        if self.model_choice in (1, 2):
+            return game_state_prompt(user_input, tokenizer=self.tokenizer, max_tokens=GAME_STATE_TOKEN_BUDGET)
+        return game_state_prompt()
+
+    async def _generate(self, prompt, context, user_input):
+        if self.model_choice == 1 or self.model_choice == 2:
+            answer = await asyncio.to_thread(
+                generate_model_response, prompt, self.model, self.tokenizer, self.model_choice, self.perplexity_logger, self.draft_model
+            )
+
+            # we keep the prompts so the turns can be replayed by the generation benchmarks
+            with open(REPLAY_TURNS_PATH, "a", encoding="utf-8") as f:
+                f.write(json.dumps({"prompt": prompt}) + "\n")
+            return answer
+
+        completion = await self.async_client.chat.completions.create(
+            model="gpt-4.1-nano",
+            messages=[
+                {
+                    "role": "developer",
+                    "content": OPENAI_DM_INSTRUCTIONS.format(context=context)
+                },
+                {
+                    "role": "user",
+                    "content": user_input
+                }
+            ]
+        )
+        return completion.choices[0].message.content
+
+    def _apply_narration(self, answer, turn):
+        # runs on the state queue's worker thread
+        # most narrations can't change the game state, for those we skip the parser call (see state_change_gate.py)
+        gate_decision = may_change_state(answer)
+        if gate_decision or STATE_GATE_SHADOW:
+            tool_calls = parser(self.client, answer, turn)
+            log_narration(answer, gate_decision, [tool_call.function.name for tool_call in tool_calls])
+        # turn boundary: the game state lives in memory (GameStateStore), this writes the turn's changes to game_state.csv
+        flush_game_state()
+
+    async def wait_for_pending(self):
+        if self.state_queue.pending(self.campaign_id):
+            await asyncio.to_thread(self.state_queue.wait_for, self.campaign_id)
+
+    async def run_turn(self, user_input, prev_message):
+        timings = {}
+        turn_start = time.perf_counter()
+        combined_input = f"{prev_message} {user_input}"
+        # the game state changes of this turn are recorded under a new turn id in the journal
+        turn = begin_turn()
+
+        if self.model_choice == 3 and USE_SINGLE_CALL_TURN:
+            return await self._run_single_call_turn(user_input, combined_input, timings, turn_start)
+
+        # retrieval, game state and dice detection are independent, so they run concurrently
+        context, compact, user_parser_res = await asyncio.gather(
+            self._timed(timings, "retrieval", self._retrieve(combined_input)),
+            self._timed(timings, "game_state", self._read_game_state(user_input)),
+            self._timed(timings, "dice", user_parser_async(self.async_client, user_input)),
+        )
+
+        if user_parser_res:
+            context += f"\n\nPlayer rolled a {user_parser_res}.\n"
+
+        prompt = (
+            f"Context: {context}\n"
+            f"Game state: {compact}\n"
+            f"Player: {user_input}\n"
+            f"Respond to player's input using the context and game state. Create a single next narration that is concise.\n"
+            f"DM: "
+        )   
+
+        answer = await self._timed(timings, "generation", self._generate(prompt, context, user_input))
+        print("DM: ", answer)
+
+        # the state parser is off the critical path, the next input is accepted right away
+        self.state_queue.submit(self.campaign_id, self._apply_narration, answer, turn)
+
+        timings["total"] = time.perf_counter() - turn_start
+        self.print_timings(timings)
+        return answer
+
+    async def _run_single_call_turn(self, user_input, combined_input, timings, turn_start):
+        # one structured OpenAI call returns the dice request, the narration and the state changes,
+        # the dice are rolled and the changes applied locally, so there is no dice or parser round trip (see openai_turn.py)
+        context, compact = await asyncio.gather(
+            self._timed(timings, "retrieval", self._retrieve(combined_input)),
+            self._timed(timings, "game_state", self._read_game_state(user_input)),
+        )
+
+        answer, _ = await self._timed(
+            timings, "generation", combined_turn_async(self.async_client, context, compact, user_input)
+        )
+        print("DM: ", answer)
+        await asyncio.to_thread(flush_game_state)
+
+        timings["total"] = time.perf_counter() - turn_start
+        self.print_timings(timings)
+        return answer
+
+    def print_timings(self, timings):
+        breakdown = " | ".join(f"{stage} {seconds:.2f}s" for stage, seconds in timings.items())
+        stats = self.state_queue.stats(self.campaign_id)[self.campaign_id]
+        if stats["last_apply_seconds"] is not None:
+            breakdown += (
+                f" | state parser (previous turn, background) {stats['last_apply_seconds']:.2f}s"
+                f" | state queue depth {stats['queue_depth']}"
+            )
+        print(f"[turn timings] {breakdown}")
+
 # -------------------------------------
 # 5) PERPLEXITY CALCULATION
 # -------------------------------------
@@ -329,6 +532,63 @@ def calculate_perplexity(text, model, tokenizer):
     perplexity = torch.exp(loss).cpu().item()
     return perplexity
 
+def _perplexity_from_logits(logits, labels):
+    # logits[i] are the logits that predicted labels[i]
+    if logits is None or labels.numel() == 0:
+        return None
+    loss = torch.nn.functional.cross_entropy(logits.float(), labels)
+    return torch.exp(loss).cpu().item()
+
+class PerplexityLogger:
+    # the main loop used to call calculate_perplexity after every turn, which ran the whole prompt through the model again
+    # now generate_model_response hands over the logits it already computed, and this class turns them into
+    # prompt / continuation perplexities and writes them to perplexity_log.txt from a background thread,
+    # so the turn latency does not include any perplexity work
+
+    def __init__(self, log_file="perplexity_log.txt"):
+        self.log_file = log_file
+        self.queue = queue.Queue()
+        self.worker = threading.Thread(target=self._run, daemon=True)
+        self.worker.start()
+
+    def submit(self, prompt, prompt_ids, prompt_logits, generated_ids, generated_logits, model=None, full_prompt_ids=None):
+        # full_prompt_ids is only set when the prompt was too long for the model and got truncated for generation
+        self.queue.put((prompt, prompt_ids, prompt_logits, generated_ids, generated_logits, model, full_prompt_ids))
+
+    def close(self):
+        # waits for the pending entries to be written
+        self.queue.put(None)
+        self.worker.join()
+
+    def _run(self):
+        while True:
+            entry = self.queue.get()
+            if entry is None:
+                break
+            try:
+                self._write(*entry)
+            except Exception as e:
+                print(f"Could not log perplexity: {e}")
+
+    def _write(self, prompt, prompt_ids, prompt_logits, generated_ids, generated_logits, model, full_prompt_ids):
+        if full_prompt_ids is not None and model is not None:
+            # prompts longer than the gpt-2 context are scored with a sliding window over the full prompt
+            # this is the only case where we run the model again, and it happens here in the background
+            nll_sum, n_tokens = sliding_window_nll(model, full_prompt_ids)
+            prompt_perplexity = math.exp(nll_sum / max(n_tokens, 1))
+        else:
+            prompt_perplexity = _perplexity_from_logits(prompt_logits, prompt_ids[1:])
+
+        continuation_perplexity = _perplexity_from_logits(generated_logits, generated_ids)
+
+        with open(self.log_file, "a") as f:
+            f.write(f"Prompt: {prompt}\n")
+            if prompt_perplexity is not None:
+                f.write(f"Perplexity: {prompt_perplexity:.2f}\n")
+            if continuation_perplexity is not None:
+                f.write(f"Continuation perplexity: {continuation_perplexity:.2f}\n")
+            f.write("\n")
+
 # ------------------------------------------
 # 6) SYNTHETIC GROUND TRUTHS GENERATION
 # ------------------------------------------
@@ -445,8 +705,7 @@ def evaluate_multiple_custom_queries(queries_with_gt: list[tuple[str, set]], ret
 if __name__ == "__main__":
     client = OpenAI()
 
-    if os.path.exists("game_state.csv"):
-        os.remove("game_state.csv")
+    reset_game_state()
 
     welcome_message = f"""
 Welcome to our D&D game! 
@@ -471,6 +730,7 @@ Now, let's create the players.
         print("Please describe player ", i + 1, ". Be sure to include their name, character class, and race. You can also include their HP, Mana, and weapon.")
         player_description = input(f"Player {i + 1} description: ")
         parser(client, player_description)
+    flush_game_state()
 
     with open("campaign_details.json", "r") as f:
         campaigns = json.load(f)
@@ -530,10 +790,31 @@ Now, what model would you like to use for the game?
         tokenizer = GPT2Tokenizer.from_pretrained(model_name)
         model = GPT2LMHeadModel.from_pretrained(model_name)
 
+    # with DMRAG_GENERATION_BACKEND=onnx we run the exported onnx graph instead (see onnx_backend.py)
+    # otherwise the model runs on the GPU when there is one,
+    # and without a GPU in the CPU inference mode set by DMRAG_CPU_INFERENCE_MODE (see cpu_inference.py)
+    if model_choice in (1, 2) and GENERATION_BACKEND == "onnx":
+        model = load_onnx_model(onnx_model_dir(model_name))
+        print(f"Running the model with ONNX Runtime from {onnx_model_dir(model_name)}.")
+    elif model_choice in (1, 2) and torch.cuda.is_available():
+        model = model.to("cuda")
+        print("Running the model on the GPU.")
+    elif model_choice in (1, 2):
+        configure_torch_threads()
+        model = prepare_cpu_model(model, CPU_INFERENCE_MODE)
+        print(f"No GPU found, running the model on CPU in '{CPU_INFERENCE_MODE}' mode.")
+
+    # the draft model for speculative decoding is switched on with DMRAG_SPECULATIVE_DECODING=1 (see speculative_decoding.py)
+    draft_model = None
+    if model_choice in (1, 2) and USE_SPECULATIVE_DECODING:
+        draft_model = load_draft_model(DRAFT_MODEL_PATH, model.device)
+        print(f"Using speculative decoding with the draft model from {DRAFT_MODEL_PATH}.")
+
     post_model_select_message = f"""
 Great! You have selected the model.
 Now, let's start the game!
 You can stop the game at any time by typing 'exit'.
+Type 'undo' to take back the game state changes of the last turn.
     """
     print(post_model_select_message)
 
@@ -546,85 +827,50 @@ What would you like to do?
     print(starter_message)
 
     prev_message = starter_message
-                    
-    while True:
-        user_input = input("Enter your response: ")
-        if user_input.lower() == "exit":
-            break
-
-        combined_input = f"{prev_message} {user_input}"
-        
-        # top_chunks = retriever.hybrid_search(user_input, top_k=TOP_K, alpha=ALPHA)
-        top_chunks = retriever.hybrid_search(combined_input, top_k=TOP_K, alpha=ALPHA)
-        context = retriever.format_context(top_chunks)
-
-        players = load_game_state()
-        payload = [asdict(p) for p in players]
-        compact = json.dumps(payload, separators=(",",":"))
 
-        user_parser_res = user_parser(client, user_input)
-        if user_parser_res:
-            context += f"\n\nPlayer rolled a {user_parser_res}.\n"
+    # prompt and continuation perplexities are written to perplexity_log.txt in the background
+    perplexity_logger = PerplexityLogger("perplexity_log.txt")
+
+    turn_runner = TurnRunner(
+        client,
+        AsyncOpenAI(),
+        retriever,
+        model_choice,
+        model=model if model_choice in (1, 2) else None,
+        tokenizer=tokenizer if model_choice in (1, 2) else None,
+        perplexity_logger=perplexity_logger,
+        draft_model=draft_model,
+        top_k=TOP_K,
+        alpha=ALPHA,
+    )
 
-        # if prev_message:
-        #     context += f"\n\n{prev_message}\n"
-        #     prev_message = None
-
-        # prompt = (
-        #     f"You are the DM. Use the context and game state to generate new, good, relevant narration. Remember that you are the DM, and everything you say will be relayed to the players. If there any new characters (other than the players), you must introduce them in the narration. Ensure the narration has a logical flow.\n\n"
-        #     f"Context: {context}\n"
-        #     f"Game state: {compact}\n"
-        #     f"Player: {user_input}\n"
-        #     f"DM: "
-        # )   
-        prompt = (
-            f"Context: {context}\n"
-            f"Game state: {compact}\n"
-            f"Player: {user_input}\n"
-            f"Respond to player's input using the context and game state. Create a single next narration that is concise.\n"
-            f"DM: "
-        )   
+    async def game_loop(prev_message):
+        while True:
+            # input() runs in a thread, so the previous turn's state parser keeps running while the players type
+            user_input = await asyncio.to_thread(input, "Enter your response: ")
+            if user_input.lower() == "exit":
+                break
+            if user_input.lower() == "undo":
+                # rolls the game state back to the end of the previous turn (see game_state_journal.py)
+                await turn_runner.wait_for_pending()
+                print(f"Game state restored to the end of turn {undo_turn()}.")
+                continue
 
-        if model_choice == 1 or model_choice == 2:
-            answer = generate_model_response(prompt, model, tokenizer, model_choice)
+            prev_message = await turn_runner.run_turn(user_input, prev_message)
 
-        else:
-            completion = client.chat.completions.create(
-                model="gpt-4.1-nano",
-                messages=[
-                    {
-                        "role": "developer",
-                        "content": 
-                            f"""You are the dungeon master for a D&D game. Here's the context: {context} \n\n
-                                Respond to the player's input as the DM. 
-                                Keep your responses extremely concise, and only include the relevant information. 
-                                Do not include any additional information.
-                                If the player describes an action, respond with whether it is successful or not, and provide any relevant details of what happened as a result of the action.
-                                Remember that you must narrate the game as the DM, and not just respond to the player's input.
-                                You must give the player information about the game world, and not just respond to their input.
-                                If the player asks a question, respond with the answer as the DM.
-                                Try to keep your responses relevant to the context provided.
-                            """
-                    },
-                    {
-                        "role": "user",
-                        "content": user_input
-                    }
-                ]
-            )
-
-            answer = completion.choices[0].message.content
+        # the last narration's game state changes still have to be applied
+        await turn_runner.wait_for_pending()
 
-        print("DM: ", answer)
-        prev_message = answer
+    asyncio.run(game_loop(prev_message))
 
-        parser(client, answer)
+    print(f"Dice detection answered locally for {dice_stats['local']} of {dice_stats['local'] + dice_stats['remote']} turns ({local_dice_fraction():.0%}).")
+    print(f"State-change gate skipped the parser for {gate_stats['skipped']} of {gate_stats['checked']} narrations.")
+    queue_stats = turn_runner.state_queue.stats(turn_runner.campaign_id)[turn_runner.campaign_id]
+    if queue_stats["mean_apply_seconds"] is not None:
+        print(f"Game state updates applied in the background: {queue_stats['applied']} (mean {queue_stats['mean_apply_seconds']:.2f}s).")
 
-        if model_choice == 1 or model_choice == 2:
-            perplexity = calculate_perplexity(prompt, model, tokenizer)
-            with open("perplexity_log.txt", "a") as f:
-                f.write(f"Prompt: {prompt}\n")
-                f.write(f"Perplexity: {perplexity:.2f}\n\n")
+    # make sure the last turns made it into perplexity_log.txt before we exit
+    perplexity_logger.close()
 
     if generate_synthetic_flag:
         QUERY_GT_PAIRS = [
@@ -0,0 +1,117 @@
+"""
+WHAT:
+
+Assisted generation (speculative decoding) for the fine-tuned gpt2-medium DM model.
+A small draft model (distilgpt2 fine-tuned on the same dnd_corpus.txt, see embedding_n_llm_fine_tuning.py) proposes a few tokens,
+and the big model checks all of them in a single forward pass, keeping the ones it agrees with.
+
+Running this file replays the logged turns (replay_turns.jsonl, written by the pipeline main loop) with and without the draft model
+and prints the draft acceptance rate and the wall-clock speedup.
+
+WHY
+
+gpt2-medium is slow per token on CPU, but most DM narration is easy to predict.
+When the draft model guesses right, we get several tokens for the price of one big-model forward pass.
+The draft shares the GPT-2 tokenizer, which HF assisted generation requires.
+"""
+
+import json
+import os
+from contextlib import contextmanager
+
+import torch
+from transformers import GPT2LMHeadModel
+
+DRAFT_MODEL_PATH = os.getenv("DMRAG_DRAFT_MODEL_PATH", "distilgpt2_dnd_draft")
+# speculative decoding is switched on by setting DMRAG_SPECULATIVE_DECODING=1
+USE_SPECULATIVE_DECODING = os.getenv("DMRAG_SPECULATIVE_DECODING", "0") == "1"
+REPLAY_TURNS_PATH = "replay_turns.jsonl"
+
+
+def load_draft_model(path: str = DRAFT_MODEL_PATH, device=None):
+    draft_model = GPT2LMHeadModel.from_pretrained(path)
+    if device is not None:
+        draft_model = draft_model.to(device)
+    return draft_model.eval()
+
+
+def load_replay_prompts(path: str = REPLAY_TURNS_PATH, limit: int = None) -> list[str]:
+    # every line is {"prompt": ...}, as appended by the pipeline main loop
+    if not os.path.exists(path):
+        return []
+    with open(path, "r", encoding="utf-8") as f:
+        prompts = [json.loads(line)["prompt"] for line in f if line.strip()]
+    return prompts[:limit] if limit else prompts
+
+
+@contextmanager
+def count_forward_calls(model):
+    # counts the forward passes of a model while the context is open, yields a dict that holds the count
+    counter = {"calls": 0}
+
+    def hook(module, args, output):
+        counter["calls"] += 1
+
+    handle = model.register_forward_hook(hook)
+    try:
+        yield counter
+    finally:
+        handle.remove()
+
+
+def speculative_stats(model, draft_model, tokenizer, prompts: list[str], max_new_tokens: int = 80) -> dict:
+    # every verification step of the big model keeps the accepted draft tokens plus one token of its own,
+    # so accepted drafts = new tokens - big model passes, and the draft model does one pass per proposed token
+    # (the numbers are estimates, e.g. the last step can be cut short by max_new_tokens)
+    new_tokens = 0
+    with count_forward_calls(model) as target_calls, count_forward_calls(draft_model) as draft_calls:
+        for prompt in prompts:
+            enc = tokenizer(prompt, return_tensors="pt").to(model.device)
+            with torch.no_grad():
+                out = model.generate(
+                    **enc,
+                    assistant_model=draft_model,
+                    max_new_tokens=max_new_tokens,
+                    do_sample=True,
+                    top_p=0.4,
+                    pad_token_id=tokenizer.eos_token_id,
+                )
+            new_tokens += out.shape[1] - enc["input_ids"].shape[1]
+
+    accepted = max(new_tokens - target_calls["calls"], 0)
+    return {
+        "new_tokens": new_tokens,
+        "target_forward_calls": target_calls["calls"],
+        "draft_forward_calls": draft_calls["calls"],
+        "acceptance_rate": accepted / max(draft_calls["calls"], 1),
+        "tokens_per_target_call": new_tokens / max(target_calls["calls"], 1),
+    }
+
+
+if __name__ == "__main__":
+    from transformers import GPT2Tokenizer
+    from generation_benchmarks import BENCHMARK_PROMPTS, tokens_per_second
+
+    MODEL_PATH = "gpt2_dnd_finetuned/gpt2_dnd_finetuned"
+    NUM_REPLAY_TURNS = 20
+
+    device = "cuda" if torch.cuda.is_available() else "cpu"
+    tokenizer = GPT2Tokenizer.from_pretrained(MODEL_PATH)
+    model = GPT2LMHeadModel.from_pretrained(MODEL_PATH).to(device).eval()
+    draft_model = load_draft_model(DRAFT_MODEL_PATH, device)
+
+    prompts = load_replay_prompts(REPLAY_TURNS_PATH, NUM_REPLAY_TURNS)
+    if not prompts:
+        print(f"No replayed turns found in {REPLAY_TURNS_PATH}, using the built-in benchmark prompts.")
+        prompts = BENCHMARK_PROMPTS
+
+    baseline_tps = tokens_per_second(model, tokenizer, prompts)
+    assisted_tps = tokens_per_second(model, tokenizer, prompts, assistant_model=draft_model)
+    stats = speculative_stats(model, draft_model, tokenizer, prompts)
+
+    print(f"turns replayed:          {len(prompts)}")
+    print(f"baseline tokens/s:       {baseline_tps:.1f}")
+    print(f"assisted tokens/s:       {assisted_tps:.1f}")
+    print(f"wall-clock speedup:      {assisted_tps / baseline_tps:.2f}x")
+    print(f"draft acceptance rate:   {stats['acceptance_rate']:.2%}")
+    print(f"tokens per target pass:  {stats['tokens_per_target_call']:.2f}")
@@ -1,8 +1,30 @@
 from typing import Dict, Any, List, Optional
+from collections import OrderedDict
 from datetime import datetime
+import os
+import threading
 from supabase import Client
+from .executors import async_variant
+from .game_state_history import (
+    COMPACT_EVERY,
+    KEYFRAME,
+    compact_history,
+    encode_entry,
+    encode_history,
+    reconstruct
+)
+from .projection import CAMPAIGN_COLUMNS, CAMPAIGN_FIELDS, CAMPAIGN_SUMMARY_FIELDS, MAX_PAGE_SIZE, paginate, select_fields
+
+# How many campaigns keep their latest game state in memory
+LATEST_GAME_STATE_CACHE_SIZE = int(os.getenv("DMRAG_LATEST_GAME_STATE_CACHE_SIZE", "256"))
 
 class CampaignService:
+    # (turn, state) of the last game state update per campaign, so an update doesn't have to rebuild it to diff against,
+    # for the LATEST_GAME_STATE_CACHE_SIZE most recently updated campaigns.
+    # Shared by all instances, the API creates a service per request
+    _latest_game_states: "OrderedDict[str, tuple]" = OrderedDict()
+    _latest_game_states_lock = threading.Lock()
+
     def __init__(self, supabase_client: Client):
         self.supabase = supabase_client
     
@@ -21,18 +43,29 @@ class CampaignService:
             # Initialize game state history with provided data or empty array
             game_state_history = campaign_data.get("game_state_history", [])
             
+            # Chat messages and game states live in their own tables (ChatMessages, GameStateHistory),
+            # the campaign row keeps empty arrays
             data_to_insert = {
                 "owner_id": user_id,
                 **campaign_data,
-                "chat_history": chat_history,
-                "game_state_history": game_state_history
+                "chat_history": [],
+                "game_state_history": []
             }
             
             response = self.supabase.table('Campaigns').insert(data_to_insert).execute()
+            campaign = response.data[0] if response.data else None
+
+            if campaign and chat_history:
+                self._insert_chat_messages(campaign["id"], chat_history, user_id)
+                campaign["chat_history"] = chat_history
+
+            if campaign and game_state_history:
+                self._insert_game_states(campaign["id"], game_state_history, user_id)
+                campaign["game_state_history"] = game_state_history
             
             return {
                 "success": True,
-                "data": response.data[0] if response.data else None,
+                "data": campaign,
                 "message": "Campaign created successfully"
             }
         except Exception as e:
@@ -42,10 +75,21 @@ class CampaignService:
                 "data": None
             }
     
-    def get_campaign(self, campaign_id: str, user_id: str) -> Dict:
-        """Get a specific campaign by ID"""
+    def get_campaign(
+        self,
+        campaign_id: str,
+        user_id: str,
+        include_chat: bool = True,
+        fields=CAMPAIGN_FIELDS,
+        chat_limit: int = 50
+    ) -> Dict:
+        """
+        Get a specific campaign by ID, only the given fields (all but the history columns by default).
+        Unless include_chat is False, its latest chat_limit messages are loaded as chat_history (oldest first),
+        with chat_before_seq and chat_has_more to page back through the older ones with get_chat_messages.
+        """
         try:
-            response = self.supabase.table('Campaigns').select('*').eq('id', campaign_id).eq('owner_id', user_id).execute()
+            response = self.supabase.table('Campaigns').select(select_fields(fields, CAMPAIGN_COLUMNS)).eq('id', campaign_id).eq('owner_id', user_id).execute()
             
             if not response.data:
                 return {
@@ -53,10 +97,20 @@ class CampaignService:
                     "error": "Campaign not found or access denied",
                     "data": None
                 }
+
+            campaign = response.data[0]
+            if include_chat:
+                # only the latest page, a long campaign has more messages than PostgREST returns in one response
+                page = self.get_chat_messages(campaign_id, user_id, chat_limit)
+                if not page["success"]:
+                    return page
+                campaign["chat_history"] = [row["message"] for row in page["data"]["messages"]]
+                campaign["chat_before_seq"] = page["data"]["before_seq"]
+                campaign["chat_has_more"] = page["data"]["has_more"]
             
             return {
                 "success": True,
-                "data": response.data[0],
+                "data": campaign,
                 "message": "Campaign retrieved successfully"
             }
         except Exception as e:
@@ -70,7 +124,7 @@ class CampaignService:
         """Update a campaign"""
         try:
             # First verify the campaign exists and belongs to the user
-            existing_response = self.supabase.table('Campaigns').select('*').eq('id', campaign_id).eq('owner_id', user_id).execute()
+            existing_response = self.supabase.table('Campaigns').select('id').eq('id', campaign_id).eq('owner_id', user_id).execute()
             
             if not existing_response.data:
                 return {
@@ -81,6 +135,18 @@ class CampaignService:
             
             # Remove fields that shouldn't be updated
             safe_updates = {k: v for k, v in updates.items() if k not in ['id', 'owner_id', 'created_at', 'campaign_title']}
+
+            # A full chat_history replaces the campaign's chat messages
+            if "chat_history" in safe_updates:
+                self.supabase.table('ChatMessages').delete().eq('campaign_id', campaign_id).eq('owner_id', user_id).execute()
+                self._insert_chat_messages(campaign_id, safe_updates["chat_history"], user_id)
+                safe_updates["chat_history"] = []
+
+            # Same for a full game_state_history
+            if "game_state_history" in safe_updates:
+                self.supabase.table('GameStateHistory').delete().eq('campaign_id', campaign_id).eq('owner_id', user_id).execute()
+                self._insert_game_states(campaign_id, safe_updates["game_state_history"], user_id)
+                safe_updates["game_state_history"] = []
             
             if not safe_updates:
                 return {
@@ -111,15 +177,42 @@ class CampaignService:
                 "data": None
             }
     
-    def get_user_campaigns(self, user_id: str) -> Dict:
-        """Get all campaigns for a user"""
+    def get_user_campaigns(
+        self,
+        user_id: str,
+        fields=CAMPAIGN_FIELDS,
+        limit: Optional[int] = None,
+        offset: int = 0,
+        include_first_state: bool = True
+    ) -> Dict:
+        """Get a user's campaigns (oldest first), only the given fields, optionally one page of them"""
         try:
-            response = self.supabase.table('Campaigns').select('*').eq('owner_id', user_id).execute()
+            # The message and update counts come from ChatMessages and GameStateHistory
+            # (embedded counts, not the rows themselves)
+            select = select_fields(fields, CAMPAIGN_COLUMNS) + ', ChatMessages(count), GameStateHistory(count)'
+            query = self.supabase.table('Campaigns').select(select).eq('owner_id', user_id).order('created_at')
+            response = paginate(query, limit, offset).execute()
+
+            # Only the first game state (the starting party) is sent along, one query for all campaigns
+            first_states = {}
+            if response.data and include_first_state:
+                first_response = self.supabase.table('GameStateHistory').select('campaign_id, state').in_('campaign_id', [c["id"] for c in response.data]).eq('turn', 1).execute()
+                first_states = {row["campaign_id"]: row["state"] for row in first_response.data}
+
+            campaigns = []
+            for campaign in response.data:
+                counts = campaign.pop("ChatMessages", None) or [{"count": 0}]
+                campaign["chat_message_count"] = counts[0]["count"]
+                counts = campaign.pop("GameStateHistory", None) or [{"count": 0}]
+                campaign["game_state_update_count"] = counts[0]["count"]
+                if include_first_state:
+                    campaign["game_state_history"] = [first_states[campaign["id"]]] if campaign["id"] in first_states else []
+                campaigns.append(campaign)
             
             return {
                 "success": True,
-                "data": response.data,
-                "message": f"Found {len(response.data)} campaigns"
+                "data": campaigns,
+                "message": f"Found {len(campaigns)} campaigns"
             }
         except Exception as e:
             return {
@@ -128,11 +221,15 @@ class CampaignService:
                 "data": None
             }
     
+    def get_user_campaign_summaries(self, user_id: str, limit: int = 20, offset: int = 0) -> Dict:
+        """One page of a user's campaigns for a listing: titles and counts, no history"""
+        return self.get_user_campaigns(user_id, CAMPAIGN_SUMMARY_FIELDS, limit, offset, include_first_state=False)
+
     def delete_campaign(self, campaign_id: str, user_id: str) -> Dict:
         """Delete a campaign"""
         try:
             # First verify the campaign exists and belongs to the user
-            existing_response = self.supabase.table('Campaigns').select('*').eq('id', campaign_id).eq('owner_id', user_id).execute()
+            existing_response = self.supabase.table('Campaigns').select('id, campaign_title').eq('id', campaign_id).eq('owner_id', user_id).execute()
             
             if not existing_response.data:
                 return {
@@ -159,34 +256,304 @@ class CampaignService:
             }
 
     # Campaign specific methods
+    def _insert_chat_messages(self, campaign_id: str, messages: List[Dict[str, Any]], user_id: str):
+        """Insert messages in order with one bulk insert"""
+        if messages:
+            rows = [{"campaign_id": campaign_id, "owner_id": user_id, "message": message} for message in messages]
+            self.supabase.table('ChatMessages').insert(rows).execute()
+
     def add_chat_message(self, campaign_id: str, message: Dict[str, Any], user_id: str) -> Dict:
-        """Add a message to campaign's chat history"""
-        campaign_response = self.get_campaign(campaign_id, user_id)
-        if not campaign_response["success"]:
-            return campaign_response
-        
-        campaign_data = campaign_response["data"]
-        current_chat = campaign_data.get("chat_history", []) or []
-        new_chat = current_chat + [message]
-        
-        return self.update_campaign(campaign_id, {"chat_history": new_chat}, user_id)
+        """Append a message to campaign's chat (a single insert, only into a campaign of the signed-in user)"""
+        try:
+            response = self.supabase.rpc('append_chat_message', {
+                "p_campaign_id": campaign_id,
+                "p_message": message
+            }).execute()
+
+            if not response.data:
+                return {
+                    "success": False,
+                    "error": "Campaign not found or access denied",
+                    "data": None
+                }
+
+            return {
+                "success": True,
+                "data": response.data[0],
+                "message": "Chat message added successfully"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "data": None
+            }
+
+    def get_chat_messages(
+        self,
+        campaign_id: str,
+        user_id: str,
+        limit: int = 50,
+        before_seq: Optional[int] = None,
+        after_seq: Optional[int] = None
+    ) -> Dict:
+        """
+        Get one page of a campaign's chat messages, oldest first.
+        Without a cursor this is the latest page. before_seq pages back through older messages,
+        after_seq returns the messages newer than the ones the client already has.
+        limit is clamped to 1..MAX_PAGE_SIZE.
+        """
+        try:
+            limit = max(1, min(limit, MAX_PAGE_SIZE))
+            query = self.supabase.table('ChatMessages').select('seq, message, created_at').eq('campaign_id', campaign_id).eq('owner_id', user_id)
+
+            if after_seq is not None:
+                response = query.gt('seq', after_seq).order('seq').limit(limit).execute()
+                messages = response.data
+            else:
+                if before_seq is not None:
+                    query = query.lt('seq', before_seq)
+                response = query.order('seq', desc=True).limit(limit).execute()
+                messages = list(reversed(response.data))
+
+            # an empty page can also mean the campaign isn't the user's (RLS hides its messages),
+            # only then the campaign itself is looked up
+            if not messages:
+                campaign = self.supabase.table('Campaigns').select('id').eq('id', campaign_id).eq('owner_id', user_id).execute()
+                if not campaign.data:
+                    return {
+                        "success": False,
+                        "error": "Campaign not found or access denied",
+                        "data": None
+                    }
+
+            return {
+                "success": True,
+                "data": {
+                    "messages": messages,
+                    # cursors for the next older / newer page
+                    "before_seq": messages[0]["seq"] if messages else before_seq,
+                    "after_seq": messages[-1]["seq"] if messages else after_seq,
+                    "has_more": len(response.data) == limit
+                },
+                "message": f"Found {len(messages)} messages"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "data": None
+            }
     
+    # Game state history (keyframes plus deltas, see game_state_history.py)
+    def _remember_latest_game_state(self, campaign_id: str, latest: tuple):
+        with self._latest_game_states_lock:
+            self._latest_game_states[campaign_id] = latest
+            self._latest_game_states.move_to_end(campaign_id)
+            while len(self._latest_game_states) > LATEST_GAME_STATE_CACHE_SIZE:
+                self._latest_game_states.popitem(last=False)
+
+    def _forget_latest_game_state(self, campaign_id: str):
+        with self._latest_game_states_lock:
+            self._latest_game_states.pop(campaign_id, None)
+
+    def _insert_game_states(self, campaign_id: str, game_states: List[Dict[str, Any]], user_id: str):
+        """Insert full game states as turns 1..n with one bulk insert"""
+        self._forget_latest_game_state(campaign_id)
+        if game_states:
+            rows = [{"campaign_id": campaign_id, "owner_id": user_id, **entry} for entry in encode_history(game_states)]
+            self.supabase.table('GameStateHistory').insert(rows).execute()
+
+    def _game_state_entries(self, campaign_id: str, user_id: str, turn: Optional[int] = None) -> List[Dict]:
+        """The rows needed to rebuild the state at a turn (the latest by default): its keyframe and the deltas after it"""
+        query = self.supabase.table('GameStateHistory').select('turn').eq('campaign_id', campaign_id).eq('owner_id', user_id).eq('kind', KEYFRAME)
+        if turn is not None:
+            query = query.lte('turn', turn)
+        keyframe = query.order('turn', desc=True).limit(1).execute()
+        if not keyframe.data:
+            return []
+
+        query = self.supabase.table('GameStateHistory').select('turn, kind, state').eq('campaign_id', campaign_id).eq('owner_id', user_id).gte('turn', keyframe.data[0]["turn"])
+        if turn is not None:
+            query = query.lte('turn', turn)
+        return query.order('turn').execute().data
+
+    def _latest_game_state(self, campaign_id: str, user_id: str) -> tuple:
+        """(turn, state) of the campaign's last game state update, (0, None) if there is none"""
+        with self._latest_game_states_lock:
+            latest = self._latest_game_states.get(campaign_id)
+        if latest is None:
+            entries = self._game_state_entries(campaign_id, user_id)
+            latest = (entries[-1]["turn"], reconstruct(entries)) if entries else (0, None)
+            self._remember_latest_game_state(campaign_id, latest)
+        return latest
+
     def add_game_state_update(self, campaign_id: str, game_state: Dict[str, Any], user_id: str) -> Dict:
-        """Add a game state update to campaign's game state history"""
-        campaign_response = self.get_campaign(campaign_id, user_id)
-        if not campaign_response["success"]:
-            return campaign_response
-        
-        campaign_data = campaign_response["data"]
-        current_history = campaign_data.get("game_state_history", []) or []
-        new_history = current_history + [game_state]
-        
-        return self.update_campaign(campaign_id, {"game_state_history": new_history}, user_id)
+        """
+        Add a game state update to campaign's game state history.
+        Stored as the next turn, as a delta to the previous state (or a keyframe every KEYFRAME_EVERY turns),
+        so an update writes one small row whatever the length of the history.
+        """
+        try:
+            for attempt in range(2):
+                turn, previous = self._latest_game_state(campaign_id, user_id)
+                entry = encode_entry(turn + 1, game_state, previous)
+                try:
+                    response = self.supabase.rpc('append_game_state_entry', {
+                        "p_campaign_id": campaign_id,
+                        "p_turn": entry["turn"],
+                        "p_kind": entry["kind"],
+                        "p_state": entry["state"]
+                    }).execute()
+                    break
+                except Exception:
+                    # the turn was written by someone else, or the turn before a delta is missing
+                    # (the history was cleared or replaced by another process), rebuild the latest state and try once more
+                    self._forget_latest_game_state(campaign_id)
+                    if attempt:
+                        raise
+
+            if not response.data:
+                return {
+                    "success": False,
+                    "error": "Campaign not found or access denied",
+                    "data": None
+                }
+
+            self._remember_latest_game_state(campaign_id, (entry["turn"], game_state))
+            return {
+                "success": True,
+                "data": {
+                    "turn": entry["turn"],
+                    "kind": entry["kind"],
+                    "compaction_due": entry["turn"] % COMPACT_EVERY == 0
+                },
+                "message": "Game state update added successfully"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "data": None
+            }
+
+    def get_game_state_at(self, campaign_id: str, user_id: str, turn: Optional[int] = None) -> Dict:
+        """Rebuild the game state at a turn (the latest by default) from its keyframe and the deltas after it"""
+        try:
+            entries = self._game_state_entries(campaign_id, user_id, turn)
+            if not entries:
+                return {
+                    "success": False,
+                    "error": "Game state not found",
+                    "data": None
+                }
+
+            return {
+                "success": True,
+                "data": {"turn": entries[-1]["turn"], "game_state": reconstruct(entries)},
+                "message": "Game state retrieved successfully"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "data": None
+            }
+
+    def get_game_state_deltas(self, campaign_id: str, user_id: str, after_turn: int = 0, to_turn: Optional[int] = None, limit: int = 100) -> Dict:
+        """
+        Get the history rows after the turn the client already has, in turn order.
+        A client holding the state of after_turn applies them in order (a keyframe replaces the state).
+        """
+        try:
+            query = self.supabase.table('GameStateHistory').select('turn, kind, state').eq('campaign_id', campaign_id).eq('owner_id', user_id).gt('turn', after_turn)
+            if to_turn is not None:
+                query = query.lte('turn', to_turn)
+            response = query.order('turn').limit(limit).execute()
+
+            return {
+                "success": True,
+                "data": {
+                    "entries": response.data,
+                    "after_turn": response.data[-1]["turn"] if response.data else after_turn,
+                    "has_more": len(response.data) == limit
+                },
+                "message": f"Found {len(response.data)} game state updates"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "data": None
+            }
+
+    def compact_game_state_history(self, campaign_id: str, user_id: str) -> Dict:
+        """
+        Re-encode a campaign's game state history as keyframes plus deltas (runs in the background).
+        Only the rows that change are written, with one upsert.
+        """
+        try:
+            response = self.supabase.table('GameStateHistory').select('turn, kind, state').eq('campaign_id', campaign_id).eq('owner_id', user_id).order('turn').execute()
+            changed = compact_history(response.data)
+            if changed:
+                rows = [{"campaign_id": campaign_id, "owner_id": user_id, **entry} for entry in changed]
+                self.supabase.table('GameStateHistory').upsert(rows, on_conflict='campaign_id,turn').execute()
+
+            return {
+                "success": True,
+                "data": {"turns": len(response.data), "rewritten": len(changed)},
+                "message": f"Compacted {len(changed)} of {len(response.data)} game state updates"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "data": None
+            }
     
     def clear_chat_history(self, campaign_id: str, user_id: str) -> Dict:
         """Clear campaign's chat history"""
-        return self.update_campaign(campaign_id, {"chat_history": []}, user_id)
+        try:
+            self.supabase.table('ChatMessages').delete().eq('campaign_id', campaign_id).eq('owner_id', user_id).execute()
+            return {
+                "success": True,
+                "message": "Chat history cleared successfully"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "data": None
+            }
     
     def clear_game_state_history(self, campaign_id: str, user_id: str) -> Dict:
         """Clear campaign's game state history"""
-        return self.update_campaign(campaign_id, {"game_state_history": []}, user_id) 
\ No newline at end of file
+        try:
+            self.supabase.table('GameStateHistory').delete().eq('campaign_id', campaign_id).eq('owner_id', user_id).execute()
+            self._forget_latest_game_state(campaign_id)
+            return {
+                "success": True,
+                "message": "Game state history cleared successfully"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "data": None
+            }
+
+    # Async variants for the routes, the blocking Supabase requests run on the bounded IO executor (see executors.py)
+    create_campaign_async = async_variant(create_campaign)
+    get_campaign_async = async_variant(get_campaign)
+    update_campaign_async = async_variant(update_campaign)
+    get_user_campaigns_async = async_variant(get_user_campaigns)
+    get_user_campaign_summaries_async = async_variant(get_user_campaign_summaries)
+    delete_campaign_async = async_variant(delete_campaign)
+    add_chat_message_async = async_variant(add_chat_message)
+    get_chat_messages_async = async_variant(get_chat_messages)
+    add_game_state_update_async = async_variant(add_game_state_update)
+    get_game_state_at_async = async_variant(get_game_state_at)
+    get_game_state_deltas_async = async_variant(get_game_state_deltas)
+    compact_game_state_history_async = async_variant(compact_game_state_history)
+    clear_chat_history_async = async_variant(clear_chat_history)
+    clear_game_state_history_async = async_variant(clear_game_state_history)
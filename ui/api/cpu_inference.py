@@ -0,0 +1,57 @@
+import os
+
+import torch
+from torch import nn
+from transformers.pytorch_utils import Conv1D
+
+# CPU inference modes for the fine-tuned GPT-2 models, mirrors codes/cpu_inference.py
+# (run that file for the perplexity parity check and the tokens/sec benchmark of each mode)
+CPU_INFERENCE_MODES = ("eager", "int8", "compiled", "int8_compiled")
+
+CPU_INFERENCE_MODE = os.getenv("DMRAG_CPU_INFERENCE_MODE", "eager")
+TORCH_NUM_THREADS = int(os.getenv("DMRAG_TORCH_NUM_THREADS", "0"))  # 0 keeps the torch default
+TORCH_NUM_INTEROP_THREADS = int(os.getenv("DMRAG_TORCH_NUM_INTEROP_THREADS", "0"))
+
+
+def configure_torch_threads(num_threads: int = TORCH_NUM_THREADS, num_interop_threads: int = TORCH_NUM_INTEROP_THREADS) -> None:
+    """Apply the configured torch intra-op and inter-op thread counts"""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+    if num_interop_threads > 0:
+        try:
+            torch.set_num_interop_threads(num_interop_threads)
+        except RuntimeError:
+            # Torch only allows this before any inter-op parallel work has started
+            print("Could not set the number of inter-op threads, torch already started parallel work.")
+
+
+def _conv1d_to_linear(model: nn.Module) -> nn.Module:
+    """Replace HF Conv1D layers with equivalent nn.Linear layers so quantize_dynamic picks them up"""
+    for name, module in list(model.named_children()):
+        if isinstance(module, Conv1D):
+            in_features, out_features = module.weight.shape
+            linear = nn.Linear(in_features, out_features)
+            linear.weight.data = module.weight.data.t().contiguous()
+            linear.bias.data = module.bias.data
+            setattr(model, name, linear)
+        else:
+            _conv1d_to_linear(module)
+    return model
+
+
+def prepare_cpu_model(model, mode: str = CPU_INFERENCE_MODE):
+    """Prepare a model (in place) for CPU inference in the given mode"""
+    if mode not in CPU_INFERENCE_MODES:
+        raise ValueError(f"Unknown CPU inference mode '{mode}', expected one of {CPU_INFERENCE_MODES}")
+
+    model = model.to("cpu").eval()
+
+    if mode in ("int8", "int8_compiled"):
+        _conv1d_to_linear(model)
+        model = torch.ao.quantization.quantize_dynamic(model, {nn.Linear}, dtype=torch.qint8)
+
+    if mode in ("compiled", "int8_compiled"):
+        # Compile only the forward so the model keeps its HF class and still works with pipeline()
+        model.forward = torch.compile(model.forward, dynamic=True)
+
+    return model
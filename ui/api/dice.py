@@ -0,0 +1,180 @@
+import random
+import re
+from dataclasses import dataclass, field
+from typing import List, Optional
+
+"""
+Local dice-roll detection for player input, mirrors codes/dice.py
+
+Why:
+    Every player input used to go to the OpenAI API (user_parser in game_state_parser.py) only to find out whether a dice_roll(max_value) should happen.
+    That is a network round trip on every single turn, even though most inputs either spell the roll out ("2d6+3", "roll for initiative")
+    or have nothing to do with dice at all.
+
+How:
+    We look for dice expressions (d20, 2d6+3, d%), "six-sided dice" style phrasing, and D&D roll phrases
+    (initiative, saving throws, ability/skill checks, attack rolls) which are all d20 rolls, with advantage/disadvantage.
+    If we find a clear roll we roll it here. If there is nothing dice related in the input we know there is no roll.
+    Only inputs that mention rolls/dice but don't say which dice (e.g. "I roll the barrel", "I check the door") are ambiguous,
+    and those still go to the tool-calling path.
+"""
+
+NUMBER_WORDS = {
+    "a": 1, "an": 1, "one": 1, "two": 2, "three": 3, "four": 4, "five": 5, "six": 6, "seven": 7, "eight": 8,
+    "nine": 9, "ten": 10, "twelve": 12, "twenty": 20, "hundred": 100,
+}
+_NUMBER = r"\d+|" + "|".join(NUMBER_WORDS)
+
+# 2d6+3, d20, 1d8 - 1, d%
+DICE_EXPRESSION = re.compile(r"\b(\d*)d(\d+|%)(?:\s*([+-])\s*(\d+))?(?![\w])", re.IGNORECASE)
+# "two six-sided dice", "a 20 sided die"
+SIDED_DICE = re.compile(
+    rf"(?:\b({_NUMBER})\s+)?\b({_NUMBER})[\s-]*sided\s+(?:die|dice)\b(?:\s*([+-])\s*(\d+))?",
+    re.IGNORECASE,
+)
+SKILLS = (
+    "acrobatics", "animal handling", "arcana", "athletics", "deception", "history", "insight", "intimidation",
+    "investigation", "medicine", "nature", "perception", "performance", "persuasion", "religion",
+    "sleight of hand", "stealth", "survival", "strength", "dexterity", "constitution", "intelligence", "wisdom", "charisma",
+)
+# phrases that always mean a d20 roll in D&D
+D20_PHRASES = re.compile(
+    r"\binitiative\b|\bsaving throw\b|\b(?:ability|skill) check\b|\battack roll\b|\broll to hit\b"
+    rf"|\broll(?:s|ing)?\s+(?:a\s+|an\s+|for\s+)?(?:{'|'.join(SKILLS)})\b"
+    rf"|\b(?:{'|'.join(SKILLS)})\s+(?:check|save|saving throw|roll)\b",
+    re.IGNORECASE,
+)
+# bigger (or sideless) dice are not a roll we make, e.g. "a d0" or "100000000d6"
+MAX_DICE_COUNT = 100
+MAX_DICE_SIDES = 1000
+
+ROLL_VERB = re.compile(r"\broll(?:s|ed|ing)?\b", re.IGNORECASE)
+ADVANTAGE = re.compile(r"\b(dis)?advantage\b", re.IGNORECASE)
+# words that may or may not mean a dice roll, the LLM decides for these
+DICE_HINTS = re.compile(r"\broll(?:s|ed|ing)?\b|\bdice\b|\bdie\b|\bcheck\b|\bthrow\b|\bsave\b", re.IGNORECASE)
+
+
+@dataclass
+class DiceSpec:
+    count: int = 1
+    sides: int = 20
+    modifier: int = 0
+    # "advantage", "disadvantage" or None, only used for single d20 rolls
+    advantage: Optional[str] = None
+
+
+@dataclass
+class DiceResult:
+    total: int
+    rolls: List[int] = field(default_factory=list)
+    spec: Optional[DiceSpec] = None
+
+
+@dataclass
+class DiceParse:
+    # "roll": we know the roll, "no_roll": nothing dice related, "ambiguous": let the LLM decide
+    status: str
+    spec: Optional[DiceSpec] = None
+
+
+def _to_int(token: Optional[str], default: int) -> int:
+    if not token:
+        return default
+    token = token.lower()
+    return int(token) if token.isdigit() else NUMBER_WORDS.get(token, default)
+
+
+def _modifier(sign: Optional[str], value: Optional[str]) -> int:
+    if not sign or not value:
+        return 0
+    return int(value) if sign == "+" else -int(value)
+
+
+def is_valid_spec(spec: DiceSpec) -> bool:
+    return 1 <= spec.count <= MAX_DICE_COUNT and 2 <= spec.sides <= MAX_DICE_SIDES
+
+
+def parse_dice_request(text: str) -> DiceParse:
+    advantage_match = ADVANTAGE.search(text)
+    advantage = None
+    if advantage_match:
+        advantage = "disadvantage" if advantage_match.group(1) else "advantage"
+
+    expression = DICE_EXPRESSION.search(text)
+    if expression:
+        sides = 100 if expression.group(2) == "%" else int(expression.group(2))
+        spec = DiceSpec(
+            count=_to_int(expression.group(1), 1),
+            sides=sides,
+            modifier=_modifier(expression.group(3), expression.group(4)),
+        )
+        if not is_valid_spec(spec):
+            return DiceParse("no_roll")
+        # "I roll a d20" or just "2d6+3" is clear, but "my sword does 1d8 damage" only describes a die
+        if ROLL_VERB.search(text) or D20_PHRASES.search(text) or len(text.split()) <= 4:
+            if spec.count == 1 and spec.sides == 20:
+                spec.advantage = advantage
+            return DiceParse("roll", spec)
+        return DiceParse("ambiguous")
+
+    sided = SIDED_DICE.search(text)
+    if sided and ROLL_VERB.search(text):
+        spec = DiceSpec(
+            count=_to_int(sided.group(1), 1),
+            sides=_to_int(sided.group(2), 20),
+            modifier=_modifier(sided.group(3), sided.group(4)),
+        )
+        if not is_valid_spec(spec):
+            return DiceParse("no_roll")
+        if spec.count == 1 and spec.sides == 20:
+            spec.advantage = advantage
+        return DiceParse("roll", spec)
+
+    if D20_PHRASES.search(text):
+        return DiceParse("roll", DiceSpec(count=1, sides=20, advantage=advantage))
+
+    if advantage and ROLL_VERB.search(text):
+        # "I roll with advantage"
+        return DiceParse("roll", DiceSpec(count=1, sides=20, advantage=advantage))
+
+    if DICE_HINTS.search(text):
+        return DiceParse("ambiguous")
+
+    return DiceParse("no_roll")
+
+
+def roll_dice(spec: DiceSpec) -> DiceResult:
+    if spec.advantage and spec.count == 1:
+        # roll two d20s and keep the higher (advantage) or the lower (disadvantage)
+        rolls = [random.randint(1, spec.sides), random.randint(1, spec.sides)]
+        kept = max(rolls) if spec.advantage == "advantage" else min(rolls)
+        return DiceResult(total=kept + spec.modifier, rolls=rolls, spec=spec)
+
+    rolls = [random.randint(1, spec.sides) for _ in range(max(spec.count, 1))]
+    return DiceResult(total=sum(rolls) + spec.modifier, rolls=rolls, spec=spec)
+
+
+# how many player inputs were answered locally vs. sent to the tool-calling path
+dice_stats = {"local": 0, "remote": 0}
+
+
+def record_remote_dice_call():
+    dice_stats["remote"] += 1
+
+
+def local_dice_fraction() -> float:
+    total = dice_stats["local"] + dice_stats["remote"]
+    return dice_stats["local"] / total if total else 0.0
+
+
+def local_dice_roll(text: str):
+    # returns (handled, result): handled is False if the input is ambiguous and the LLM should decide,
+    # otherwise result is the rolled total, or None if there is no roll in the input
+    parse = parse_dice_request(text)
+    if parse.status == "ambiguous":
+        return False, None
+
+    dice_stats["local"] += 1
+    if parse.status == "no_roll":
+        return True, None
+    return True, roll_dice(parse.spec).total
@@ -0,0 +1,62 @@
+import asyncio
+import functools
+import os
+from concurrent.futures import ThreadPoolExecutor
+
+"""
+This file is used to run the blocking work of the API off the event loop, on bounded executors
+Note: This is not a runnable file, it is used by the services and main.py
+
+Why:
+    The routes are async def, but they called blocking Supabase requests, the retriever search and
+    the GPT-2 generation directly on the event loop. While one user's generation ran, every other request waited.
+
+How:
+    Blocking work is awaited on a thread pool sized for its kind of work:
+        - IO_EXECUTOR: Supabase requests (they wait on the network, so there can be many)
+        - SEARCH_EXECUTOR: retriever initialization and search
+        - GENERATION_EXECUTOR: model generation (CPU bound, a few at a time so they don't fight over the cores)
+    Work beyond a pool's size waits in that pool's queue, the event loop keeps serving the other requests.
+    The services get async variants (name_async) of their methods with async_variant.
+"""
+
+IO_WORKERS = int(os.getenv("DMRAG_IO_WORKERS", "16"))
+SEARCH_WORKERS = int(os.getenv("DMRAG_SEARCH_WORKERS", "2"))
+GENERATION_WORKERS = int(os.getenv("DMRAG_GENERATION_WORKERS", "1"))
+
+IO_EXECUTOR = ThreadPoolExecutor(max_workers=IO_WORKERS, thread_name_prefix="dmrag-io")
+SEARCH_EXECUTOR = ThreadPoolExecutor(max_workers=SEARCH_WORKERS, thread_name_prefix="dmrag-search")
+GENERATION_EXECUTOR = ThreadPoolExecutor(max_workers=GENERATION_WORKERS, thread_name_prefix="dmrag-generate")
+
+
+async def run_in(executor: ThreadPoolExecutor, fn, *args, **kwargs):
+    return await asyncio.get_running_loop().run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+
+async def run_io(fn, *args, **kwargs):
+    return await run_in(IO_EXECUTOR, fn, *args, **kwargs)
+
+
+async def run_search(fn, *args, **kwargs):
+    return await run_in(SEARCH_EXECUTOR, fn, *args, **kwargs)
+
+
+async def run_generation(fn, *args, **kwargs):
+    return await run_in(GENERATION_EXECUTOR, fn, *args, **kwargs)
+
+
+def async_variant(method, executor: ThreadPoolExecutor = IO_EXECUTOR):
+    # an async version of a blocking method, run on the given executor
+    @functools.wraps(method)
+    async def wrapper(self, *args, **kwargs):
+        return await run_in(executor, method, self, *args, **kwargs)
+    wrapper.__name__ = f"{method.__name__}_async"
+    return wrapper
+
+
+def executor_stats() -> dict:
+    # workers and queued tasks per executor
+    return {
+        name: {"workers": executor._max_workers, "queued": executor._work_queue.qsize()}
+        for name, executor in (("io", IO_EXECUTOR), ("search", SEARCH_EXECUTOR), ("generation", GENERATION_EXECUTOR))
+    }
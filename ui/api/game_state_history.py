@@ -0,0 +1,124 @@
+import copy
+import os
+from typing import Any, Dict, List, Optional
+
+"""
+This file is used to store a campaign's game state history as keyframes plus deltas
+Note: This is not a runnable file, it is used by campaign_service.py
+
+Why:
+    add_game_state_update used to append the full game state to the campaign's game_state_history array
+    and write the whole array back, so every update rewrote every earlier state (quadratic over a long campaign),
+    even though a turn usually only changes a few fields (some HP, an item).
+
+How:
+    Every update is one row of the GameStateHistory table, numbered by turn.
+    Every KEYFRAME_EVERY turns the row holds the full state (a keyframe), the other rows only hold the delta
+    to the state of the turn before: a list of ops {"op": "set" | "del" | "trunc", "path": [...], "value": ...}.
+    The state at a turn is its nearest keyframe with the deltas after it applied in order.
+    compact_history re-encodes an existing history this way (e.g. the full states moved over from the old array).
+"""
+
+KEYFRAME_EVERY = int(os.getenv("DMRAG_GAME_STATE_KEYFRAME_EVERY", "20"))
+# a campaign's history is compacted (in the background) every this many turns
+COMPACT_EVERY = int(os.getenv("DMRAG_GAME_STATE_COMPACT_EVERY", "100"))
+
+KEYFRAME = "keyframe"
+DELTA = "delta"
+
+
+def diff_states(old: Any, new: Any, path: Optional[List] = None) -> List[Dict]:
+    # the ops that turn old into new, dicts and lists are diffed field by field
+    path = path or []
+    if isinstance(old, dict) and isinstance(new, dict):
+        ops = []
+        for key, value in new.items():
+            if key not in old:
+                ops.append({"op": "set", "path": path + [key], "value": value})
+            else:
+                ops.extend(diff_states(old[key], value, path + [key]))
+        ops.extend({"op": "del", "path": path + [key]} for key in old if key not in new)
+        return ops
+
+    if isinstance(old, list) and isinstance(new, list):
+        ops = []
+        for i in range(min(len(old), len(new))):
+            ops.extend(diff_states(old[i], new[i], path + [i]))
+        if len(new) < len(old):
+            ops.append({"op": "trunc", "path": path, "value": len(new)})
+        ops.extend({"op": "set", "path": path + [i], "value": new[i]} for i in range(len(old), len(new)))
+        return ops
+
+    if old == new and type(old) == type(new):
+        return []
+    return [{"op": "set", "path": path, "value": new}]
+
+
+def apply_delta(state: Any, ops: List[Dict]) -> Any:
+    # a new state, the given one is not changed
+    state = copy.deepcopy(state)
+    for op in ops:
+        path, value = op["path"], copy.deepcopy(op.get("value"))
+        if op["op"] == "set" and not path:
+            state = value
+            continue
+
+        target = state
+        for key in (path if op["op"] == "trunc" else path[:-1]):
+            target = target[key]
+
+        if op["op"] == "trunc":
+            del target[value:]
+        elif op["op"] == "del":
+            del target[path[-1]]
+        elif isinstance(target, list) and path[-1] == len(target):
+            target.append(value)
+        else:
+            target[path[-1]] = value
+    return state
+
+
+def is_keyframe_turn(turn: int) -> bool:
+    # turns start at 1, turn 1 is always a keyframe
+    return (turn - 1) % KEYFRAME_EVERY == 0
+
+
+def encode_entry(turn: int, state: Dict, previous: Optional[Dict]) -> Dict:
+    # the row stored for one turn, previous is the state of the turn before (None for the first turn)
+    if previous is None or is_keyframe_turn(turn):
+        return {"turn": turn, "kind": KEYFRAME, "state": state}
+    return {"turn": turn, "kind": DELTA, "state": diff_states(previous, state)}
+
+
+def encode_history(states: List[Dict], first_turn: int = 1) -> List[Dict]:
+    entries = []
+    previous = None
+    for turn, state in enumerate(states, start=first_turn):
+        entries.append(encode_entry(turn, state, previous))
+        previous = state
+    return entries
+
+
+def reconstruct(entries: List[Dict], turn: Optional[int] = None) -> Optional[Dict]:
+    # the state at a turn (the last one by default) from rows ordered by turn, starting with a keyframe
+    state = None
+    for entry in entries:
+        if turn is not None and entry["turn"] > turn:
+            break
+        state = entry["state"] if entry["kind"] == KEYFRAME else apply_delta(state, entry["state"])
+    return state
+
+
+def compact_history(entries: List[Dict]) -> List[Dict]:
+    # re-encodes the history with a keyframe every KEYFRAME_EVERY turns, returns only the rows that change
+    # a row that already has the right kind is kept as it is, the state is rebuilt from it so it is correct by definition
+    # (comparing its ops with a fresh diff would depend on key order, and jsonb reorders object keys)
+    changed = []
+    state = None
+    for entry in entries:
+        previous = state
+        state = entry["state"] if entry["kind"] == KEYFRAME else apply_delta(state, entry["state"])
+        compacted = encode_entry(entry["turn"], state, previous)
+        if compacted["kind"] != entry["kind"]:
+            changed.append(compacted)
+    return changed
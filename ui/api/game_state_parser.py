@@ -2,6 +2,8 @@ import json
 from typing import Dict, Any, List, Optional
 from openai import OpenAI
 from .game_state_service import GameStateService
+from .dice import local_dice_roll, record_remote_dice_call
+from .state_change_gate import NARRATION_LOGGING, STATE_GATE_SHADOW, log_narration, may_change_state
 from .schemas import Character, CharacterCreate, CharacterStats, CharacterBackground, CharacterBackstory
 
 # Game state tools for OpenAI function calling
@@ -163,11 +165,16 @@ user_tools = [
     }
 ]
 
-def parser(client: OpenAI, answer: str, game_service: GameStateService, user_id: str):
+def parser(client: OpenAI, answer: str, game_service: GameStateService, user_id: str, use_gate: bool = True):
     """
     Parse the model response to check if any changes to the game state were made.
     Uses OpenAI API function calling to determine what functions to call.
+    Narrations that can't change the game state (see state_change_gate.py) skip the API call.
     """
+    gate_decision = may_change_state(answer) if use_gate else True
+    if not gate_decision and not STATE_GATE_SHADOW:
+        return
+
     completion = client.chat.completions.create(
         model="gpt-4",
         messages=[{"role": "user", "content": answer}],
@@ -175,137 +182,89 @@ def parser(client: OpenAI, answer: str, game_service: GameStateService, user_id:
     )
 
     tool_calls = completion.choices[0].message.tool_calls
+    if use_gate and NARRATION_LOGGING:
+        log_narration(answer, gate_decision, [tool_call.function.name for tool_call in tool_calls or []])
 
     if not tool_calls:
         return
     
+    # All the changes of one completion are grouped by character and applied together
+    # (one apply_character_changes call that updates them on the database), only character creation goes through its own insert
+    mutations = []
     for tool_call in tool_calls:
         function_name = tool_call.function.name
         arguments = json.loads(tool_call.function.arguments)
 
+        if function_name != "create_character":
+            mutations.append({"function": function_name, "arguments": arguments})
+            continue
+
         try:
-            if function_name == "create_character":
-                # Create CharacterCreate object using the schema
-                character_data = CharacterCreate(
-                    name=arguments["name"],
-                    race=arguments["race"],
-                    characterClass=arguments["characterClass"],
-                    level=arguments["level"],
-                    hitPoints=arguments["hitPoints"],
-                    armorClass=arguments["armorClass"],
-                    proficiencyBonus=arguments["proficiencyBonus"],
-                    weapon=arguments.get("weapon"),
-                    items=arguments.get("items", []),
-                    mana=arguments.get("mana"),
-                    status=arguments.get("status"),
-                    stats=CharacterStats(
-                        strength=arguments.get("strength", 10),
-                        dexterity=arguments.get("dexterity", 10),
-                        constitution=arguments.get("constitution", 10),
-                        intelligence=arguments.get("intelligence", 10),
-                        wisdom=arguments.get("wisdom", 10),
-                        charisma=arguments.get("charisma", 10)
-                    ),
-                    background=CharacterBackground(
-                        id="default",
-                        name="Adventurer",
-                        description="A brave adventurer"
-                    ),
-                    backstory=CharacterBackstory(
-                        text=arguments.get("backstory", "An adventurer ready for quests"),
-                        created_at="2024-01-01T00:00:00Z"
-                    )
+            # Create CharacterCreate object using the schema
+            character_data = CharacterCreate(
+                name=arguments["name"],
+                race=arguments["race"],
+                characterClass=arguments["characterClass"],
+                level=arguments["level"],
+                hitPoints=arguments["hitPoints"],
+                armorClass=arguments["armorClass"],
+                proficiencyBonus=arguments["proficiencyBonus"],
+                weapon=arguments.get("weapon"),
+                items=arguments.get("items", []),
+                mana=arguments.get("mana"),
+                status=arguments.get("status"),
+                stats=CharacterStats(
+                    strength=arguments.get("strength", 10),
+                    dexterity=arguments.get("dexterity", 10),
+                    constitution=arguments.get("constitution", 10),
+                    intelligence=arguments.get("intelligence", 10),
+                    wisdom=arguments.get("wisdom", 10),
+                    charisma=arguments.get("charisma", 10)
+                ),
+                background=CharacterBackground(
+                    id="default",
+                    name="Adventurer",
+                    description="A brave adventurer"
+                ),
+                backstory=CharacterBackstory(
+                    text=arguments.get("backstory", "An adventurer ready for quests"),
+                    created_at="2024-01-01T00:00:00Z"
                 )
-                
-                result = game_service.create_character(character_data.dict(), user_id)
-                if result["success"]:
-                    char_data = result["data"]
-                    print(f"Player created: {char_data['name']}, {char_data['characterClass']}, {char_data['race']} with {char_data['hitPoints']} HP")
-                else:
-                    print(f"Failed to create character: {result['error']}")
-                    
-            elif function_name == "damage_player":
-                character_id = arguments["character_id"]
-                amount = arguments["amount"]
-                
-                result = game_service.damage_character(character_id, amount, user_id)
-                if result["success"]:
-                    char_data = result["data"]
-                    print(f"Character {char_data['name']} takes {amount} damage. HP now: {char_data['hitPoints']}")
-                else:
-                    print(f"Failed to damage character: {result['error']}")
-                    
-            elif function_name == "heal_player":
-                character_id = arguments["character_id"]
-                amount = arguments["amount"]
-                
-                result = game_service.heal_character(character_id, amount, user_id)
-                if result["success"]:
-                    char_data = result["data"]
-                    print(f"Character {char_data['name']} heals {amount} HP. HP now: {char_data['hitPoints']}")
-                else:
-                    print(f"Failed to heal character: {result['error']}")
-                    
-            elif function_name == "add_item_to_player":
-                character_id = arguments["character_id"]
-                item = arguments["item"]
-                
-                result = game_service.add_item_to_character(character_id, item, user_id)
-                if result["success"]:
-                    char_data = result["data"]
-                    print(f"Added {item} to {char_data['name']}'s inventory")
-                else:
-                    print(f"Failed to add item: {result['error']}")
-                    
-            elif function_name == "remove_item_from_player":
-                character_id = arguments["character_id"]
-                item = arguments["item"]
-                
-                result = game_service.remove_item_from_character(character_id, item, user_id)
-                if result["success"]:
-                    char_data = result["data"]
-                    print(f"Removed {item} from {char_data['name']}'s inventory")
-                else:
-                    print(f"Failed to remove item: {result['error']}")
-                    
-            elif function_name == "change_weapon_for_player":
-                character_id = arguments["character_id"]
-                weapon = arguments["weapon"]
-                
-                result = game_service.change_character_weapon(character_id, weapon, user_id)
-                if result["success"]:
-                    char_data = result["data"]
-                    print(f"Character {char_data['name']} weapon changed to {weapon}")
-                else:
-                    print(f"Failed to change weapon: {result['error']}")
-                    
-            elif function_name == "restore_mana":
-                character_id = arguments["character_id"]
-                amount = arguments["amount"]
-                
-                result = game_service.restore_character_mana(character_id, amount, user_id)
-                if result["success"]:
-                    char_data = result["data"]
-                    print(f"Character {char_data['name']} restores {amount} mana. Mana now: {char_data.get('mana', 0)}")
-                else:
-                    print(f"Failed to restore mana: {result['error']}")
-                    
-            elif function_name == "drain_mana":
-                character_id = arguments["character_id"]
-                amount = arguments["amount"]
-                
-                result = game_service.drain_character_mana(character_id, amount, user_id)
-                if result["success"]:
-                    char_data = result["data"]
-                    print(f"Character {char_data['name']} loses {amount} mana. Mana now: {char_data.get('mana', 0)}")
-                else:
-                    print(f"Failed to drain mana: {result['error']}")
-                    
+            )
+            
+            result = game_service.create_character(character_data.dict(), user_id)
+            if result["success"]:
+                char_data = result["data"]
+                print(f"Player created: {char_data['name']}, {char_data['characterClass']}, {char_data['race']} with {char_data['hitPoints']} HP")
+            else:
+                print(f"Failed to create character: {result['error']}")
         except Exception as e:
             print(f"Error executing {function_name}: {e}")
 
+    if not mutations:
+        return
+
+    result = game_service.apply_mutations(mutations, user_id)
+    if not result["success"]:
+        print(f"Failed to apply game state changes: {result['error']}")
+        return
+
+    characters = result["data"]["characters"]
+    for mutation, outcome in zip(mutations, result["data"]["results"]):
+        if not outcome["success"]:
+            print(f"Failed to apply {mutation['function']}: {outcome['error']}")
+            continue
+        char_data = characters.get(outcome["character_id"], {})
+        print(f"Applied {mutation['function']} to {char_data.get('name', outcome['character_id'])}: {mutation['arguments']}")
+
 def user_parser(client: OpenAI, answer: str) -> Optional[int]:
     """Parse user input for dice rolls"""
+    # Clear cases (2d6+3, roll for initiative, no dice at all) are answered locally without an API call
+    handled, result = local_dice_roll(answer)
+    if handled:
+        return result
+
+    record_remote_dice_call()
     completion = client.chat.completions.create(
         model="gpt-4",
         messages=[{"role": "user", "content": answer}],
@@ -0,0 +1,71 @@
+import re
+import threading
+from typing import Callable, Dict, Hashable, List, Optional
+
+"""
+This file is used to build the game state part of the prompt, and to cache it between turns
+Note: This is not a runnable file, it is used by main.py
+
+Why:
+    Every turn we used to load the game state, turn every player into a dict and json.dumps the whole list,
+    even though the game state only changes when a narration changes it.
+    For GPT-2 the prompt also has a hard length limit, and a long game state pushes out the retrieved context.
+
+How:
+    The game state has a version that every change bumps. The serialized players (one JSON fragment per player)
+    are cached per version, so they are only rebuilt after a change.
+    On top of that we can keep only the players mentioned in the player's input, or put those first and
+    fill up a token budget with the rest of the party.
+"""
+
+
+class SerializedStateCache:
+    # entries built for one version of the game state, everything is dropped when the version changes
+    # the API uses it from several generation threads, so the check and the build are done under a lock
+    # (a second request for the same entry waits for the first build instead of repeating it)
+    def __init__(self):
+        self._version = None
+        self._entries: Dict[Hashable, object] = {}
+        self._lock = threading.Lock()
+
+    def get(self, version, key: Hashable, build: Callable[[], object]):
+        with self._lock:
+            if version != self._version:
+                self._entries = {}
+                self._version = version
+            if key not in self._entries:
+                self._entries[key] = build()
+            return self._entries[key]
+
+
+def mentioned_names(names: List[str], text: str) -> List[str]:
+    # the players whose name appears (as a whole word) in the text
+    if not text:
+        return []
+    return [name for name in names if name and re.search(rf"\b{re.escape(name)}\b", text, re.IGNORECASE)]
+
+
+def join_fragments(fragments: List[str]) -> str:
+    return "[" + ",".join(fragments) + "]"
+
+
+def fit_to_token_budget(fragments: List[str], count_tokens: Callable[[str], int], max_tokens: int) -> str:
+    # keeps whole players, in order (most relevant first), as long as the JSON stays within max_tokens
+    kept = []
+    used = count_tokens("[]")
+    for fragment in fragments:
+        cost = count_tokens(fragment) + (1 if kept else 0)  # the comma
+        if used + cost > max_tokens:
+            break
+        kept.append(fragment)
+        used += cost
+
+    # token counts of the pieces don't always add up exactly, so we check the joined string
+    while kept and count_tokens(join_fragments(kept)) > max_tokens:
+        kept.pop()
+    return join_fragments(kept)
+
+
+def order_by_mention(names: List[str], text: Optional[str]) -> List[str]:
+    mentioned = mentioned_names(names, text or "")
+    return mentioned + [name for name in names if name not in mentioned]
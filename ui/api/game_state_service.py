@@ -1,9 +1,26 @@
+from collections import defaultdict
 from typing import Dict, Any, List, Optional
 from supabase import Client
+from .executors import async_variant
+from .projection import CHARACTER_COLUMNS, CHARACTER_SUMMARY_FIELDS, paginate, select_fields
 
 class GameStateService:
+    # Bumped whenever a user's characters change through this service, so cached game states can be invalidated.
+    # Shared by all instances, the API creates a service per request
+    _versions: Dict[str, int] = defaultdict(int)
+    # The tool calls apply_mutations accepts, besides change_weapon_for_player
+    STAT_MUTATIONS = {"damage_player", "heal_player", "restore_mana", "drain_mana"}
+    ITEM_MUTATIONS = {"add_item_to_player", "remove_item_from_player"}
+
     def __init__(self, supabase_client: Client):
         self.supabase = supabase_client
+
+    def state_version(self, user_id: str) -> int:
+        """Version of a user's game state, changes after every mutation"""
+        return self._versions[user_id]
+
+    def _bump_version(self, user_id: str):
+        self._versions[user_id] += 1
     
     def create_character(self, character_data: Dict, user_id: str) -> Dict:
         """Create a new character"""
@@ -14,6 +31,7 @@ class GameStateService:
             }
             
             response = self.supabase.table('Characters').insert(data_to_insert).execute()
+            self._bump_version(user_id)
             
             return {
                 "success": True,
@@ -27,10 +45,10 @@ class GameStateService:
                 "data": None
             }
     
-    def get_character(self, character_id: str, user_id: str) -> Dict:
-        """Get a specific character by ID"""
+    def get_character(self, character_id: str, user_id: str, fields=None) -> Dict:
+        """Get a specific character by ID (only the given fields, if any)"""
         try:
-            response = self.supabase.table('Characters').select('*').eq('id', character_id).eq('owner_id', user_id).execute()
+            response = self.supabase.table('Characters').select(select_fields(fields, CHARACTER_COLUMNS)).eq('id', character_id).eq('owner_id', user_id).execute()
             
             if not response.data:
                 return {
@@ -55,7 +73,7 @@ class GameStateService:
         """Update a character"""
         try:
             # First verify the character exists and belongs to the user
-            existing_response = self.supabase.table('Characters').select('*').eq('id', character_id).eq('owner_id', user_id).execute()
+            existing_response = self.supabase.table('Characters').select('id').eq('id', character_id).eq('owner_id', user_id).execute()
             
             if not existing_response.data:
                 return {
@@ -76,6 +94,7 @@ class GameStateService:
             
             # Update the character
             update_response = self.supabase.table('Characters').update(safe_updates).eq('id', character_id).eq('owner_id', user_id).execute()
+            self._bump_version(user_id)
             
             if not update_response.data:
                 return {
@@ -96,10 +115,11 @@ class GameStateService:
                 "data": None
             }
     
-    def get_user_characters(self, user_id: str) -> Dict:
-        """Get all characters for a user"""
+    def get_user_characters(self, user_id: str, fields=None, limit: Optional[int] = None, offset: int = 0) -> Dict:
+        """Get a user's characters (oldest first), only the given fields if any, optionally one page of them"""
         try:
-            response = self.supabase.table('Characters').select('*').eq('owner_id', user_id).execute()
+            query = self.supabase.table('Characters').select(select_fields(fields, CHARACTER_COLUMNS)).eq('owner_id', user_id).order('created_at')
+            response = paginate(query, limit, offset).execute()
             
             return {
                 "success": True,
@@ -113,11 +133,15 @@ class GameStateService:
                 "data": None
             }
     
+    def get_user_character_summaries(self, user_id: str, limit: int = 50, offset: int = 0) -> Dict:
+        """One page of a user's characters for a listing: no stats, background or backstory"""
+        return self.get_user_characters(user_id, CHARACTER_SUMMARY_FIELDS, limit, offset)
+    
     def delete_character(self, character_id: str, user_id: str) -> Dict:
         """Delete a character"""
         try:
             # First verify the character exists and belongs to the user
-            existing_response = self.supabase.table('Characters').select('*').eq('id', character_id).eq('owner_id', user_id).execute()
+            existing_response = self.supabase.table('Characters').select('id, name').eq('id', character_id).eq('owner_id', user_id).execute()
             
             if not existing_response.data:
                 return {
@@ -130,6 +154,7 @@ class GameStateService:
             
             # Delete the character
             self.supabase.table('Characters').delete().eq('id', character_id).eq('owner_id', user_id).execute()
+            self._bump_version(user_id)
             
             return {
                 "success": True,
@@ -144,33 +169,51 @@ class GameStateService:
             }
 
     # Game state specific methods
+    def adjust_character_stats(self, character_id: str, user_id: str, hp_delta: int = 0, mana_delta: int = 0) -> Dict:
+        """
+        Change a character's HP and/or mana by a delta in one atomic update (clamped at 0).
+        Runs the adjust_character_stats Postgres function, so it is a single round trip
+        and concurrent changes to the same character are not lost.
+        """
+        try:
+            response = self.supabase.rpc('adjust_character_stats', {
+                "p_character_id": character_id,
+                "p_owner_id": user_id,
+                "p_hp_delta": hp_delta,
+                "p_mana_delta": mana_delta
+            }).execute()
+            self._bump_version(user_id)
+
+            if not response.data:
+                return {
+                    "success": False,
+                    "error": "Character not found or access denied",
+                    "data": None
+                }
+
+            return {
+                "success": True,
+                "data": response.data[0],
+                "message": "Character updated successfully"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "data": None
+            }
+
     def damage_character(self, character_id: str, amount: int, user_id: str) -> Dict:
         """Damage a character by a certain amount"""
-        char_response = self.get_character(character_id, user_id)
-        if not char_response["success"]:
-            return char_response
-        
-        char_data = char_response["data"]
-        current_hp = char_data["hitPoints"]
-        new_hp = max(0, current_hp - amount)
-        
-        return self.update_character(character_id, {"hitPoints": new_hp}, user_id)
+        return self.adjust_character_stats(character_id, user_id, hp_delta=-amount)
     
     def heal_character(self, character_id: str, amount: int, user_id: str) -> Dict:
         """Heal a character by a certain amount"""
-        char_response = self.get_character(character_id, user_id)
-        if not char_response["success"]:
-            return char_response
-        
-        char_data = char_response["data"]
-        current_hp = char_data["hitPoints"]
-        new_hp = current_hp + amount
-        
-        return self.update_character(character_id, {"hitPoints": new_hp}, user_id)
+        return self.adjust_character_stats(character_id, user_id, hp_delta=amount)
     
     def add_item_to_character(self, character_id: str, item: str, user_id: str) -> Dict:
         """Add an item to character's inventory"""
-        char_response = self.get_character(character_id, user_id)
+        char_response = self.get_character(character_id, user_id, fields=["items"])
         if not char_response["success"]:
             return char_response
         
@@ -182,7 +225,7 @@ class GameStateService:
     
     def remove_item_from_character(self, character_id: str, item: str, user_id: str) -> Dict:
         """Remove an item from character's inventory"""
-        char_response = self.get_character(character_id, user_id)
+        char_response = self.get_character(character_id, user_id, fields=["items"])
         if not char_response["success"]:
             return char_response
         
@@ -198,24 +241,105 @@ class GameStateService:
     
     def restore_character_mana(self, character_id: str, amount: int, user_id: str) -> Dict:
         """Restore character's mana"""
-        char_response = self.get_character(character_id, user_id)
-        if not char_response["success"]:
-            return char_response
-        
-        char_data = char_response["data"]
-        current_mana = char_data.get("mana", 0) or 0
-        new_mana = current_mana + amount
-        
-        return self.update_character(character_id, {"mana": new_mana}, user_id)
+        return self.adjust_character_stats(character_id, user_id, mana_delta=amount)
     
     def drain_character_mana(self, character_id: str, amount: int, user_id: str) -> Dict:
         """Drain character's mana"""
-        char_response = self.get_character(character_id, user_id)
-        if not char_response["success"]:
-            return char_response
-        
-        char_data = char_response["data"]
-        current_mana = char_data.get("mana", 0) or 0
-        new_mana = max(0, current_mana - amount)
-        
-        return self.update_character(character_id, {"mana": new_mana}, user_id) 
\ No newline at end of file
+        return self.adjust_character_stats(character_id, user_id, mana_delta=-amount)
+
+    # Batch of game state changes from one completion
+    def _validate_mutation(self, function_name: str, arguments: Dict) -> Optional[str]:
+        """Return why a mutation can't be applied, or None if it can"""
+        if not arguments.get("character_id"):
+            return "Missing character_id"
+        if function_name in self.STAT_MUTATIONS:
+            amount = arguments.get("amount")
+            if not isinstance(amount, int) or isinstance(amount, bool) or amount < 0:
+                return f"Invalid amount {amount!r}"
+        elif function_name in self.ITEM_MUTATIONS:
+            if not isinstance(arguments.get("item"), str):
+                return "Missing item"
+        elif function_name == "change_weapon_for_player":
+            if not isinstance(arguments.get("weapon"), str):
+                return "Missing weapon"
+        else:
+            return f"Unknown function {function_name}"
+        return None
+
+    def _add_to_change(self, function_name: str, arguments: Dict, change: Dict):
+        """
+        Fold one validated mutation into a character's change for apply_character_changes.
+        HP and mana add up to one delta, items_remove drops every copy of an item before items_add is appended,
+        so a remove also cancels the earlier adds of the same item.
+        """
+        if function_name in ("damage_player", "heal_player"):
+            sign = -1 if function_name == "damage_player" else 1
+            change["hp_delta"] = change.get("hp_delta", 0) + sign * arguments["amount"]
+        elif function_name in ("restore_mana", "drain_mana"):
+            sign = -1 if function_name == "drain_mana" else 1
+            change["mana_delta"] = change.get("mana_delta", 0) + sign * arguments["amount"]
+        elif function_name == "add_item_to_player":
+            change.setdefault("items_add", []).append(arguments["item"])
+        elif function_name == "remove_item_from_player":
+            change["items_add"] = [i for i in change.get("items_add", []) if i != arguments["item"]]
+            if arguments["item"] not in change.setdefault("items_remove", []):
+                change["items_remove"].append(arguments["item"])
+        else:
+            change["weapon"] = arguments["weapon"]
+
+    def apply_mutations(self, mutations: List[Dict], user_id: str) -> Dict:
+        """
+        Apply all game state changes of one completion as one bulk write.
+        Each mutation is {"function": ..., "arguments": {...}}. The mutations are grouped by character and folded
+        into one change per character (HP/mana deltas, items to add and remove, the new weapon), which the
+        apply_character_changes Postgres function applies in a single UPDATE. One round trip per completion,
+        however many tool calls and characters it has.
+        The deltas are applied to the current rows in the database (clamped at 0 like adjust_character_stats),
+        so changes made meanwhile by other campaigns, the routes or the UI are not overwritten.
+        """
+        try:
+            results = []
+            changes: Dict[str, Dict] = {}
+            for mutation in mutations:
+                function_name, arguments = mutation["function"], mutation["arguments"]
+                error = self._validate_mutation(function_name, arguments)
+                if error:
+                    results.append({"function": function_name, "success": False, "error": error})
+                    continue
+
+                character_id = arguments["character_id"]
+                self._add_to_change(function_name, arguments, changes.setdefault(character_id, {"id": character_id}))
+                results.append({"function": function_name, "success": True, "character_id": character_id})
+
+            updated = {}
+            if changes:
+                response = self.supabase.rpc('apply_character_changes', {"p_changes": list(changes.values())}).execute()
+                updated = {row["id"]: row for row in response.data or []}
+                self._bump_version(user_id)
+
+            # the function only returns the user's characters, the changes of any other character were not applied
+            for result in results:
+                if result["success"] and result["character_id"] not in updated:
+                    result.update(success=False, error=f"Character {result.pop('character_id')} not found or access denied")
+
+            return {
+                "success": True,
+                "data": {"results": results, "characters": updated},
+                "message": f"Applied {sum(r['success'] for r in results)} of {len(results)} changes to {len(updated)} characters"
+            }
+        except Exception as e:
+            return {
+                "success": False,
+                "error": str(e),
+                "data": None
+            }
+
+    # Async variants for the routes, the blocking Supabase requests run on the bounded IO executor (see executors.py)
+    create_character_async = async_variant(create_character)
+    get_character_async = async_variant(get_character)
+    update_character_async = async_variant(update_character)
+    get_user_characters_async = async_variant(get_user_characters)
+    get_user_character_summaries_async = async_variant(get_user_character_summaries)
+    delete_character_async = async_variant(delete_character)
+    adjust_character_stats_async = async_variant(adjust_character_stats)
+    apply_mutations_async = async_variant(apply_mutations)
@@ -0,0 +1,85 @@
+import argparse
+import asyncio
+import statistics
+import time
+
+import httpx
+
+"""
+This file is used to check that the API keeps serving light requests while generations run
+Run it against a running API (uvicorn api.main:app from the ui folder):
+    python -m api.load_test --token <access token> [--campaign-id <id>] [--generations 4] [--seconds 30]
+
+It measures the latency of /get_user_characters on its own, then again while --generations clients
+keep calling /generate_response. With the blocking work on the executors (see executors.py),
+the latency during generations should stay close to the baseline instead of growing with the generation time.
+"""
+
+
+def summarize(latencies):
+    if not latencies:
+        return "no requests"
+    ordered = sorted(latencies)
+    p95 = ordered[min(len(ordered) - 1, int(len(ordered) * 0.95))]
+    return (
+        f"n={len(ordered)} p50={statistics.median(ordered) * 1000:.1f}ms "
+        f"p95={p95 * 1000:.1f}ms max={ordered[-1] * 1000:.1f}ms"
+    )
+
+
+async def sample_reads(client, stop_at, interval, latencies):
+    # one /get_user_characters request every interval seconds until stop_at
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        response = await client.get("/get_user_characters")
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+        await asyncio.sleep(max(0.0, interval - (time.perf_counter() - start)))
+
+
+async def generate_until(client, stop_at, campaign_id, latencies):
+    params = {"campaign_id": campaign_id} if campaign_id else None
+    while time.perf_counter() < stop_at:
+        start = time.perf_counter()
+        response = await client.post(
+            "/generate_response", params=params, json={"user_input": "I look around the tavern for anyone suspicious."}
+        )
+        response.raise_for_status()
+        latencies.append(time.perf_counter() - start)
+
+
+async def run(args):
+    headers = {"Authorization": f"Bearer {args.token}"}
+    async with httpx.AsyncClient(base_url=args.base_url, headers=headers, timeout=None) as client:
+        # warm up (auth cache, connections, the retriever and the model)
+        await sample_reads(client, time.perf_counter() + 1, args.interval, [])
+        await generate_until(client, time.perf_counter() + 1, args.campaign_id, [])
+
+        baseline = []
+        await sample_reads(client, time.perf_counter() + args.seconds / 2, args.interval, baseline)
+
+        loaded, generations = [], []
+        stop_at = time.perf_counter() + args.seconds
+        await asyncio.gather(
+            sample_reads(client, stop_at, args.interval, loaded),
+            *(generate_until(client, stop_at, args.campaign_id, generations) for _ in range(args.generations))
+        )
+
+    print(f"/get_user_characters alone:              {summarize(baseline)}")
+    print(f"/get_user_characters during generations: {summarize(loaded)}")
+    print(f"/generate_response ({args.generations} clients):         {summarize(generations)}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Read latency of the API while generations run")
+    parser.add_argument("--base-url", default="http://localhost:8000")
+    parser.add_argument("--token", required=True, help="Supabase access token of a test user")
+    parser.add_argument("--campaign-id", default=None)
+    parser.add_argument("--generations", type=int, default=4, help="concurrent /generate_response clients")
+    parser.add_argument("--seconds", type=float, default=30.0, help="duration of the loaded phase")
+    parser.add_argument("--interval", type=float, default=0.1, help="seconds between /get_user_characters requests")
+    asyncio.run(run(parser.parse_args()))
+
+
+if __name__ == "__main__":
+    main()
@@ -1,29 +1,28 @@
 from fastapi import FastAPI, HTTPException, Depends, status, APIRouter
-from typing import List, Optional, Dict, Any
+from typing import List, Optional, Dict, Any, Tuple
 import uuid
 from datetime import datetime
 import uuid as uuid_module
 import json
-import io
-from supabase import Client
+import os
+import threading
+import time
+from collections import OrderedDict
+from openai import OpenAI
 import uvicorn
-from transformers import pipeline, GPT2Tokenizer, GPT2LMHeadModel
 import torch
 from pathlib import Path
 
 # Determine project root directory relative to this file (ui/api/main.py -> project root is two levels up)
 BASE_DIR = Path(__file__).resolve().parents[2]
 
-# Cache variables to store the loaded model/tokenizer across requests
-_cached_model = None
-_cached_tokenizer = None
-
 from api.middleware import (
     setup_middleware,
     get_current_user, 
     get_user_and_token,
-    get_supabase_client
+    get_request_supabase_client
 )
+from api.supabase_clients import UserSupabaseClient
 from api.schemas import (
     CharacterCreate,
     InitializeRetrieverRequest,
@@ -35,6 +34,13 @@ from api.schemas import (
 from api.game_state_service import GameStateService
 from api.retriever_service import RetrieverService
 from api.campaign_service import CampaignService
+from api.model_pool import ModelPool, DEFAULT_MODEL_NAME
+from api.game_state_parser import parser
+from api.state_update_queue import StateUpdateQueue
+from api.storage_cache import StorageCache
+from api.projection import CAMPAIGN_FIELDS
+from api.executors import executor_stats, run_generation, run_io
+from api.game_state_prompt import SerializedStateCache, fit_to_token_budget, join_fragments, mentioned_names
 
 app = FastAPI(title="AI DM API", version="1.0.0")
 api_router = APIRouter()
@@ -42,50 +48,104 @@ api_router = APIRouter()
 # Setup all middleware
 setup_middleware(app)
 
-# Get supabase client from middleware
-supabase: Client = get_supabase_client()
-
 # Initialize services
-game_service = GameStateService(supabase)
 retriever_service = RetrieverService()
-campaign_service = CampaignService(supabase)
+# Fine-tuned models are loaded lazily by name and evicted (LRU) to stay under the RAM budget
+model_pool = ModelPool()
+# Game state changes in a narration are applied in the background, in turn order per campaign
+state_update_queue = StateUpdateQueue()
+# How long a generation waits for the previous narration's state updates before it uses the current state
+STATE_UPDATE_WAIT_SECONDS = float(os.getenv("DMRAG_STATE_UPDATE_WAIT_SECONDS", "10"))
+openai_client = OpenAI() if os.getenv("OPENAI_API_KEY") else None
+# Storage objects (chunk corpus, campaign details) cached on the local disk
+storage_cache = StorageCache()
+# Formatted game states per user, rebuilt only after a mutation (see get_formatted_game_state),
+# for the GAME_STATE_CACHE_USERS most recently active users
+game_state_caches: "OrderedDict[str, SerializedStateCache]" = OrderedDict()
+game_state_caches_lock = threading.Lock()
+GAME_STATE_CACHE_USERS = int(os.getenv("DMRAG_GAME_STATE_CACHE_USERS", "1000"))
+GAME_STATE_CACHE_SECONDS = int(os.getenv("DMRAG_GAME_STATE_CACHE_SECONDS", "60"))
+GAME_STATE_TOKEN_BUDGET = int(os.getenv("DMRAG_GAME_STATE_TOKEN_BUDGET", "256"))
+
+# The Supabase services are created per request, on a client that carries the request's token
+# (their caches, like the game state versions, are shared between instances)
+def get_game_service(supabase_client = Depends(get_request_supabase_client)) -> GameStateService:
+    return GameStateService(supabase_client)
+
+def get_campaign_service(supabase_client = Depends(get_request_supabase_client)) -> CampaignService:
+    return CampaignService(supabase_client)
+
+def _listing_result(result: Dict) -> Dict:
+    """Listings with an unknown field or an invalid limit/offset are a bad request"""
+    if not result["success"] and result["error"].lower().startswith(("unknown field", "invalid limit", "invalid offset")):
+        raise HTTPException(status_code=400, detail=result["error"])
+    return result
 
 # Character endpoints
 @api_router.get("/get_user_characters")
-async def get_user_characters(user: str = Depends(get_current_user)):
-    """Get all characters for the current user"""
+async def get_user_characters(
+    fields: Optional[str] = None,
+    limit: Optional[int] = None,
+    offset: int = 0,
+    game_service: GameStateService = Depends(get_game_service),
+    user: str = Depends(get_current_user)
+):
+    """Get the characters of the current user (fields: comma separated columns to return, limit/offset: one page)"""
+    user_id = user.id
+    return _listing_result(await game_service.get_user_characters_async(user_id, fields, limit, offset))
+
+@api_router.get("/get_user_character_summaries")
+async def get_user_character_summaries(
+    limit: int = 50,
+    offset: int = 0,
+    game_service: GameStateService = Depends(get_game_service),
+    user: str = Depends(get_current_user)
+):
+    """Get one page of the current user's characters without stats, background or backstory"""
     user_id = user.id
-    return game_service.get_user_characters(user_id)
+    return _listing_result(await game_service.get_user_character_summaries_async(user_id, limit, offset))
 
 @api_router.get("/get_character/{character_id}")
-async def get_character(character_id: str, user: str = Depends(get_current_user)):
+async def get_character(
+    character_id: str,
+    fields: Optional[str] = None,
+    game_service: GameStateService = Depends(get_game_service),
+    user: str = Depends(get_current_user)
+):
     """Get a specific character by ID for the current user"""
     user_id = user.id
-    result = game_service.get_character(character_id, user_id)
+    result = await game_service.get_character_async(character_id, user_id, fields)
     
     if not result["success"]:
         if "not found" in result["error"].lower():
             raise HTTPException(status_code=404, detail=result["error"])
+        elif "unknown field" in result["error"].lower():
+            raise HTTPException(status_code=400, detail=result["error"])
         else:
             raise HTTPException(status_code=500, detail=result["error"])
     
     return result
 
 @api_router.post("/create_character")
-async def create_character(character: CharacterCreate, user: str = Depends(get_current_user)):
+async def create_character(
+    character: CharacterCreate,
+    game_service: GameStateService = Depends(get_game_service),
+    user: str = Depends(get_current_user)
+):
     """Create a new character"""
     user_id = user.id
-    return game_service.create_character(character.dict(), user_id)
+    return await game_service.create_character_async(character.dict(), user_id)
 
 @api_router.put("/update_character/{character_id}")
 async def update_character(
     character_id: str, 
     updates: Dict[str, Any], 
+    game_service: GameStateService = Depends(get_game_service),
     user: str = Depends(get_current_user)
 ):
     """Update a specific character for the current user"""
     user_id = user.id
-    result = game_service.update_character(character_id, updates, user_id)
+    result = await game_service.update_character_async(character_id, updates, user_id)
     
     if not result["success"]:
         if "not found" in result["error"].lower():
@@ -98,10 +158,14 @@ async def update_character(
     return result
 
 @api_router.delete("/delete_character/{character_id}")
-async def delete_character(character_id: str, user: str = Depends(get_current_user)):
+async def delete_character(
+    character_id: str,
+    game_service: GameStateService = Depends(get_game_service),
+    user: str = Depends(get_current_user)
+):
     """Delete a specific character for the current user"""
     user_id = user.id
-    result = game_service.delete_character(character_id, user_id)
+    result = await game_service.delete_character_async(character_id, user_id)
     
     if not result["success"]:
         if "not found" in result["error"].lower():
@@ -113,16 +177,40 @@ async def delete_character(character_id: str, user: str = Depends(get_current_us
 
 # Campaign endpoints
 @api_router.get("/get_user_campaigns")
-async def get_user_campaigns(user: str = Depends(get_current_user)):
-    """Get all campaigns for the current user"""
+async def get_user_campaigns(
+    fields: Optional[str] = None,
+    limit: Optional[int] = None,
+    offset: int = 0,
+    campaign_service: CampaignService = Depends(get_campaign_service),
+    user: str = Depends(get_current_user)
+):
+    """Get the campaigns of the current user (fields: comma separated columns to return, limit/offset: one page)"""
+    user_id = user.id
+    return _listing_result(await campaign_service.get_user_campaigns_async(
+        user_id, fields if fields is not None else CAMPAIGN_FIELDS, limit, offset
+    ))
+
+@api_router.get("/get_user_campaign_summaries")
+async def get_user_campaign_summaries(
+    limit: int = 20,
+    offset: int = 0,
+    campaign_service: CampaignService = Depends(get_campaign_service),
+    user: str = Depends(get_current_user)
+):
+    """Get one page of the current user's campaigns: titles and message/update counts, no history"""
     user_id = user.id
-    return campaign_service.get_user_campaigns(user_id)
+    return _listing_result(await campaign_service.get_user_campaign_summaries_async(user_id, limit, offset))
 
 @api_router.post("/get_campaign")
-async def get_campaign(campaign_id: str, user: str = Depends(get_current_user)):
-    """Get a specific campaign by ID for the current user"""
+async def get_campaign(
+    campaign_id: str,
+    include_chat: bool = True,
+    campaign_service: CampaignService = Depends(get_campaign_service),
+    user: str = Depends(get_current_user)
+):
+    """Get a specific campaign by ID for the current user (its latest chat messages too, unless include_chat is false)"""
     user_id = user.id
-    result = campaign_service.get_campaign(campaign_id, user_id)
+    result = await campaign_service.get_campaign_async(campaign_id, user_id, include_chat)
     
     if not result["success"]:
         if "not found" in result["error"].lower():
@@ -133,22 +221,27 @@ async def get_campaign(campaign_id: str, user: str = Depends(get_current_user)):
     return result
 
 @api_router.post("/create_campaign")
-async def create_campaign(campaign: CampaignCreate, user: str = Depends(get_current_user)):
+async def create_campaign(
+    campaign: CampaignCreate,
+    campaign_service: CampaignService = Depends(get_campaign_service),
+    user: str = Depends(get_current_user)
+):
     """Create a new campaign"""
     user_id = user.id
-    return campaign_service.create_campaign(campaign.dict(), user_id)
+    return await campaign_service.create_campaign_async(campaign.dict(), user_id)
 
 @api_router.put("/update_campaign")
 async def update_campaign(
     campaign_id: str,
     updates: CampaignUpdate,
+    campaign_service: CampaignService = Depends(get_campaign_service),
     user: str = Depends(get_current_user)
 ):
     """Update a specific campaign for the current user"""
     user_id = user.id
     # Only include non-None fields in the update
     update_data = {k: v for k, v in updates.dict().items() if v is not None}
-    result = campaign_service.update_campaign(campaign_id, update_data, user_id)
+    result = await campaign_service.update_campaign_async(campaign_id, update_data, user_id)
     
     if not result["success"]:
         if "not found" in result["error"].lower():
@@ -161,10 +254,14 @@ async def update_campaign(
     return result
 
 @api_router.post("/delete_campaign")
-async def delete_campaign(campaign_id: str, user: str = Depends(get_current_user)):
+async def delete_campaign(
+    campaign_id: str,
+    campaign_service: CampaignService = Depends(get_campaign_service),
+    user: str = Depends(get_current_user)
+):
     """Delete a specific campaign for the current user"""
     user_id = user.id
-    result = campaign_service.delete_campaign(campaign_id, user_id)
+    result = await campaign_service.delete_campaign_async(campaign_id, user_id)
     
     if not result["success"]:
         if "not found" in result["error"].lower():
@@ -178,11 +275,12 @@ async def delete_campaign(campaign_id: str, user: str = Depends(get_current_user
 async def add_chat_message(
     campaign_id: str,
     message: Dict[str, Any],
+    campaign_service: CampaignService = Depends(get_campaign_service),
     user: str = Depends(get_current_user)
 ):
     """Add a message to campaign's chat history"""
     user_id = user.id
-    result = campaign_service.add_chat_message(campaign_id, message, user_id)
+    result = await campaign_service.add_chat_message_async(campaign_id, message, user_id)
     
     if not result["success"]:
         if "not found" in result["error"].lower():
@@ -192,41 +290,112 @@ async def add_chat_message(
     
     return result
 
+@api_router.get("/get_chat_messages")
+async def get_chat_messages(
+    campaign_id: str,
+    limit: int = 50,
+    before_seq: Optional[int] = None,
+    after_seq: Optional[int] = None,
+    campaign_service: CampaignService = Depends(get_campaign_service),
+    user: str = Depends(get_current_user)
+):
+    """Get one page of a campaign's chat messages (latest page by default, before_seq/after_seq to page)"""
+    user_id = user.id
+    result = await campaign_service.get_chat_messages_async(campaign_id, user_id, limit, before_seq, after_seq)
+    
+    if not result["success"]:
+        if "not found" in result["error"].lower():
+            raise HTTPException(status_code=404, detail=result["error"])
+        raise HTTPException(status_code=500, detail=result["error"])
+    
+    return result
+
 @api_router.post("/add_game_state_update")
 async def add_game_state_update(
     campaign_id: str,
     game_state: Dict[str, Any],
+    campaign_service: CampaignService = Depends(get_campaign_service),
     user: str = Depends(get_current_user)
 ):
     """Add a game state update to campaign's history"""
     user_id = user.id
-    result = campaign_service.add_game_state_update(campaign_id, game_state, user_id)
+    result = await campaign_service.add_game_state_update_async(campaign_id, game_state, user_id)
     
     if not result["success"]:
         if "not found" in result["error"].lower():
             raise HTTPException(status_code=404, detail=result["error"])
         else:
             raise HTTPException(status_code=500, detail=result["error"])
+
+    # Every COMPACT_EVERY turns the history is re-encoded in the background, in order with the campaign's other updates
+    if result["data"]["compaction_due"]:
+        state_update_queue.submit(campaign_id, campaign_service.compact_game_state_history, campaign_id, user_id)
     
     return result
 
+@api_router.get("/get_game_state_at")
+async def get_game_state_at(
+    campaign_id: str,
+    turn: Optional[int] = None,
+    campaign_service: CampaignService = Depends(get_campaign_service),
+    user: str = Depends(get_current_user)
+):
+    """Get a campaign's game state at a turn (the latest by default)"""
+    user_id = user.id
+    result = await campaign_service.get_game_state_at_async(campaign_id, user_id, turn)
+    
+    if not result["success"]:
+        if "not found" in result["error"].lower():
+            raise HTTPException(status_code=404, detail=result["error"])
+        else:
+            raise HTTPException(status_code=500, detail=result["error"])
+    
+    return result
+
+@api_router.get("/get_game_state_deltas")
+async def get_game_state_deltas(
+    campaign_id: str,
+    after_turn: int = 0,
+    to_turn: Optional[int] = None,
+    limit: int = 100,
+    campaign_service: CampaignService = Depends(get_campaign_service),
+    user: str = Depends(get_current_user)
+):
+    """Get the game state updates after the turn the client already has (keyframes and deltas)"""
+    user_id = user.id
+    result = await campaign_service.get_game_state_deltas_async(campaign_id, user_id, after_turn, to_turn, limit)
+    
+    if not result["success"]:
+        raise HTTPException(status_code=500, detail=result["error"])
+    
+    return result
+
+@api_router.post("/compact_game_state_history")
+async def compact_game_state_history(
+    campaign_id: str,
+    campaign_service: CampaignService = Depends(get_campaign_service),
+    user: str = Depends(get_current_user)
+):
+    """Queue a re-encoding of a campaign's game state history as keyframes plus deltas"""
+    user_id = user.id
+    campaign_result = await campaign_service.get_campaign_async(campaign_id, user_id, include_chat=False, fields=["id"])
+    if not campaign_result["success"]:
+        raise HTTPException(status_code=404, detail=campaign_result["error"])
+
+    state_update_queue.submit(campaign_id, campaign_service.compact_game_state_history, campaign_id, user_id)
+    return {"success": True, "message": "Game state history compaction queued"}
+
 @api_router.get("/get_campaign_details")
-async def get_campaign_details(auth_data = Depends(get_user_and_token)):
+async def get_campaign_details(
+    supabase_client = Depends(get_request_supabase_client),
+    auth_data = Depends(get_user_and_token)
+):
     """Fetch campaign details from the campaign_details.json file in supabase storage"""
     try:
         user, token = auth_data
         
-        # Set the auth token for storage access
-        supabase.storage._client.headers.update({
-            "Authorization": f"Bearer {token}"
-        })
-        
-        # Download the campaign_details.json file from Supabase Storage
-        response = supabase.storage.from_("jsonl-files").download("campaign_details.json")
-        
-        # Convert bytes to string and parse JSON
-        file_content = response.decode('utf-8')
-        campaign_details = json.loads(file_content)
+        # campaign_details.json from Supabase Storage, through the local disk cache (revalidated after the TTL)
+        campaign_details = await run_io(storage_cache.read_json, supabase_client, "jsonl-files", "campaign_details.json")
         
         return {
             "success": True,
@@ -243,7 +412,7 @@ async def initialize_retriever(
     user: str = Depends(get_current_user)
 ):
     """Initialize the hybrid retriever with chunks"""
-    result = retriever_service.initialize_retriever(
+    result = await retriever_service.initialize_retriever_async(
         request.chunks, 
         request.embedding_model_path
     )
@@ -259,7 +428,7 @@ async def search(
     user: str = Depends(get_current_user)
 ):
     """Perform hybrid search using the initialized retriever"""
-    result = retriever_service.search(
+    result = await retriever_service.search_async(
         request.query, 
         request.top_k, 
         request.alpha
@@ -278,65 +447,107 @@ async def get_retriever_status(user: str = Depends(get_current_user)):
     """Get the current status of the retriever"""
     return retriever_service.get_status()
 
+@api_router.get("/model_pool_status")
+async def get_model_pool_status(user: str = Depends(get_current_user)):
+    """Get the loaded models and adapters, cold load times, adapter switch cost and resident sizes"""
+    return model_pool.get_status()
+
+@api_router.get("/state_update_status")
+async def get_state_update_status(
+    campaign_service: CampaignService = Depends(get_campaign_service),
+    user: str = Depends(get_current_user)
+):
+    """Get the pending game state updates and their apply latency of the user's campaigns"""
+    campaigns_result = await campaign_service.get_user_campaigns_async(user.id, fields=["id"], include_first_state=False)
+    if not campaigns_result["success"]:
+        raise HTTPException(status_code=500, detail=campaigns_result["error"])
+
+    # updates without a campaign are queued under the user's id
+    keys = [user.id] + [campaign["id"] for campaign in campaigns_result["data"]]
+    return {"success": True, "data": state_update_queue.stats(campaign_ids=keys)}
+
+@api_router.get("/executor_status")
+async def get_executor_status(user: str = Depends(get_current_user)):
+    """Get the size and queued work of the IO, search and generation executors"""
+    return {"success": True, "data": executor_stats()}
+
+@api_router.get("/storage_cache_status")
+async def get_storage_cache_status(user: str = Depends(get_current_user)):
+    """Get the hits, revalidations and downloads of the local storage cache"""
+    return {"success": True, "data": storage_cache.stats()}
+
 @api_router.post("/generate_response")
 async def generate_response(
     request: ModelResponseRequest,
     campaign_id: str = None,
+    game_service: GameStateService = Depends(get_game_service),
+    campaign_service: CampaignService = Depends(get_campaign_service),
+    supabase_client = Depends(get_request_supabase_client),
     auth_data = Depends(get_user_and_token)
 ):
     """Generate a response using the fine-tuned GPT-2 model stored in /models"""
     try:
         user, token = auth_data
         
-        # Define the model path relative to project root
-        MODEL_PATH = str(BASE_DIR / "models/gpt2_dnd_finetuned/gpt2_dnd_finetuned")
-
-        # Use simple in-memory cache to avoid reloading the model on every request
-        global _cached_model, _cached_tokenizer
-        if _cached_model is None or _cached_tokenizer is None:
-            _cached_tokenizer = GPT2Tokenizer.from_pretrained(MODEL_PATH)
-            _cached_model = GPT2LMHeadModel.from_pretrained(MODEL_PATH)
-
-            # Ensure padding token exists
-            if _cached_tokenizer.pad_token is None:
-                _cached_tokenizer.pad_token = _cached_tokenizer.eos_token
-
-        # Get campaign filter if provided
+        # Get campaign filter and model choice if provided
         source_filter = None
+        campaign_model_name = None
+        # The state updates are queued per campaign only once the campaign is known to be the user's
+        update_key = user.id
         if campaign_id:
-            campaign_result = campaign_service.get_campaign(campaign_id, user.id)
+            campaign_result = await campaign_service.get_campaign_async(campaign_id, user.id, include_chat=False, fields=["filter_title", "model_name"])
             if campaign_result["success"]:
+                update_key = campaign_id
                 source_filter = campaign_result["data"].get("filter_title")
+                campaign_model_name = campaign_result["data"].get("model_name")
                 print(f"Using source filter: {source_filter}")
 
+        # The request's model wins over the campaign's model, which wins over the default
+        model_name = request.model_name or campaign_model_name or DEFAULT_MODEL_NAME
+        if not model_pool.has_model(model_name):
+            raise HTTPException(status_code=400, detail=f"Unknown model '{model_name}'")
+
         # Initialize retriever if not already done
         retriever_status = retriever_service.get_status()
         if not retriever_status.get("initialized", False):
             print("Retriever not initialized, loading chunks and initializing retriever")
             # Load chunks and initialize retriever
-            chunks = load_all_chunks(
+            chunks = await run_io(
+                load_all_chunks,
                 bucket_name="jsonl-files",
                 file_name="first_200.jsonl",
-                supabase_client=supabase,
-                source_filter=source_filter,
-                user_token=token
+                supabase_client=supabase_client,
+                source_filter=source_filter
             )
 
             # Initialize retriever with loaded chunks
-            init_result = retriever_service.initialize_retriever(chunks)
+            init_result = await retriever_service.initialize_retriever_async(chunks)
 
             print("Retriever initialization result:")
             print(init_result)
 
         # Retrieve relevant context using hybrid search
-        search_result = retriever_service.search(request.user_input, top_k=3, alpha=0.2)
+        search_result = await retriever_service.search_async(request.user_input, top_k=3, alpha=0.2)
 
         context = ""
         if search_result["success"]:
             # Format the retrieved chunks as context
             context = "\n\n".join(chunk["text"] for chunk in search_result["results"])
         
-        response = general_model_response(request.user_input, _cached_model, _cached_tokenizer, context, user.id)
+        # The game state in the prompt has to include the previous narration's changes,
+        # this only blocks if they are still being applied, and at most STATE_UPDATE_WAIT_SECONDS
+        # (so a stuck update can't hold an IO worker and the request forever)
+        if not await run_io(state_update_queue.wait_for, update_key, STATE_UPDATE_WAIT_SECONDS):
+            print(f"State updates of {update_key} still pending, generating with the current game state")
+
+        # Generation runs on the bounded generation executor, the event loop keeps serving other requests
+        response = await run_generation(
+            generate_with_model, model_name, request.user_input, game_service, context, user.id
+        )
+
+        # The narration is returned right away, the state parser runs on the campaign's background worker
+        if response is not None and openai_client is not None:
+            state_update_queue.submit(update_key, parser, openai_client, response, game_service, user.id)
 
         if response is None:
             return {
@@ -349,22 +560,33 @@ async def generate_response(
             "success": True,
             "data": {
                 "response": response,
+                "model_name": model_name,
             }
         }
+    except HTTPException:
+        raise
     except Exception as e:
         raise HTTPException(status_code=500, detail=f"Error generating response: {str(e)}")
 
-def general_model_response(user_input: str, model, tokenizer, context: str = "", user_id: str = "") -> Optional[str]:
+def generate_with_model(model_name: str, user_input: str, game_service: GameStateService, context: str = "", user_id: str = "") -> Optional[str]:
+    """Generate a response with a model of the pool (blocking, run it on the generation executor)"""
+    # Full models and LoRA adapters (on a shared base model) are both served through the pool
+    with model_pool.acquire(model_name) as (model, tokenizer):
+        return general_model_response(user_input, model, tokenizer, game_service, context, user_id)
+
+def general_model_response(
+    user_input: str,
+    model,
+    tokenizer,
+    game_service: GameStateService,
+    context: str = "",
+    user_id: str = ""
+) -> Optional[str]:
     """Generate a response using the specified model and tokenizer"""
-    dm_generator = pipeline(
-        "text-generation",
-        model=model,
-        tokenizer=tokenizer,
-        device=0 if torch.cuda.is_available() else -1,
-    )
-
     # Get current game state
-    game_state = get_formatted_game_state(user_id) if user_id else ""
+    game_state = get_formatted_game_state(
+        game_service, user_id, user_input, tokenizer=tokenizer, max_tokens=GAME_STATE_TOKEN_BUDGET
+    ) if user_id else ""
 
     full_prompt = (
         f"Context: {context}\n"
@@ -377,13 +599,18 @@ def general_model_response(user_input: str, model, tokenizer, context: str = "",
     print("Prompt:")
     print(game_state)
 
-    out = dm_generator(
-        full_prompt,
-        max_new_tokens=80,
-        do_sample=True,
-        top_p=0.4,
-        pad_token_id=tokenizer.eos_token_id,
-    )[0]["generated_text"]
+    # Call generate directly instead of a text-generation pipeline, so PyTorch and ONNX Runtime
+    # models (DMRAG_GENERATION_BACKEND) sample the same way
+    inputs = tokenizer(full_prompt, return_tensors="pt").to(model.device)
+    with torch.no_grad():
+        output_ids = model.generate(
+            **inputs,
+            max_new_tokens=80,
+            do_sample=True,
+            top_p=0.4,
+            pad_token_id=tokenizer.eos_token_id,
+        )[0]
+    out = full_prompt + tokenizer.decode(output_ids[inputs["input_ids"].shape[1]:], skip_special_tokens=True)
 
     # Parse out the DM line since the model tends to ramble and not follow instructions
     lines = out.split('\n')
@@ -409,65 +636,95 @@ def general_model_response(user_input: str, model, tokenizer, context: str = "",
     else:
         return None
 
-def get_formatted_game_state(user_id: str) -> str:
-    """Retrieve and format the current game state for a user"""
+# The columns the game state prompt uses
+PROMPT_CHARACTER_FIELDS = ["name", "race", "characterClass", "level", "hitPoints", "armorClass", "weapon", "items", "mana", "status"]
+
+def _game_state_cache(user_id: str) -> SerializedStateCache:
+    """The user's game state cache, the least recently used one is dropped beyond GAME_STATE_CACHE_USERS"""
+    # generations run on several executor threads
+    with game_state_caches_lock:
+        cache = game_state_caches.get(user_id)
+        if cache is None:
+            cache = game_state_caches[user_id] = SerializedStateCache()
+        game_state_caches.move_to_end(user_id)
+        while len(game_state_caches) > GAME_STATE_CACHE_USERS:
+            game_state_caches.popitem(last=False)
+        return cache
+
+def _character_fragments(game_service: GameStateService, user_id: str) -> Dict[str, Tuple[str, str]]:
+    """
+    Fetch the user's characters and format each one as a compact JSON object,
+    keyed by id (two characters can have the same name) with the name next to it
+    """
+    characters_result = game_service.get_user_characters(user_id, fields=PROMPT_CHARACTER_FIELDS)
+    if not characters_result["success"]:
+        raise RuntimeError(characters_result["error"])
+
+    fragments = {}
+    for char in characters_result["data"] or []:
+        char_info = {
+            "name": char.get("name", "Unknown"),
+            "race": char.get("race", "Unknown"),
+            "class": char.get("characterClass", "Unknown"),
+            "level": char.get("level", 1),
+            "hp": char.get("hitPoints", 0),
+            "ac": char.get("armorClass", 10),
+            "weapon": char.get("weapon", "Fists"),
+            "items": char.get("items", []),
+            "mana": char.get("mana", 0),
+            "status": char.get("status", "Normal")
+        }
+        fragments[char["id"]] = (char_info["name"], json.dumps(char_info, separators=(",", ":")))
+    return fragments
+
+def get_formatted_game_state(
+    game_service: GameStateService,
+    user_id: str,
+    user_input: Optional[str] = None,
+    mentioned_only: bool = False,
+    tokenizer=None,
+    max_tokens: Optional[int] = None
+) -> str:
+    """
+    Retrieve and format the current game state for a user.
+    The formatted characters are cached until a GameStateService mutation bumps the user's version
+    (or GAME_STATE_CACHE_SECONDS pass), so most turns don't query Supabase for the game state at all.
+    mentioned_only keeps only the characters named in user_input, and tokenizer/max_tokens fit
+    the characters (named ones first) into a token budget for the GPT-2 prompt.
+    """
     try:
-        # Get all characters for the user
-        characters_result = game_service.get_user_characters(user_id)
-        
-        if not characters_result["success"] or not characters_result["data"]:
+        version = (game_service.state_version(user_id), int(time.time() // GAME_STATE_CACHE_SECONDS))
+        cache = _game_state_cache(user_id)
+        fragments = cache.get(version, "fragments", lambda: _character_fragments(game_service, user_id))
+
+        if not fragments:
             return "No active characters in the game."
-        
-        characters = characters_result["data"]
-        
-        # Format characters into a compact game state representation
-        game_state_data = []
-        for char in characters:
-            char_info = {
-                "name": char.get("name", "Unknown"),
-                "race": char.get("race", "Unknown"),
-                "class": char.get("characterClass", "Unknown"),
-                "level": char.get("level", 1),
-                "hp": char.get("hitPoints", 0),
-                "ac": char.get("armorClass", 10),
-                "weapon": char.get("weapon", "Fists"),
-                "items": char.get("items", []),
-                "mana": char.get("mana", 0),
-                "status": char.get("status", "Normal")
-            }
-            game_state_data.append(char_info)
-        
-        # Convert to compact JSON string
-        return json.dumps(game_state_data, separators=(",", ":"))
-        
+
+        # every character with a mentioned name, in the order of the characters
+        mentioned = set(mentioned_names(list({name for name, _ in fragments.values()}), user_input))
+        mentioned_ids = [character_id for character_id, (name, _) in fragments.items() if name in mentioned]
+        if mentioned_only:
+            selected = tuple(mentioned_ids or fragments)
+            return cache.get(version, ("characters", selected), lambda: join_fragments([fragments[c][1] for c in selected]))
+
+        if tokenizer is None or max_tokens is None:
+            return cache.get(version, "all", lambda: join_fragments([fragment for _, fragment in fragments.values()]))
+
+        ordered = tuple(mentioned_ids + [character_id for character_id in fragments if character_id not in mentioned_ids])
+        return cache.get(
+            version, ("budget", ordered, max_tokens, id(tokenizer)),
+            lambda: fit_to_token_budget([fragments[c][1] for c in ordered], lambda text: len(tokenizer.encode(text)), max_tokens)
+        )
+
     except Exception as e:
         return f"Error retrieving game state: {str(e)}"
 
-def load_all_chunks(bucket_name: str, file_name: str, supabase_client: Client, source_filter: str = None, user_token: str = None):
+def load_all_chunks(bucket_name: str, file_name: str, supabase_client: UserSupabaseClient, source_filter: str = None):
     all_chunks = []
     
-    # Set the auth token for storage access if provided
-    if user_token:
-        # Set auth headers for storage client
-        supabase_client.storage._client.headers.update({
-            "Authorization": f"Bearer {user_token}"
-        })
-    
-    # Download the file from Supabase Storage
-    response = supabase_client.storage.from_(bucket_name).download(file_name)
-    
-    # Convert bytes to string and create a file-like object
-    file_content = response.decode('utf-8')
-    file_lines = io.StringIO(file_content)
-    
-    # Process each line just like before
-    for line in file_lines:
-        line = line.strip()
-        if not line:  # Skip empty lines
-            continue
-            
-        chunk = json.loads(line)
-
+    # The file comes from the local disk cache of Supabase Storage (downloaded or revalidated only after the TTL),
+    # and is parsed one line at a time
+    for chunk in storage_cache.iter_jsonl(supabase_client, bucket_name, file_name):
         # We always include the rule book chunks
         if chunk.get("genre") == "core_rules" and chunk.get("source_doc") == "rule_book":
             all_chunks.append(chunk)
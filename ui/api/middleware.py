@@ -1,9 +1,16 @@
 from fastapi import FastAPI, HTTPException, Depends, Header
 from fastapi.middleware.cors import CORSMiddleware
 from typing import Optional, Tuple
+from collections import OrderedDict
+from dataclasses import dataclass, field
+import hashlib
 import os
+import time
+import jwt
 from supabase import create_client, Client
 from dotenv import load_dotenv
+from .supabase_clients import SupabaseTransport, UserSupabaseClient
+from .executors import run_io
 
 load_dotenv()
 
@@ -12,6 +19,14 @@ SUPABASE_URL = os.getenv("SUPABASE_URL")
 SUPABASE_KEY = os.getenv("SUPABASE_KEY")
 SUPABASE_JWT_SECRET = os.getenv("SUPABASE_JWT_SECRET")
 supabase: Client = create_client(SUPABASE_URL, SUPABASE_KEY)
+# Requests get their own client (with their own token) on this shared connection pool
+supabase_transport = SupabaseTransport(SUPABASE_URL, SUPABASE_KEY)
+
+# Verified users are cached by token hash for this long (never past the token's expiry)
+AUTH_CACHE_SECONDS = int(os.getenv("DMRAG_AUTH_CACHE_SECONDS", "60"))
+AUTH_CACHE_SIZE = 1024
+# Supabase access tokens are issued for this audience
+JWT_AUDIENCE = "authenticated"
 
 def setup_middleware(app: FastAPI):
     """Setup all middleware for the FastAPI app"""
@@ -31,26 +46,119 @@ def setup_middleware(app: FastAPI):
     
     return app
 
-# Auth dependency
-async def get_current_user(authorization: Optional[str] = Header(None)):
+@dataclass
+class LocalUser:
+    """The user of a locally verified access token (the fields of the token the API uses)"""
+    id: str
+    email: Optional[str] = None
+    role: Optional[str] = None
+    aud: str = JWT_AUDIENCE
+    app_metadata: dict = field(default_factory=dict)
+    user_metadata: dict = field(default_factory=dict)
+
+# sha256(token) -> (expires_at, user), least recently used first
+_user_cache: "OrderedDict[str, Tuple[float, object]]" = OrderedDict()
+
+def _verify_token_locally(token: str) -> Optional[Tuple[LocalUser, float]]:
+    """
+    Check the token's signature, expiry and audience with SUPABASE_JWT_SECRET, None if it can't be verified here.
+    An expired token or a wrong signature is rejected right away, the auth server would only say the same.
+    """
+    if not SUPABASE_JWT_SECRET:
+        return None
+    try:
+        claims = jwt.decode(
+            token,
+            SUPABASE_JWT_SECRET,
+            algorithms=["HS256"],
+            audience=JWT_AUDIENCE,
+            options={"require": ["exp", "sub"]}
+        )
+    except (jwt.ExpiredSignatureError, jwt.InvalidSignatureError):
+        raise HTTPException(status_code=401, detail="Invalid or expired token")
+    except jwt.InvalidTokenError:
+        return None
+
+    user = LocalUser(
+        id=claims["sub"],
+        email=claims.get("email"),
+        role=claims.get("role"),
+        aud=claims["aud"],
+        app_metadata=claims.get("app_metadata") or {},
+        user_metadata=claims.get("user_metadata") or {}
+    )
+    return user, claims["exp"]
+
+def _token_expiry(token: str) -> Optional[float]:
+    """The exp claim of a token, read without verifying it (for tokens the auth server already accepted)"""
+    try:
+        return jwt.decode(token, options={"verify_signature": False}).get("exp")
+    except jwt.InvalidTokenError:
+        return None
+
+async def _authenticate(authorization: Optional[str]) -> Tuple:
+    """
+    The user and token of a Bearer authorization header.
+    Tokens are verified locally (no round trip to the auth server) and the user is cached by token hash,
+    only tokens that can't be verified locally (e.g. no JWT secret configured) are checked remotely.
+    """
     if not authorization or not authorization.startswith("Bearer "):
         raise HTTPException(status_code=401, detail="Missing or invalid authorization header")
     
     token = authorization.split("Bearer ")[1]
-    response = supabase.auth.get_user(token)
-    supabase.postgrest.auth(token)
-    user = response.user
-    return user
+    key = hashlib.sha256(token.encode("utf-8")).hexdigest()
+    now = time.time()
+
+    cached = _user_cache.get(key)
+    if cached and cached[0] > now:
+        _user_cache.move_to_end(key)
+        return cached[1], token
+
+    expires_at = now + AUTH_CACHE_SECONDS
+    try:
+        verified = _verify_token_locally(token)
+    except HTTPException:
+        _user_cache.pop(key, None)
+        raise
+    if verified:
+        user, token_expiry = verified
+        expires_at = min(expires_at, token_expiry)
+    else:
+        try:
+            response = await run_io(supabase.auth.get_user, token)
+        except Exception:
+            response = None
+        if not response or not response.user:
+            _user_cache.pop(key, None)
+            raise HTTPException(status_code=401, detail="Invalid or expired token")
+        user = response.user
+        token_expiry = _token_expiry(token)
+        if token_expiry is not None:
+            expires_at = min(expires_at, token_expiry)
+
+    _user_cache[key] = (expires_at, user)
+    _user_cache.move_to_end(key)
+    while len(_user_cache) > AUTH_CACHE_SIZE:
+        _user_cache.popitem(last=False)
+    return user, token
 
 # Helper function to get both user and token
 async def get_user_and_token(authorization: Optional[str] = Header(None)) -> Tuple:
-    if not authorization or not authorization.startswith("Bearer "):
-        raise HTTPException(status_code=401, detail="Missing or invalid authorization header")
-    
-    token = authorization.split("Bearer ")[1]
-    response = supabase.auth.get_user(token)
-    user = response.user
-    return user, token
+    return await _authenticate(authorization)
+
+# Auth dependency
+async def get_current_user(auth_data = Depends(get_user_and_token)):
+    user, token = auth_data
+    return user
+
+def get_user_supabase_client(token: Optional[str] = None) -> UserSupabaseClient:
+    """A Supabase client (table, rpc, storage) authenticated with the user's token, on the shared connection pool"""
+    return supabase_transport.client(token)
+
+# Per-request client dependency (FastAPI runs get_user_and_token once per request, however many dependencies use it)
+async def get_request_supabase_client(auth_data = Depends(get_user_and_token)) -> UserSupabaseClient:
+    user, token = auth_data
+    return get_user_supabase_client(token)
 
 # Export supabase client for use in other modules
 def get_supabase_client() -> Client:
@@ -0,0 +1,335 @@
+import gc
+import os
+import threading
+import time
+from collections import OrderedDict
+from contextlib import contextmanager
+from pathlib import Path
+from typing import Any, Dict, Iterator, List, Optional, Tuple
+
+import torch
+from transformers import GPT2LMHeadModel, GPT2Tokenizer
+
+from .cpu_inference import CPU_INFERENCE_MODE, configure_torch_threads, prepare_cpu_model
+from .onnx_backend import GENERATION_BACKEND, load_onnx_model, onnx_model_dir
+
+# Determine project root directory relative to this file
+BASE_DIR = Path(__file__).resolve().parents[2]
+
+# Models that can be served, by name. Paths are relative to the project root.
+MODEL_REGISTRY = {
+    "gpt2_dnd_finetuned": str(BASE_DIR / "models/gpt2_dnd_finetuned/gpt2_dnd_finetuned"),
+    "gpt2_crd3_finetuned": str(BASE_DIR / "models/gpt2_crd3_finetuned"),
+}
+DEFAULT_MODEL_NAME = os.getenv("DMRAG_DEFAULT_MODEL", "gpt2_dnd_finetuned")
+
+# LoRA adapters (trained with use_lora in codes/embedding_n_llm_fine_tuning.py), by name.
+# All adapters share one copy of the base model in memory.
+ADAPTER_BASE_MODEL = os.getenv("DMRAG_ADAPTER_BASE_MODEL", "gpt2-medium")
+ADAPTER_REGISTRY = {
+    "gpt2_dnd_lora": str(BASE_DIR / "models/gpt2_dnd_lora"),
+    "gpt2_crd3_lora": str(BASE_DIR / "models/gpt2_crd3_lora"),
+}
+# Key of the shared adapter base model in the pool
+ADAPTER_BASE_KEY = "__adapter_base__"
+
+# RAM budget for all loaded models together, least recently used models are evicted to stay under it
+MODEL_POOL_MAX_BYTES = int(float(os.getenv("DMRAG_MODEL_POOL_MAX_GB", "4")) * 1024 ** 3)
+
+WEIGHT_FILE_SUFFIXES = (".safetensors", ".bin")
+
+
+def _process_rss_bytes() -> int:
+    """Current resident set size of this process (0 if it can't be read)"""
+    try:
+        with open("/proc/self/statm") as f:
+            return int(f.read().split()[1]) * os.sysconf("SC_PAGE_SIZE")
+    except (OSError, ValueError, IndexError):
+        return 0
+
+
+def _weights_bytes(model_path: str) -> int:
+    """Size of the weight files of a model on disk, used as the memory estimate before loading"""
+    path = Path(model_path)
+    if not path.is_dir():
+        return 0
+    return sum(f.stat().st_size for f in path.iterdir() if f.suffix in WEIGHT_FILE_SUFFIXES)
+
+
+class ModelPool:
+    def __init__(self, registry: Dict[str, str] = None, max_bytes: int = MODEL_POOL_MAX_BYTES, adapter_registry: Dict[str, str] = None):
+        self.registry = dict(registry or MODEL_REGISTRY)
+        self.adapter_registry = dict(ADAPTER_REGISTRY if adapter_registry is None else adapter_registry)
+        self.max_bytes = max_bytes
+        self.device = "cuda" if torch.cuda.is_available() else "cpu"
+        # name -> {"model", "tokenizer", "size_bytes", ...}, ordered from least to most recently used
+        self._models: "OrderedDict[str, Dict[str, Any]]" = OrderedDict()
+        # Load statistics are kept after eviction so repeated cold loads stay visible
+        self._load_stats: Dict[str, Dict[str, Any]] = {}
+        self._lock = threading.Lock()
+        # Signalled when a generation releases its model, a load waiting for room can then evict it
+        self._released = threading.Condition(self._lock)
+        # The active adapter is state on the shared base model, so one adapter generation runs at a time
+        self._adapter_lock = threading.Lock()
+        self._loaded_adapters: List[str] = []
+        self._active_adapter: Optional[str] = None
+        self._adapter_switches = 0
+        self._adapter_switch_seconds = 0.0
+        self._last_adapter_switch_seconds = 0.0
+
+        if self.device == "cpu":
+            configure_torch_threads()
+
+    def has_model(self, name: str) -> bool:
+        """Check whether a model or adapter name is known to the pool"""
+        return name in self.registry or name in self.adapter_registry
+
+    def is_adapter(self, name: str) -> bool:
+        """Check whether a name refers to a LoRA adapter on the shared base model"""
+        return name in self.adapter_registry
+
+    def get(self, name: str = None) -> Tuple[Any, Any]:
+        """Return (model, tokenizer) for a full model name, loading it on first use"""
+        name = name or DEFAULT_MODEL_NAME
+        if name not in self.registry:
+            raise KeyError(f"Unknown model '{name}'. Available models: {', '.join(self.registry)}")
+        return self._get_entry(name, self.registry[name], adapter_base=False)
+
+    @contextmanager
+    def acquire(self, name: str = None) -> Iterator[Tuple[Any, Any]]:
+        """
+        Yield (model, tokenizer) for a model or adapter name for the duration of a generation
+
+        The model is pinned until the generation is done, so a concurrent load can't evict it
+        (its weights would stay referenced here and the process would go over the budget).
+        Adapters are switched on the shared base model, so an adapter generation holds the
+        adapter lock until it is done and another request can't switch the adapter underneath it.
+        """
+        name = name or DEFAULT_MODEL_NAME
+        if not self.is_adapter(name):
+            if name not in self.registry:
+                raise KeyError(f"Unknown model '{name}'. Available models: {', '.join(self.registry)}")
+            with self._pinned(name, self.registry[name], adapter_base=False) as (model, tokenizer):
+                yield model, tokenizer
+            return
+
+        with self._adapter_lock:
+            with self._pinned(ADAPTER_BASE_KEY, ADAPTER_BASE_MODEL, adapter_base=True) as (model, tokenizer):
+                self._activate_adapter(model, name)
+                yield model, tokenizer
+
+    def generate_batch(self, prompts: List[str], adapter_names: List[str], **generate_kwargs) -> List[str]:
+        """
+        Generate for a batch of prompts where every prompt can use a different adapter
+
+        Uses PEFT mixed-adapter batches (adapter_names), so the batch runs in one pass without
+        switching the active adapter. This is meant for a batching scheduler that groups requests.
+        """
+        unknown = [name for name in adapter_names if not self.is_adapter(name)]
+        if unknown:
+            raise KeyError(f"Unknown adapters: {', '.join(unknown)}")
+
+        with self._adapter_lock, self._pinned(ADAPTER_BASE_KEY, ADAPTER_BASE_MODEL, adapter_base=True) as (model, tokenizer):
+            for name in set(adapter_names):
+                self._load_adapter(model, name)
+
+            # Decoder-only models need left padding so the new tokens follow each prompt directly.
+            # The tokenizer is shared with acquire(), so its padding side is restored right away
+            padding_side = tokenizer.padding_side
+            tokenizer.padding_side = "left"
+            try:
+                inputs = tokenizer(prompts, return_tensors="pt", padding=True).to(model.device)
+            finally:
+                tokenizer.padding_side = padding_side
+            with torch.no_grad():
+                outputs = model.generate(**inputs, adapter_names=adapter_names, pad_token_id=tokenizer.eos_token_id, **generate_kwargs)
+
+        prompt_length = inputs["input_ids"].shape[1]
+        return [tokenizer.decode(output[prompt_length:], skip_special_tokens=True) for output in outputs]
+
+    def _get_entry(self, name: str, model_path: str, adapter_base: bool) -> Tuple[Any, Any]:
+        entry = self._entry(name, model_path, adapter_base, pin=False)
+        return entry["model"], entry["tokenizer"]
+
+    @contextmanager
+    def _pinned(self, name: str, model_path: str, adapter_base: bool) -> Iterator[Tuple[Any, Any]]:
+        """(model, tokenizer) of a pool entry that can't be evicted until the block is done"""
+        entry = self._entry(name, model_path, adapter_base, pin=True)
+        try:
+            yield entry["model"], entry["tokenizer"]
+        finally:
+            with self._lock:
+                entry["in_use"] -= 1
+                self._released.notify_all()
+
+    def _entry(self, name: str, model_path: str, adapter_base: bool, pin: bool) -> Dict[str, Any]:
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is not None:
+                self._models.move_to_end(name)
+                self._load_stats[name]["hits"] += 1
+            else:
+                size_bytes = _weights_bytes(model_path)
+                # Make room before loading, so two big models are never resident above the budget
+                self._evict_until_fits(size_bytes)
+
+                entry = self._load(name, model_path, adapter_base)
+                entry["size_bytes"] = size_bytes or entry["rss_delta_bytes"]
+                entry["in_use"] = 0
+                self._models[name] = entry
+            if pin:
+                entry["in_use"] += 1
+            return entry
+
+    def _load_adapter(self, model, name: str) -> None:
+        """Load an adapter's weights into the shared base model if they aren't there yet"""
+        if name in self._loaded_adapters:
+            return
+        start = time.perf_counter()
+        model.load_adapter(self.adapter_registry[name], adapter_name=name)
+        self._loaded_adapters.append(name)
+        print(f"Loaded adapter '{name}' in {time.perf_counter() - start:.2f}s")
+
+    def _activate_adapter(self, model, name: str) -> None:
+        """Make an adapter the active one on the shared base model and record the switch cost"""
+        self._load_adapter(model, name)
+        if self._active_adapter == name:
+            return
+        start = time.perf_counter()
+        model.set_adapter(name)
+        elapsed = time.perf_counter() - start
+        self._active_adapter = name
+        self._adapter_switches += 1
+        self._adapter_switch_seconds += elapsed
+        self._last_adapter_switch_seconds = elapsed
+
+    def _load(self, name: str, model_path: str, adapter_base: bool = False) -> Dict[str, Any]:
+        """Load a model and tokenizer and record the cold load time and resident size"""
+        rss_before = _process_rss_bytes()
+        start = time.perf_counter()
+
+        tokenizer = GPT2Tokenizer.from_pretrained(model_path)
+        if tokenizer.pad_token is None:
+            tokenizer.pad_token = tokenizer.eos_token
+
+        if GENERATION_BACKEND == "onnx" and not adapter_base:
+            # Exported decoder-with-past graph, see codes/onnx_backend.py for the export command
+            model = load_onnx_model(onnx_model_dir(model_path))
+        else:
+            # low_cpu_mem_usage skips the randomly initialised copy of the weights, and safetensors
+            # checkpoints are memory-mapped instead of read into a second buffer
+            has_safetensors = any(Path(model_path).glob("*.safetensors"))
+            model = GPT2LMHeadModel.from_pretrained(
+                model_path,
+                low_cpu_mem_usage=True,
+                use_safetensors=True if has_safetensors else None,
+            )
+
+            if adapter_base:
+                # Imported here so peft is only needed when adapters are served
+                from peft import PeftModel
+
+                # The first adapter turns the base model into a PeftModel, the others are added with load_adapter
+                first_adapter = next(iter(self.adapter_registry))
+                model = PeftModel.from_pretrained(model, self.adapter_registry[first_adapter], adapter_name=first_adapter)
+                self._loaded_adapters = [first_adapter]
+                self._active_adapter = first_adapter
+                # int8 / compiled CPU modes rewrite the layers that LoRA wraps, so the adapter base runs eager
+                model = model.to(self.device).eval()
+            elif self.device == "cuda":
+                model = model.to(self.device).eval()
+            else:
+                model = prepare_cpu_model(model, CPU_INFERENCE_MODE)
+
+        load_seconds = time.perf_counter() - start
+        rss_delta = max(_process_rss_bytes() - rss_before, 0)
+
+        stats = self._load_stats.setdefault(name, {"loads": 0, "evictions": 0, "hits": 0})
+        stats["loads"] += 1
+        stats["last_cold_load_seconds"] = round(load_seconds, 3)
+        stats["last_rss_delta_bytes"] = rss_delta
+        print(f"Loaded model '{name}' in {load_seconds:.2f}s (+{rss_delta / 1024 ** 2:.0f} MB RSS)")
+
+        return {
+            "model": model,
+            "tokenizer": tokenizer,
+            "loaded_at": time.time(),
+            "cold_load_seconds": load_seconds,
+            "rss_delta_bytes": rss_delta,
+        }
+
+    def _resident_bytes(self) -> int:
+        return sum(entry["size_bytes"] for entry in self._models.values())
+
+    def _evict_until_fits(self, incoming_bytes: int) -> None:
+        """
+        Evict least recently used models until the incoming model fits in the budget.
+        Models in use by a generation are skipped, if only those are left the load waits until one is released.
+        """
+        while self._models and self._resident_bytes() + incoming_bytes > self.max_bytes:
+            name = next((name for name, entry in self._models.items() if not entry["in_use"]), None)
+            if name is None:
+                self._released.wait()
+                continue
+            entry = self._models.pop(name)
+            self._load_stats[name]["evictions"] += 1
+            if name == ADAPTER_BASE_KEY:
+                self._loaded_adapters = []
+                self._active_adapter = None
+            print(f"Evicting model '{name}' to stay under the model pool budget")
+            del entry
+            gc.collect()
+            if torch.cuda.is_available():
+                torch.cuda.empty_cache()
+
+    def evict(self, name: str) -> bool:
+        """Explicitly unload a model (not while a generation uses it)"""
+        with self._lock:
+            entry = self._models.get(name)
+            if entry is None or entry["in_use"]:
+                return False
+            del self._models[name]
+            self._load_stats[name]["evictions"] += 1
+            if name == ADAPTER_BASE_KEY:
+                self._loaded_adapters = []
+                self._active_adapter = None
+            del entry
+            gc.collect()
+            return True
+
+    def get_status(self) -> Dict[str, Any]:
+        """Get the pool status: loaded models, their sizes and load statistics"""
+        with self._lock:
+            models = {}
+            for name in self.registry:
+                entry = self._models.get(name)
+                models[name] = {
+                    "loaded": entry is not None,
+                    "in_use": entry["in_use"] if entry else 0,
+                    "size_bytes": entry["size_bytes"] if entry else _weights_bytes(self.registry[name]),
+                    **self._load_stats.get(name, {}),
+                }
+            base_entry = self._models.get(ADAPTER_BASE_KEY)
+            adapters = {
+                "base_model": ADAPTER_BASE_MODEL,
+                "base_loaded": base_entry is not None,
+                "base_size_bytes": base_entry["size_bytes"] if base_entry else 0,
+                "available": list(self.adapter_registry),
+                "loaded": list(self._loaded_adapters),
+                "active": self._active_adapter,
+                "switches": self._adapter_switches,
+                "last_switch_ms": round(self._last_adapter_switch_seconds * 1000, 3),
+                "avg_switch_ms": round(self._adapter_switch_seconds * 1000 / self._adapter_switches, 3) if self._adapter_switches else 0.0,
+            }
+            return {
+                "device": self.device,
+                "generation_backend": GENERATION_BACKEND,
+                "cpu_inference_mode": CPU_INFERENCE_MODE if self.device == "cpu" else None,
+                "default_model": DEFAULT_MODEL_NAME,
+                "max_bytes": self.max_bytes,
+                "resident_bytes": self._resident_bytes(),
+                "process_rss_bytes": _process_rss_bytes(),
+                "lru_order": list(self._models),
+                "models": models,
+                "adapters": adapters,
+            }
@@ -0,0 +1,30 @@
+import os
+
+# ONNX Runtime generation backend, mirrors codes/onnx_backend.py
+# (run that file to export a model and for the perplexity parity test and tokens/sec comparison)
+GENERATION_BACKENDS = ("torch", "onnx")
+GENERATION_BACKEND = os.getenv("DMRAG_GENERATION_BACKEND", "torch")
+ONNX_NUM_THREADS = int(os.getenv("DMRAG_ONNX_NUM_THREADS", "0"))  # 0 lets onnxruntime decide
+
+
+def onnx_model_dir(model_path: str) -> str:
+    """Directory of the exported decoder-with-past ONNX model for a PyTorch model directory"""
+    return model_path.rstrip("/") + "_onnx"
+
+
+def load_onnx_model(onnx_dir: str, num_threads: int = ONNX_NUM_THREADS):
+    """Load an exported GPT-2 ONNX model for CPU generation through HF generate()"""
+    import onnxruntime
+    from optimum.onnxruntime import ORTModelForCausalLM
+
+    session_options = onnxruntime.SessionOptions()
+    session_options.graph_optimization_level = onnxruntime.GraphOptimizationLevel.ORT_ENABLE_ALL
+    if num_threads > 0:
+        session_options.intra_op_num_threads = num_threads
+
+    return ORTModelForCausalLM.from_pretrained(
+        onnx_dir,
+        use_cache=True,
+        provider="CPUExecutionProvider",
+        session_options=session_options,
+    )
@@ -0,0 +1,234 @@
+import json
+import random
+import re
+from datetime import datetime, timedelta
+
+from .campaign_service import CampaignService
+from .game_state_service import GameStateService
+from .game_state_history import encode_history
+from .projection import CAMPAIGN_FIELDS
+
+"""
+This file is used to measure the payload of the campaign and character reads, before and after column projection
+Run it from the ui folder: python -m api.payload_benchmark
+
+A local stub stands in for Supabase (the part of the query builder the services use, on in-memory tables),
+so no database or network is needed. The response payload is the JSON size of the rows a query returns.
+
+"Before" are the select('*') reads on the old layout (chat and game state history as arrays in the campaign row),
+"after" are the service reads on the current layout (ChatMessages and GameStateHistory tables, projected columns).
+"""
+
+USER_ID = "user-1"
+CAMPAIGNS = 10
+CHARACTERS = 8
+TURNS = 200
+
+
+class StubResponse:
+    def __init__(self, data):
+        self.data = data
+
+
+class StubQuery:
+    # the subset of the postgrest query builder used by the services, on lists of dicts
+    def __init__(self, db, table):
+        self.db = db
+        self.table = table
+        self.columns = "*"
+        self.filters = []
+        self.ordering = None
+        self.window = None
+
+    def select(self, columns):
+        self.columns = columns
+        return self
+
+    def _filter(self, column, test):
+        self.filters.append(lambda row: column in row and test(row[column]))
+        return self
+
+    def eq(self, column, value):
+        return self._filter(column, lambda v: v == value)
+
+    def in_(self, column, values):
+        return self._filter(column, lambda v: v in values)
+
+    def gt(self, column, value):
+        return self._filter(column, lambda v: v > value)
+
+    def gte(self, column, value):
+        return self._filter(column, lambda v: v >= value)
+
+    def lt(self, column, value):
+        return self._filter(column, lambda v: v < value)
+
+    def lte(self, column, value):
+        return self._filter(column, lambda v: v <= value)
+
+    def order(self, column, desc=False):
+        self.ordering = (column, desc)
+        return self
+
+    def range(self, start, end):
+        self.window = (start, end + 1)
+        return self
+
+    def limit(self, size):
+        self.window = (0, size)
+        return self
+
+    def _project(self, row):
+        if self.columns.strip() == "*":
+            return dict(row)
+        projected = {}
+        for column in (c.strip() for c in self.columns.split(",")):
+            embedded = re.fullmatch(r"(\w+)\(count\)", column)
+            if embedded:
+                # embedded count of the rows of another table that point at this row
+                count = sum(1 for r in self.db.tables[embedded.group(1)] if r["campaign_id"] == row["id"])
+                projected[embedded.group(1)] = [{"count": count}]
+            elif column == "*":
+                projected.update(row)
+            else:
+                projected[column] = row[column]
+        return projected
+
+    def execute(self):
+        rows = [row for row in self.db.tables[self.table] if all(f(row) for f in self.filters)]
+        if self.ordering:
+            rows.sort(key=lambda row: row[self.ordering[0]], reverse=self.ordering[1])
+        if self.window:
+            rows = rows[self.window[0]:self.window[1]]
+        data = [self._project(row) for row in rows]
+        self.db.bytes_sent += len(json.dumps(data))
+        return StubResponse(data)
+
+
+class StubSupabase:
+    def __init__(self, tables):
+        self.tables = tables
+        self.bytes_sent = 0
+
+    def table(self, name):
+        return StubQuery(self, name)
+
+
+def make_character(i, start):
+    return {
+        "id": f"char-{i}",
+        "owner_id": USER_ID,
+        "created_at": (start + timedelta(minutes=i)).isoformat(),
+        "name": f"Hero{i}",
+        "race": "Elf",
+        "characterClass": "Wizard",
+        "level": 3,
+        "hitPoints": 24,
+        "armorClass": 13,
+        "proficiencyBonus": 2,
+        "stats": {"strength": 8, "dexterity": 14, "constitution": 12, "intelligence": 17, "wisdom": 13, "charisma": 10},
+        "background": {"id": "sage", "name": "Sage", "description": "Spent years learning the lore of the multiverse. " * 4},
+        "backstory": {"text": "Raised in a tower on the edge of the Sword Coast, ... " * 20, "created_at": start.isoformat()},
+        "weapon": "Quarterstaff",
+        "items": ["Spellbook", "Component pouch", "Potion of healing"],
+        "mana": 12,
+        "status": "Normal"
+    }
+
+
+def make_history(characters, rng):
+    # one chat message pair and one game state per turn, a turn changes a little of the game state
+    messages, states = [], []
+    state = {"characters": [dict(c) for c in characters]}
+    for turn in range(TURNS):
+        messages.append({"role": "user", "content": f"I attack the goblin (turn {turn})", "timestamp": turn})
+        messages.append({"role": "assistant", "content": "The goblin staggers back as your blade ... " * 6, "timestamp": turn})
+        state = json.loads(json.dumps(state))
+        character = rng.choice(state["characters"])
+        character["hitPoints"] = max(0, character["hitPoints"] - rng.randint(0, 5))
+        if rng.random() < 0.2:
+            character["items"].append(f"Loot {turn}")
+        states.append(state)
+    return messages, states
+
+
+def build_databases():
+    rng = random.Random(0)
+    start = datetime(2026, 1, 1)
+    characters = [make_character(i, start) for i in range(CHARACTERS)]
+
+    old_campaigns, new_campaigns, chat_rows, history_rows = [], [], [], []
+    for i in range(CAMPAIGNS):
+        messages, states = make_history(characters[:4], rng)
+        campaign = {
+            "id": f"campaign-{i}",
+            "owner_id": USER_ID,
+            "created_at": (start + timedelta(days=i)).isoformat(),
+            "campaign_title": f"Campaign {i}",
+            "filter_title": f"Adventure {i}",
+            "initial_message": "You wake up in a dark cave ... " * 5,
+            "model_name": None
+        }
+        old_campaigns.append({**campaign, "chat_history": messages, "game_state_history": states})
+        new_campaigns.append({**campaign, "chat_history": [], "game_state_history": []})
+        chat_rows += [{"seq": len(chat_rows) + n, "campaign_id": campaign["id"], "owner_id": USER_ID, "message": m} for n, m in enumerate(messages)]
+        history_rows += [{"campaign_id": campaign["id"], "owner_id": USER_ID, **entry} for entry in encode_history(states)]
+
+    old_db = StubSupabase({"Campaigns": old_campaigns, "Characters": characters, "ChatMessages": [], "GameStateHistory": []})
+    new_db = StubSupabase({"Campaigns": new_campaigns, "Characters": characters, "ChatMessages": chat_rows, "GameStateHistory": history_rows})
+    return old_db, new_db
+
+
+def measure(db, read):
+    db.bytes_sent = 0
+    read()
+    return db.bytes_sent
+
+
+def main():
+    old_db, new_db = build_databases()
+    campaigns, games = CampaignService(new_db), GameStateService(new_db)
+    campaign_id = "campaign-0"
+
+    reads = [
+        (
+            "campaign list (dashboard)",
+            lambda: old_db.table('Campaigns').select('*').eq('owner_id', USER_ID).execute(),
+            lambda: campaigns.get_user_campaigns(USER_ID)
+        ),
+        (
+            "campaign summaries (20 per page)",
+            lambda: old_db.table('Campaigns').select('*').eq('owner_id', USER_ID).execute(),
+            lambda: campaigns.get_user_campaign_summaries(USER_ID)
+        ),
+        (
+            "campaign for a generation",
+            lambda: old_db.table('Campaigns').select('*').eq('id', campaign_id).eq('owner_id', USER_ID).execute(),
+            lambda: campaigns.get_campaign(campaign_id, USER_ID, include_chat=False, fields=["filter_title", "model_name"])
+        ),
+        (
+            "campaign without chat",
+            lambda: old_db.table('Campaigns').select('*').eq('id', campaign_id).eq('owner_id', USER_ID).execute(),
+            lambda: campaigns.get_campaign(campaign_id, USER_ID, include_chat=False, fields=CAMPAIGN_FIELDS)
+        ),
+        (
+            "character summaries",
+            lambda: old_db.table('Characters').select('*').eq('owner_id', USER_ID).execute(),
+            lambda: games.get_user_character_summaries(USER_ID)
+        ),
+        (
+            "characters for the prompt",
+            lambda: old_db.table('Characters').select('*').eq('owner_id', USER_ID).execute(),
+            lambda: games.get_user_characters(USER_ID, fields=["name", "race", "characterClass", "level", "hitPoints", "armorClass", "weapon", "items", "mana", "status"])
+        ),
+    ]
+
+    print(f"{CAMPAIGNS} campaigns of {TURNS} turns, {CHARACTERS} characters")
+    print(f"{'read':36} {'before':>12} {'after':>12} {'ratio':>8}")
+    for name, before, after in reads:
+        before_bytes, after_bytes = measure(old_db, before), measure(new_db, after)
+        print(f"{name:36} {before_bytes:>12,} {after_bytes:>12,} {before_bytes / max(after_bytes, 1):>7.1f}x")
+
+
+if __name__ == "__main__":
+    main()
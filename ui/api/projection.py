@@ -0,0 +1,70 @@
+from typing import Iterable, List, Optional, Union
+
+"""
+This file is used to build the column projection and pagination of Supabase reads
+Note: This is not a runnable file, it is used by campaign_service.py and game_state_service.py
+
+Why:
+    The services used to select('*') for every read, so listing campaign titles or character names
+    pulled every column of every row (backstories, stats, and the old chat/game state history arrays).
+
+How:
+    Reads take the fields they need, checked against the table's columns (so a request can't select
+    arbitrary relations), and a limit/offset that becomes a PostgREST range.
+"""
+
+# Supabase returns at most this many rows per request anyway
+MAX_PAGE_SIZE = 1000
+
+# Columns of the Campaigns table
+CAMPAIGN_COLUMNS = (
+    "id", "owner_id", "created_at", "campaign_title", "filter_title", "initial_message", "model_name",
+    "chat_history", "game_state_history"
+)
+# Everything but the history columns (chat messages and game states have their own tables and endpoints)
+CAMPAIGN_FIELDS = ("id", "owner_id", "created_at", "campaign_title", "filter_title", "initial_message", "model_name")
+# What a campaign listing needs (the history columns are loaded on demand)
+CAMPAIGN_SUMMARY_FIELDS = ("id", "campaign_title", "filter_title", "model_name", "created_at")
+
+# Columns of the Characters table
+CHARACTER_COLUMNS = (
+    "id", "owner_id", "created_at", "name", "race", "characterClass", "level", "hitPoints", "armorClass",
+    "proficiencyBonus", "stats", "background", "backstory", "weapon", "items", "mana", "status"
+)
+# What a character listing needs (no stats, background or backstory)
+CHARACTER_SUMMARY_FIELDS = ("id", "name", "race", "characterClass", "level", "hitPoints", "mana", "status")
+
+
+def select_fields(fields: Optional[Union[str, Iterable[str]]], columns: Iterable[str]) -> str:
+    """
+    The select string for the given fields (a list or a comma separated string), '*' for None.
+    id is always included, unknown fields raise a ValueError.
+    """
+    if fields is None:
+        return "*"
+    if isinstance(fields, str):
+        fields = fields.split(",")
+
+    selected: List[str] = ["id"]
+    for field in (f.strip() for f in fields):
+        if not field or field in selected:
+            continue
+        if field not in columns:
+            raise ValueError(f"Unknown field '{field}'")
+        selected.append(field)
+    return ", ".join(selected)
+
+
+def paginate(query, limit: Optional[int] = None, offset: int = 0):
+    """
+    Restrict a query to rows offset..offset+limit-1 (no restriction when neither is given).
+    limit is capped at MAX_PAGE_SIZE, a limit below 1 or a negative offset raise a ValueError.
+    """
+    if limit is not None and limit < 1:
+        raise ValueError(f"Invalid limit {limit}, it must be at least 1")
+    if offset < 0:
+        raise ValueError(f"Invalid offset {offset}, it can't be negative")
+    if limit is None and not offset:
+        return query
+    limit = min(limit or MAX_PAGE_SIZE, MAX_PAGE_SIZE)
+    return query.range(offset, offset + limit - 1)
@@ -10,6 +10,8 @@ from rank_bm25 import BM25Okapi
 from sklearn.preprocessing import normalize
 from sentence_transformers import SentenceTransformer
 
+from .executors import SEARCH_EXECUTOR, async_variant
+
 # Determine project root directory relative to this file
 BASE_DIR = Path(__file__).resolve().parents[2]
 
@@ -169,4 +171,8 @@ class RetrieverService:
             "initialized": self.retriever is not None,
             "chunk_count": len(self.retriever.chunks) if self.retriever else 0,
             "embedding_model_path": self.embedding_model_path
-        } 
\ No newline at end of file
+        }
+
+    # Async variants for the routes, embedding and search run on the bounded search executor (see executors.py)
+    initialize_retriever_async = async_variant(initialize_retriever, SEARCH_EXECUTOR)
+    search_async = async_variant(search, SEARCH_EXECUTOR)
@@ -53,12 +53,14 @@ class SearchRequest(BaseModel):
 
 class ModelResponseRequest(BaseModel):
     user_input: str
+    model_name: Optional[str] = None
 
 # Campaign schemas
 class CampaignCreate(BaseModel):
     campaign_title: str
     filter_title: str
     initial_message: str
+    model_name: Optional[str] = None
     chat_history: Optional[List[Dict[str, Any]]] = []
     game_state_history: Optional[List[Dict[str, Any]]] = []
 
@@ -71,5 +73,6 @@ class CampaignUpdate(BaseModel):
     campaign_title: Optional[str] = None
     filter_title: Optional[str] = None
     initial_message: Optional[str] = None
+    model_name: Optional[str] = None
     chat_history: Optional[List[Dict[str, Any]]] = None
     game_state_history: Optional[List[Dict[str, Any]]] = None 
\ No newline at end of file
@@ -0,0 +1,106 @@
+import json
+import os
+import re
+import threading
+from pathlib import Path
+
+"""
+Local gate in front of the narration parser, mirrors codes/state_change_gate.py
+(run that file to evaluate the gate's precision / recall on logged narrations)
+
+Why:
+    parser() in game_state_parser.py sends every narration to the OpenAI tool-calling API with the full tools list,
+    but most narrations ("The tavern is quiet. The innkeeper nods at you.") don't change any HP, mana, items or weapons.
+    A cheap keyword / number-pattern check in front of it lets us skip the remote call for those.
+
+How:
+    A narration can only mutate the game state if it talks about damage/healing, mana, items changing hands or weapons.
+    We look for those words, and for numbers next to hp/damage/mana.
+    The gate is tuned for recall: a skipped state change is a bug in the game, an extra API call only costs time.
+    With DMRAG_STATE_GATE_SHADOW=1 the parser is called even when the gate says no, and every narration that goes
+    to the parser is logged with the tool calls the model made, which gives us labels to measure the gate
+    (the log also contains the narrations the gate would skip, needed to measure recall).
+    The log holds the players' story text, so it is only written in shadow mode or when DMRAG_NARRATION_LOG
+    names the log file.
+"""
+
+BASE_DIR = Path(__file__).resolve().parents[2]
+STATE_GATE_SHADOW = os.getenv("DMRAG_STATE_GATE_SHADOW", "0") == "1"
+NARRATION_LOG_PATH = Path(os.getenv("DMRAG_NARRATION_LOG") or BASE_DIR / "narration_log.jsonl")
+NARRATION_LOGGING = STATE_GATE_SHADOW or bool(os.getenv("DMRAG_NARRATION_LOG"))
+# the parser runs on the state update queue's workers, one line is written at a time
+_narration_log_lock = threading.Lock()
+
+STATE_CHANGE_PATTERNS = [
+    # hp: damage and healing
+    r"\bdamage[ds]?\b", r"\bhit(?:s)?\b", r"\bstruck\b", r"\bstrikes?\b", r"\bwound(?:s|ed)?\b", r"\bhurt(?:s)?\b",
+    r"\binjur(?:e|es|ed|y)\b", r"\bslash(?:es|ed)?\b", r"\bstab(?:s|bed)?\b", r"\bpierc(?:e|es|ed)\b", r"\bbit(?:e|es|ten)\b",
+    r"\bburn(?:s|ed)?\b", r"\bpoison(?:s|ed)?\b", r"\bfireball\b", r"\bblast(?:s|ed)?\b", r"\bexplo(?:de|des|sion)\b",
+    r"\bheal(?:s|ed|ing)?\b", r"\bcur(?:e|es|ed)\b", r"\bpotion\b", r"\bregain(?:s|ed)?\b", r"\brestor(?:e|es|ed)\b",
+    r"\brecover(?:s|ed)?\b", r"\bhp\b", r"\bhit points?\b", r"\bhealth\b", r"\bunconscious\b", r"\bfalls?\b",
+    # mana
+    r"\bmana\b", r"\bspell slots?\b", r"\bdrain(?:s|ed)?\b", r"\bexhaust(?:s|ed)?\b",
+    # items changing hands
+    r"\bpick(?:s|ed)? up\b", r"\bgrab(?:s|bed)?\b", r"\btak(?:e|es|en)\b", r"\btook\b", r"\bfind(?:s)?\b", r"\bfound\b",
+    r"\breceiv(?:e|es|ed)\b", r"\bgiv(?:e|es|en)\b", r"\bgave\b", r"\bhand(?:s|ed)\b", r"\bloot(?:s|ed)?\b",
+    r"\binventory\b", r"\bpocket(?:s|ed)?\b", r"\bdrop(?:s|ped)?\b", r"\blos(?:e|es|t)\b", r"\bstol(?:e|en)\b",
+    r"\bsteal(?:s)?\b", r"\bbuy(?:s)?\b", r"\bbought\b", r"\bsell(?:s)?\b", r"\bsold\b", r"\breward(?:s|ed)?\b",
+    r"\bgold\b", r"\bcoins?\b",
+    # weapons
+    r"\bweapon\b", r"\bwield(?:s|ed|ing)?\b", r"\bequip(?:s|ped)?\b", r"\bdraw(?:s|n)?\b", r"\bdrew\b",
+    r"\bunsheath(?:e|es|ed)\b", r"\bswap(?:s|ped)?\b", r"\bswitch(?:es|ed)?\b",
+    # numbers next to game state quantities ("loses 10 hp", "takes 7 damage", "3 mana")
+    r"\b\d+\s*(?:hp|hit points?|damage|health|mana|points?)\b",
+]
+STATE_CHANGE_REGEX = re.compile("|".join(STATE_CHANGE_PATTERNS), re.IGNORECASE)
+
+# how many narrations the gate saw and how many parser calls it saved this session
+gate_stats = {"checked": 0, "skipped": 0}
+
+
+def may_change_state(narration: str) -> bool:
+    # False means the narration can't contain a game state mutation, so the remote parser call is skipped
+    gate_stats["checked"] += 1
+    if narration and STATE_CHANGE_REGEX.search(narration):
+        return True
+    gate_stats["skipped"] += 1
+    return False
+
+
+def log_narration(narration: str, gate_decision: bool, tool_call_names: list[str], path: Path = NARRATION_LOG_PATH):
+    # the tool calls the parser made are the label of the narration
+    line = json.dumps({"narration": narration, "gate": gate_decision, "tool_calls": tool_call_names}) + "\n"
+    with _narration_log_lock:
+        with open(path, "a", encoding="utf-8") as f:
+            f.write(line)
+
+
+def evaluate_gate(path: Path = NARRATION_LOG_PATH) -> dict:
+    # precision / recall of the gate against the parser's tool calls
+    # we re-run the gate on every logged narration, so changes to the patterns can be evaluated on old logs
+    tp = fp = fn = tn = 0
+    with open(path, "r", encoding="utf-8") as f:
+        for line in f:
+            if not line.strip():
+                continue
+            entry = json.loads(line)
+            predicted = bool(STATE_CHANGE_REGEX.search(entry["narration"] or ""))
+            actual = bool(entry["tool_calls"])
+            if predicted and actual:
+                tp += 1
+            elif predicted and not actual:
+                fp += 1
+            elif actual:
+                fn += 1
+            else:
+                tn += 1
+
+    total = tp + fp + fn + tn
+    return {
+        "narrations": total,
+        "precision": tp / (tp + fp) if tp + fp else 0.0,
+        "recall": tp / (tp + fn) if tp + fn else 0.0,
+        # narrations the gate would skip, i.e. parser calls saved
+        "calls_saved": fn + tn,
+        "missed_state_changes": fn,
+    }
@@ -0,0 +1,110 @@
+import os
+import queue
+import threading
+import time
+from collections import defaultdict
+
+"""
+This file is used to apply game state updates in the background, in turn order, per campaign
+Note: This is not a runnable file, it is used by main.py
+
+Why:
+    The narration used to be returned only after the state parser had made its OpenAI call and applied every tool call.
+    The players don't need the game state to read the narration, only the next turn's prompt needs it.
+
+How:
+    Every campaign gets its own worker thread and FIFO queue, so the updates of one campaign are applied strictly in turn order
+    (and a slow campaign doesn't hold up the others). The next turn calls wait_for(campaign) before it reads the game state,
+    which only blocks if an update for that campaign is still pending.
+    A worker that has had nothing to do for IDLE_WORKER_SECONDS exits (with its queue and stats),
+    so only campaigns with recent updates hold a thread.
+    stats() reports the queue depth and how long updates waited in the queue and took to apply.
+"""
+
+IDLE_WORKER_SECONDS = float(os.getenv("DMRAG_STATE_WORKER_IDLE_SECONDS", "60"))
+
+
+def _new_stats() -> dict:
+    return {
+        "applied": 0,
+        "failed": 0,
+        "last_wait_seconds": None,
+        "last_apply_seconds": None,
+        "total_apply_seconds": 0.0,
+    }
+
+
+class StateUpdateQueue:
+    def __init__(self, idle_seconds: float = IDLE_WORKER_SECONDS):
+        self.idle_seconds = idle_seconds
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._queues = {}
+        self._pending = defaultdict(int)
+        self._stats = defaultdict(_new_stats)
+
+    def submit(self, campaign_id, fn, *args, **kwargs):
+        # fn(*args, **kwargs) runs on the campaign's worker after all previously submitted updates of that campaign
+        with self._lock:
+            if campaign_id not in self._queues:
+                self._queues[campaign_id] = queue.Queue()
+                threading.Thread(target=self._run, args=(campaign_id,), daemon=True).start()
+            self._pending[campaign_id] += 1
+            self._queues[campaign_id].put((time.perf_counter(), fn, args, kwargs))
+
+    def pending(self, campaign_id) -> int:
+        with self._lock:
+            return self._pending.get(campaign_id, 0)
+
+    def wait_for(self, campaign_id, timeout=None) -> bool:
+        # blocks until every submitted update of the campaign is applied, returns False on timeout
+        with self._idle:
+            return self._idle.wait_for(lambda: self._pending.get(campaign_id, 0) == 0, timeout)
+
+    def stats(self, campaign_id=None, campaign_ids=None) -> dict:
+        # the stats of one campaign, of the given campaigns, or of every campaign with a worker
+        with self._lock:
+            if campaign_id is not None:
+                campaign_ids = [campaign_id]
+            elif campaign_ids is None:
+                campaign_ids = list(self._queues)
+            result = {}
+            for cid in campaign_ids:
+                stats = dict(self._stats.get(cid) or _new_stats())
+                stats["queue_depth"] = self._pending.get(cid, 0)
+                stats["mean_apply_seconds"] = stats["total_apply_seconds"] / stats["applied"] if stats["applied"] else None
+                result[cid] = stats
+            return result
+
+    def _run(self, campaign_id):
+        updates = self._queues[campaign_id]
+        while True:
+            try:
+                submitted_at, fn, args, kwargs = updates.get(timeout=self.idle_seconds)
+            except queue.Empty:
+                with self._lock:
+                    # submit puts under the same lock, so nothing can arrive between this check and the exit
+                    if updates.empty():
+                        del self._queues[campaign_id]
+                        self._pending.pop(campaign_id, None)
+                        self._stats.pop(campaign_id, None)
+                        return
+                continue
+            start = time.perf_counter()
+            failed = False
+            try:
+                fn(*args, **kwargs)
+            except Exception as e:
+                failed = True
+                print(f"Could not update the game state for {campaign_id}: {e}")
+            end = time.perf_counter()
+
+            with self._idle:
+                stats = self._stats[campaign_id]
+                stats["failed" if failed else "applied"] += 1
+                stats["last_wait_seconds"] = start - submitted_at
+                stats["last_apply_seconds"] = end - start
+                if not failed:
+                    stats["total_apply_seconds"] += end - start
+                self._pending[campaign_id] -= 1
+                self._idle.notify_all()
@@ -0,0 +1,147 @@
+import hashlib
+import json
+import os
+import tempfile
+import threading
+import time
+from pathlib import Path
+from typing import Any, Dict, Iterator, Optional
+
+"""
+This file is used to cache Supabase Storage objects (the chunk corpus, campaign_details.json) on the local disk
+Note: This is not a runnable file, it is used by main.py
+
+Why:
+    The retriever's chunks (first_200.jsonl) were downloaded and decoded into one string every time the retriever
+    initialized, and /get_campaign_details downloaded campaign_details.json on every call,
+    although these files rarely change.
+
+How:
+    A downloaded object is stored under its sha256 (objects/<sha256>), the index maps bucket/path to the hash,
+    its ETag and Last-Modified, and when it was last checked.
+    Within the TTL the cached file is used as is. After it, the object is revalidated with a conditional request
+    (If-None-Match / If-Modified-Since): a 304 only refreshes the check time, anything else is downloaded again,
+    streamed to disk while it is hashed. If Storage can't be reached, the cached copy is used.
+    JSONL files are parsed line by line from the cached file, never decoded as a whole.
+
+    The cache is shared by all users, it is meant for objects every signed-in user may read
+    (the request still needs a signed-in user's client to download or revalidate).
+"""
+
+BASE_DIR = Path(__file__).resolve().parents[2]
+STORAGE_CACHE_DIR = Path(os.getenv("DMRAG_STORAGE_CACHE_DIR", BASE_DIR / "storage_cache"))
+STORAGE_CACHE_SECONDS = int(os.getenv("DMRAG_STORAGE_CACHE_SECONDS", "300"))
+
+
+class StorageCache:
+    def __init__(self, cache_dir: Path = STORAGE_CACHE_DIR, ttl_seconds: int = STORAGE_CACHE_SECONDS):
+        self.cache_dir = Path(cache_dir)
+        self.objects_dir = self.cache_dir / "objects"
+        self.index_path = self.cache_dir / "index.json"
+        self.ttl_seconds = ttl_seconds
+        self.objects_dir.mkdir(parents=True, exist_ok=True)
+        # "bucket/path" -> {"sha256", "etag", "last_modified", "size", "checked_at"}
+        self._index: Dict[str, Dict[str, Any]] = json.loads(self.index_path.read_text()) if self.index_path.exists() else {}
+        self._lock = threading.Lock()
+        self._key_locks: Dict[str, threading.Lock] = {}
+        self._stats = {"hits": 0, "revalidated": 0, "downloaded": 0, "bytes_downloaded": 0, "stale_served": 0}
+
+    def _key_lock(self, key: str) -> threading.Lock:
+        with self._lock:
+            return self._key_locks.setdefault(key, threading.Lock())
+
+    def _save_index(self):
+        # same as the game state CSV: write a temporary file and rename it, so the index is never half written
+        fd, tmp_path = tempfile.mkstemp(dir=self.cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "w") as f:
+            json.dump(self._index, f)
+        os.replace(tmp_path, self.index_path)
+
+    def _object_path(self, sha256: str) -> Path:
+        return self.objects_dir / sha256
+
+    def _download(self, supabase_client, bucket: str, path: str, entry: Optional[Dict]) -> Dict:
+        # conditional GET of the object, streamed to disk, returns the new index entry
+        headers = {}
+        if entry and entry.get("etag"):
+            headers["If-None-Match"] = entry["etag"]
+        if entry and entry.get("last_modified"):
+            headers["If-Modified-Since"] = entry["last_modified"]
+
+        with supabase_client.storage_stream(bucket, path, headers=headers) as response:
+            if response.status_code == 304 and entry:
+                self._stats["revalidated"] += 1
+                return {**entry, "checked_at": time.time()}
+            response.raise_for_status()
+
+            digest = hashlib.sha256()
+            size = 0
+            fd, tmp_path = tempfile.mkstemp(dir=self.objects_dir, suffix=".tmp")
+            try:
+                with os.fdopen(fd, "wb") as f:
+                    for block in response.iter_bytes():
+                        digest.update(block)
+                        f.write(block)
+                        size += len(block)
+                sha256 = digest.hexdigest()
+                os.replace(tmp_path, self._object_path(sha256))
+            except BaseException:
+                if os.path.exists(tmp_path):
+                    os.remove(tmp_path)
+                raise
+
+            self._stats["downloaded"] += 1
+            self._stats["bytes_downloaded"] += size
+            return {
+                "sha256": sha256,
+                "etag": response.headers.get("etag"),
+                "last_modified": response.headers.get("last-modified"),
+                "size": size,
+                "checked_at": time.time()
+            }
+
+    def _remove_unreferenced(self, sha256: str):
+        # an object is shared by every path with the same content, it's only removed once no path uses it
+        if all(entry["sha256"] != sha256 for entry in self._index.values()):
+            self._object_path(sha256).unlink(missing_ok=True)
+
+    def get_path(self, supabase_client, bucket: str, path: str) -> Path:
+        """The local file of a storage object, downloaded or revalidated when the cached copy is older than the TTL"""
+        key = f"{bucket}/{path}"
+        with self._key_lock(key):
+            entry = self._index.get(key)
+            cached = entry is not None and self._object_path(entry["sha256"]).exists()
+            if cached and time.time() - entry["checked_at"] < self.ttl_seconds:
+                self._stats["hits"] += 1
+                return self._object_path(entry["sha256"])
+
+            try:
+                new_entry = self._download(supabase_client, bucket, path, entry if cached else None)
+            except Exception as e:
+                if not cached:
+                    raise
+                print(f"Could not revalidate {key}, using the cached copy: {e}")
+                self._stats["stale_served"] += 1
+                return self._object_path(entry["sha256"])
+
+            with self._lock:
+                self._index[key] = new_entry
+                if cached and entry["sha256"] != new_entry["sha256"]:
+                    self._remove_unreferenced(entry["sha256"])
+                self._save_index()
+            return self._object_path(new_entry["sha256"])
+
+    def read_json(self, supabase_client, bucket: str, path: str) -> Any:
+        with open(self.get_path(supabase_client, bucket, path), "r", encoding="utf-8") as f:
+            return json.load(f)
+
+    def iter_jsonl(self, supabase_client, bucket: str, path: str) -> Iterator[Dict]:
+        """The objects of a JSONL file, parsed one line at a time from the cached file"""
+        with open(self.get_path(supabase_client, bucket, path), "r", encoding="utf-8") as f:
+            for line in f:
+                line = line.strip()
+                if line:
+                    yield json.loads(line)
+
+    def stats(self) -> Dict[str, Any]:
+        return {**self._stats, "objects": len(self._index), "ttl_seconds": self.ttl_seconds}
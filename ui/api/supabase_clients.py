@@ -0,0 +1,87 @@
+import os
+from typing import Dict, Optional
+
+import httpx
+from postgrest import SyncPostgrestClient
+from storage3 import SyncStorageClient
+
+"""
+This file is used to give every request its own lightweight Supabase client, on one shared connection pool
+Note: This is not a runnable file, the pool is created in middleware.py
+
+Why:
+    There used to be one global Supabase client, and the handlers set the user's token on it
+    (supabase.postgrest.auth(token), supabase.storage._client.headers).
+    Two requests of different users at the same time raced on that shared auth state,
+    so a query could run with the other user's token.
+
+How:
+    The connection pool (an httpx transport with keep-alive) is created once and shared.
+    A request gets a UserSupabaseClient that carries its own token (in its own headers) and only has
+    the parts of the Supabase client the services use: table, rpc and storage. Creating one is cheap,
+    its PostgREST and storage clients are only built when used, and they send through the shared pool.
+"""
+
+SUPABASE_MAX_CONNECTIONS = int(os.getenv("DMRAG_SUPABASE_MAX_CONNECTIONS", "20"))
+SUPABASE_TIMEOUT_SECONDS = float(os.getenv("DMRAG_SUPABASE_TIMEOUT_SECONDS", "30"))
+
+
+class SupabaseTransport:
+    # the connection pool shared by all per-request clients
+    def __init__(self, url: str, key: str, max_connections: int = SUPABASE_MAX_CONNECTIONS):
+        self.url = (url or "").rstrip("/")
+        self.key = key
+        self.transport = httpx.HTTPTransport(
+            limits=httpx.Limits(max_connections=max_connections, max_keepalive_connections=max_connections)
+        )
+
+    def http_client(self, base_url: str, headers: Dict[str, str]) -> httpx.Client:
+        # not closed per request, closing it would close the shared transport
+        return httpx.Client(base_url=base_url, headers=headers, transport=self.transport, timeout=SUPABASE_TIMEOUT_SECONDS)
+
+    def client(self, token: Optional[str] = None) -> "UserSupabaseClient":
+        return UserSupabaseClient(self, token)
+
+    def close(self):
+        self.transport.close()
+
+
+class UserSupabaseClient:
+    # table/rpc/storage like the Supabase client, authenticated as one user (or with the API key without a token)
+    def __init__(self, transport: SupabaseTransport, token: Optional[str] = None):
+        self._transport = transport
+        self.headers = {
+            "apiKey": transport.key,
+            "Authorization": f"Bearer {token or transport.key}"
+        }
+        self._postgrest = None
+        self._storage = None
+
+    @property
+    def postgrest(self) -> SyncPostgrestClient:
+        if self._postgrest is None:
+            rest_url = f"{self._transport.url}/rest/v1"
+            self._postgrest = SyncPostgrestClient(
+                rest_url, headers=self.headers, http_client=self._transport.http_client(rest_url, self.headers)
+            )
+        return self._postgrest
+
+    @property
+    def storage(self) -> SyncStorageClient:
+        if self._storage is None:
+            storage_url = f"{self._transport.url}/storage/v1"
+            self._storage = SyncStorageClient(
+                storage_url, self.headers, http_client=self._transport.http_client(storage_url, self.headers)
+            )
+        return self._storage
+
+    def storage_stream(self, bucket: str, path: str, headers: Optional[Dict[str, str]] = None):
+        """A streamed GET of a storage object (e.g. with conditional headers), use it as a context manager"""
+        storage_url = f"{self._transport.url}/storage/v1"
+        return self._transport.http_client(storage_url, self.headers).stream("GET", f"/object/{bucket}/{path}", headers=headers)
+
+    def table(self, table_name: str):
+        return self.postgrest.from_(table_name)
+
+    def rpc(self, fn: str, params: Optional[Dict] = None):
+        return self.postgrest.rpc(fn, params or {})
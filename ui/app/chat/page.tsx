@@ -3,6 +3,7 @@
 import React, { useState, useRef, useEffect } from 'react';
 import { useRouter, useSearchParams } from 'next/navigation';
 import { modelApi, campaignsApi } from '@/lib/data';
+import type { ChatMessageRow } from '@/lib/types';
 
 interface Message {
   id: string;
@@ -11,6 +12,16 @@ interface Message {
   timestamp: Date;
 }
 
+// Stored chat messages are loaded one page at a time, newest page first
+const CHAT_PAGE_SIZE = 50;
+
+const toMessage = (row: ChatMessageRow): Message => ({
+  id: `seq-${row.seq}`,
+  type: (row.message.role === 'user' ? 'player' : 'dm') as 'player' | 'dm',
+  content: row.message.content,
+  timestamp: new Date(row.message.timestamp || row.created_at || Date.now())
+});
+
 export default function ChatPage() {
   const router = useRouter();
   const searchParams = useSearchParams();
@@ -21,15 +32,21 @@ export default function ChatPage() {
   const [isLoading, setIsLoading] = useState(false);
   const [campaignLoading, setCampaignLoading] = useState(true);
   const [campaign, setCampaign] = useState<any>(null);
+  // cursor of the oldest loaded message, for scrolling back through the chat
+  const [beforeSeq, setBeforeSeq] = useState<number | null>(null);
+  const [hasOlderMessages, setHasOlderMessages] = useState(false);
+  const [olderLoading, setOlderLoading] = useState(false);
   const messagesEndRef = useRef<HTMLDivElement>(null);
 
   const scrollToBottom = () => {
     messagesEndRef.current?.scrollIntoView({ behavior: 'smooth' });
   };
 
+  // only new messages at the end scroll down, not older ones loaded above
+  const lastMessageId = messages[messages.length - 1]?.id;
   useEffect(() => {
     scrollToBottom();
-  }, [messages]);
+  }, [lastMessageId]);
 
   // Load campaign data when component mounts or campaign ID changes
   useEffect(() => {
@@ -50,18 +67,18 @@ export default function ChatPage() {
 
       try {
         setCampaignLoading(true);
-        const campaignData = await campaignsApi.getCampaign(campaignId);
+        // the campaign without its chat, then the latest page of messages
+        const [campaignData, chatPage] = await Promise.all([
+          campaignsApi.getCampaign(campaignId, false),
+          campaignsApi.getChatMessages(campaignId, null, CHAT_PAGE_SIZE)
+        ]);
         
         setCampaign(campaignData);
+        setBeforeSeq(chatPage.before_seq);
+        setHasOlderMessages(chatPage.has_more);
         
-        // Convert stored chat history to message format
-        const chatHistory = campaignData.chat_history || [];
-        const formattedMessages = chatHistory.map((msg: any, index: number) => ({
-          id: `${index + 1}`,
-          type: (msg.role === 'user' ? 'player' : 'dm') as 'player' | 'dm',
-          content: msg.content,
-          timestamp: new Date(msg.timestamp || Date.now())
-        }));
+        // Convert stored chat messages to message format
+        const formattedMessages = chatPage.messages.map(toMessage);
         
                   setMessages(formattedMessages.length > 0 ? formattedMessages : [
             {
@@ -82,6 +99,22 @@ export default function ChatPage() {
     loadCampaign();
   }, [campaignId, router]);
 
+  const loadOlderMessages = async () => {
+    if (!campaignId || olderLoading || !hasOlderMessages) return;
+
+    try {
+      setOlderLoading(true);
+      const chatPage = await campaignsApi.getChatMessages(campaignId, beforeSeq, CHAT_PAGE_SIZE);
+      setMessages(prev => [...chatPage.messages.map(toMessage), ...prev]);
+      setBeforeSeq(chatPage.before_seq);
+      setHasOlderMessages(chatPage.has_more);
+    } catch (error) {
+      console.error('Failed to load older messages:', error);
+    } finally {
+      setOlderLoading(false);
+    }
+  };
+
   const handleSendMessage = async () => {
     if (!inputMessage.trim() || isLoading) return;
 
@@ -202,6 +235,17 @@ export default function ChatPage() {
 
       <div className="chatContainer">
         <div className="messagesArea">
+          {hasOlderMessages && (
+            <div className="text-center my-2">
+              <button
+                onClick={loadOlderMessages}
+                className="text-purple-600 hover:text-purple-800 underline text-sm"
+                disabled={olderLoading}
+              >
+                {olderLoading ? 'Loading...' : 'Load older messages'}
+              </button>
+            </div>
+          )}
           {messages.map((message) => (
             <div key={message.id} className={`message ${message.type}`}>
               <div className="messageAvatar">
@@ -755,11 +755,11 @@ export default function DashboardPage() {
                   <div className="text-sm space-y-3 mb-4 text-black">
                     <div>
                       <p className="font-medium text-black mb-2">Chat Messages:</p>
-                      <p className="text-black">{campaign.chat_history?.length || 0} messages</p>
+                      <p className="text-black">{campaign.chat_message_count ?? campaign.chat_history?.length ?? 0} messages</p>
                     </div>
                     <div>
                       <p className="font-medium text-black mb-2">Game State Updates:</p>
-                      <p className="text-black">{campaign.game_state_history?.length || 0} updates</p>
+                      <p className="text-black">{campaign.game_state_update_count ?? campaign.game_state_history?.length ?? 0} updates</p>
                     </div>
                     {campaign.game_state_history?.length > 0 && campaign.game_state_history[0]?.characters && (
                       <div>
@@ -1,4 +1,4 @@
-import type { ApiResponse, Character, Campaign, CampaignCreate, CampaignUpdate, CampaignDetailsResponse } from './types'
+import type { ApiResponse, Character, Campaign, CampaignCreate, CampaignUpdate, CampaignDetailsResponse, ChatMessagesPage } from './types'
 import { createClient } from '@/lib/supabase'
 
 const API_BASE_URL = process.env.NEXT_PUBLIC_API_URL || 'http://localhost:8000'
@@ -79,8 +79,13 @@ export const campaignsApi = {
     return apiRequest<Campaign[]>('/get_user_campaigns')
   },
 
-  async getCampaign(id: string): Promise<Campaign> {
-    return apiRequest<Campaign>(`/get_campaign?campaign_id=${id}`, 'POST')
+  async getCampaign(id: string, includeChat: boolean = true): Promise<Campaign> {
+    return apiRequest<Campaign>(`/get_campaign?campaign_id=${id}&include_chat=${includeChat}`, 'POST')
+  },
+
+  async getChatMessages(campaignId: string, beforeSeq?: number | null, limit: number = 50): Promise<ChatMessagesPage> {
+    const cursorParam = beforeSeq !== undefined && beforeSeq !== null ? `&before_seq=${beforeSeq}` : ''
+    return apiRequest<ChatMessagesPage>(`/get_chat_messages?campaign_id=${campaignId}&limit=${limit}${cursorParam}`)
   },
 
   async createCampaign(campaign: CampaignCreate): Promise<Campaign> {
@@ -103,6 +108,15 @@ export const campaignsApi = {
     return apiRequest<Campaign>(`/add_game_state_update?campaign_id=${campaignId}`, 'POST', gameState)
   },
 
+  async getGameStateAt(campaignId: string, turn?: number): Promise<any> {
+    const turnParam = turn !== undefined ? `&turn=${turn}` : ''
+    return apiRequest<any>(`/get_game_state_at?campaign_id=${campaignId}${turnParam}`)
+  },
+
+  async getGameStateDeltas(campaignId: string, afterTurn: number = 0): Promise<any> {
+    return apiRequest<any>(`/get_game_state_deltas?campaign_id=${campaignId}&after_turn=${afterTurn}`)
+  },
+
   async startAdventure(characterId: string, campaignSettings?: any): Promise<any> {
     return apiRequest<any>('/start_adventure', 'POST', { 
       character_id: characterId,
@@ -55,11 +55,30 @@ export interface Campaign {
   filter_title: string
   initial_message: string
   chat_history: any[]
+  // cursor and flag for the messages before chat_history (see ChatMessagesPage)
+  chat_before_seq?: number | null
+  chat_has_more?: boolean
+  chat_message_count?: number
+  game_state_update_count?: number
   game_state_history: any[]
   owner_id: string
   created_at: string
 }
 
+export interface ChatMessageRow {
+  seq: number
+  message: any
+  created_at: string
+}
+
+// One page of a campaign's chat messages, oldest first
+export interface ChatMessagesPage {
+  messages: ChatMessageRow[]
+  before_seq: number | null
+  after_seq: number | null
+  has_more: boolean
+}
+
 export interface CampaignCreate {
   campaign_title: string
   filter_title: string
@@ -0,0 +1,3 @@
+-- Model used to generate the DM responses of a campaign (a name from MODEL_REGISTRY in ui/api/model_pool.py).
+-- NULL means the API default (DMRAG_DEFAULT_MODEL).
+alter table "Campaigns" add column if not exists model_name text;
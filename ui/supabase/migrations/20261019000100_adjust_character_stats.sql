@@ -0,0 +1,21 @@
+-- Atomic, clamped HP / mana changes for a character (used by GameStateService damage/heal/restore/drain).
+-- A single UPDATE takes the row lock, so concurrent changes to the same character can't overwrite each other,
+-- and the API needs one round trip instead of select + select + update.
+-- Same clamping as before: HP and mana never go below 0. Returns the updated row, or no rows if the
+-- character doesn't exist or belongs to someone else.
+create or replace function adjust_character_stats(
+  p_character_id uuid,
+  p_owner_id uuid,
+  p_hp_delta integer default 0,
+  p_mana_delta integer default 0
+)
+returns setof "Characters"
+language sql
+as $$
+  update "Characters"
+     set "hitPoints" = greatest(0, coalesce("hitPoints", 0) + p_hp_delta),
+         mana = greatest(0, coalesce(mana, 0) + p_mana_delta)
+   where id = p_character_id
+     and owner_id = p_owner_id
+  returning *;
+$$;
@@ -0,0 +1,33 @@
+-- Chat messages as rows instead of one ever-growing "Campaigns".chat_history array.
+-- Appending a message is a single insert, reading is a paginated range scan on (campaign_id, seq).
+create table if not exists "ChatMessages" (
+  seq bigint generated always as identity primary key,
+  campaign_id uuid not null references "Campaigns"(id) on delete cascade,
+  owner_id uuid not null,
+  message jsonb not null,
+  created_at timestamptz not null default now()
+);
+
+create index if not exists chat_messages_campaign_seq_idx on "ChatMessages" (campaign_id, seq);
+
+-- Appends a message to a campaign the owner owns, in one statement (returns no rows otherwise).
+create or replace function append_chat_message(p_campaign_id uuid, p_owner_id uuid, p_message jsonb)
+returns setof "ChatMessages"
+language sql
+as $$
+  insert into "ChatMessages" (campaign_id, owner_id, message)
+  select c.id, c.owner_id, p_message
+    from "Campaigns" c
+   where c.id = p_campaign_id
+     and c.owner_id = p_owner_id
+  returning *;
+$$;
+
+-- Move the existing chat_history arrays over, keeping their order, then empty them.
+insert into "ChatMessages" (campaign_id, owner_id, message)
+select c.id, c.owner_id, m.message
+  from "Campaigns" c
+ cross join lateral jsonb_array_elements(coalesce(c.chat_history::jsonb, '[]'::jsonb)) with ordinality as m(message, ord)
+ order by c.created_at, c.id, m.ord;
+
+update "Campaigns" set chat_history = '[]'::jsonb where chat_history is not null and chat_history::jsonb <> '[]'::jsonb;
@@ -0,0 +1,35 @@
+-- Game state history as one row per turn instead of one ever-growing "Campaigns".game_state_history array.
+-- A row holds either the full state (kind 'keyframe') or the ops that turn the previous turn's state into it
+-- (kind 'delta'), see ui/api/game_state_history.py.
+create table if not exists "GameStateHistory" (
+  campaign_id uuid not null references "Campaigns"(id) on delete cascade,
+  turn integer not null,
+  owner_id uuid not null,
+  kind text not null check (kind in ('keyframe', 'delta')),
+  state jsonb not null,
+  created_at timestamptz not null default now(),
+  primary key (campaign_id, turn)
+);
+
+-- Adds a turn to a campaign the owner owns, in one statement (returns no rows otherwise).
+-- The primary key rejects a turn that was already written.
+create or replace function append_game_state_entry(p_campaign_id uuid, p_owner_id uuid, p_turn integer, p_kind text, p_state jsonb)
+returns setof "GameStateHistory"
+language sql
+as $$
+  insert into "GameStateHistory" (campaign_id, turn, owner_id, kind, state)
+  select c.id, p_turn, c.owner_id, p_kind, p_state
+    from "Campaigns" c
+   where c.id = p_campaign_id
+     and c.owner_id = p_owner_id
+  returning *;
+$$;
+
+-- Move the existing game_state_history arrays over as keyframes, keeping their order, then empty them.
+-- The background compaction turns them into keyframes plus deltas.
+insert into "GameStateHistory" (campaign_id, turn, owner_id, kind, state)
+select c.id, m.ord, c.owner_id, 'keyframe', m.state
+  from "Campaigns" c
+ cross join lateral jsonb_array_elements(coalesce(c.game_state_history::jsonb, '[]'::jsonb)) with ordinality as m(state, ord);
+
+update "Campaigns" set game_state_history = '[]'::jsonb where game_state_history is not null and game_state_history::jsonb <> '[]'::jsonb;
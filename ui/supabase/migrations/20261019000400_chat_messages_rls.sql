@@ -0,0 +1,29 @@
+-- "ChatMessages" is in the public schema, so it is reachable through the REST API with the anon key.
+-- Row level security limits every user to their own messages.
+alter table "ChatMessages" enable row level security;
+
+drop policy if exists "Users read their own chat messages" on "ChatMessages";
+create policy "Users read their own chat messages" on "ChatMessages"
+  for select using (owner_id = auth.uid());
+
+drop policy if exists "Users add their own chat messages" on "ChatMessages";
+create policy "Users add their own chat messages" on "ChatMessages"
+  for insert with check (owner_id = auth.uid());
+
+drop policy if exists "Users delete their own chat messages" on "ChatMessages";
+create policy "Users delete their own chat messages" on "ChatMessages"
+  for delete using (owner_id = auth.uid());
+
+-- The owner is the signed-in user, not a parameter the caller chooses.
+drop function if exists append_chat_message(uuid, uuid, jsonb);
+create or replace function append_chat_message(p_campaign_id uuid, p_message jsonb)
+returns setof "ChatMessages"
+language sql
+as $$
+  insert into "ChatMessages" (campaign_id, owner_id, message)
+  select c.id, c.owner_id, p_message
+    from "Campaigns" c
+   where c.id = p_campaign_id
+     and c.owner_id = auth.uid()
+  returning *;
+$$;
@@ -0,0 +1,34 @@
+-- "GameStateHistory" is in the public schema, so it is reachable through the REST API with the anon key.
+-- Row level security limits every user to their own game state history
+-- (update is needed by the compaction, which upserts re-encoded rows).
+alter table "GameStateHistory" enable row level security;
+
+drop policy if exists "Users read their own game state history" on "GameStateHistory";
+create policy "Users read their own game state history" on "GameStateHistory"
+  for select using (owner_id = auth.uid());
+
+drop policy if exists "Users add their own game state history" on "GameStateHistory";
+create policy "Users add their own game state history" on "GameStateHistory"
+  for insert with check (owner_id = auth.uid());
+
+drop policy if exists "Users update their own game state history" on "GameStateHistory";
+create policy "Users update their own game state history" on "GameStateHistory"
+  for update using (owner_id = auth.uid()) with check (owner_id = auth.uid());
+
+drop policy if exists "Users delete their own game state history" on "GameStateHistory";
+create policy "Users delete their own game state history" on "GameStateHistory"
+  for delete using (owner_id = auth.uid());
+
+-- The owner is the signed-in user, not a parameter the caller chooses.
+drop function if exists append_game_state_entry(uuid, uuid, integer, text, jsonb);
+create or replace function append_game_state_entry(p_campaign_id uuid, p_turn integer, p_kind text, p_state jsonb)
+returns setof "GameStateHistory"
+language sql
+as $$
+  insert into "GameStateHistory" (campaign_id, turn, owner_id, kind, state)
+  select c.id, p_turn, c.owner_id, p_kind, p_state
+    from "Campaigns" c
+   where c.id = p_campaign_id
+     and c.owner_id = auth.uid()
+  returning *;
+$$;
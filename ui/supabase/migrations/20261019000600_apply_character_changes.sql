@@ -0,0 +1,30 @@
+-- All character changes of one completion in a single UPDATE (used by GameStateService.apply_mutations).
+-- p_changes is a jsonb array of {id, hp_delta, mana_delta, items_add, items_remove, weapon}, one entry per character.
+-- Like adjust_character_stats, HP and mana change by a delta on the current row (clamped at 0), so concurrent
+-- changes from other campaigns, /adjust_character_stats or the UI are not overwritten.
+-- items (a jsonb array) loses every items_remove entry, then gets items_add appended, in order.
+-- Only the signed-in user's characters are changed, the updated rows are returned.
+create or replace function apply_character_changes(p_changes jsonb)
+returns setof "Characters"
+language sql
+as $$
+  update "Characters" c
+     set "hitPoints" = greatest(0, coalesce(c."hitPoints", 0) + coalesce(ch.hp_delta, 0)),
+         mana = greatest(0, coalesce(c.mana, 0) + coalesce(ch.mana_delta, 0)),
+         items = case
+           when ch.items_add is null and ch.items_remove is null then c.items
+           else coalesce(
+             (select jsonb_agg(item order by position)
+                from jsonb_array_elements(coalesce(c.items, '[]'::jsonb)) with ordinality as kept(item, position)
+               where not coalesce(ch.items_remove, '[]'::jsonb) @> jsonb_build_array(item)),
+             '[]'::jsonb
+           ) || coalesce(ch.items_add, '[]'::jsonb)
+         end,
+         weapon = coalesce(ch.weapon, c.weapon)
+    from jsonb_to_recordset(p_changes) as ch(
+      id uuid, hp_delta integer, mana_delta integer, items_add jsonb, items_remove jsonb, weapon text
+    )
+   where c.id = ch.id
+     and c.owner_id = auth.uid()
+  returning c.*;
+$$;
@@ -0,0 +1,27 @@
+-- A delta only makes sense on top of the turn before it. An API process with a stale idea of the latest turn
+-- (e.g. after another process cleared or replaced the history) would otherwise write a delta that can't be rebuilt.
+-- Such a delta is rejected with an error, the API then rebuilds the latest state and tries again.
+create or replace function append_game_state_entry(p_campaign_id uuid, p_turn integer, p_kind text, p_state jsonb)
+returns setof "GameStateHistory"
+language plpgsql
+as $$
+begin
+  if p_kind = 'delta' and not exists (
+    select 1
+      from "GameStateHistory" h
+     where h.campaign_id = p_campaign_id
+       and h.turn = p_turn - 1
+       and h.owner_id = auth.uid()
+  ) then
+    raise exception 'Turn % of campaign % is missing, a delta needs the turn before it', p_turn - 1, p_campaign_id;
+  end if;
+
+  return query
+  insert into "GameStateHistory" (campaign_id, turn, owner_id, kind, state)
+  select c.id, p_turn, c.owner_id, p_kind, p_state
+    from "Campaigns" c
+   where c.id = p_campaign_id
+     and c.owner_id = auth.uid()
+  returning *;
+end;
+$$;
@@ -0,0 +1,126 @@
+import json
+import random
+
+from api.game_state_history import (
+    DELTA,
+    KEYFRAME,
+    KEYFRAME_EVERY,
+    apply_delta,
+    compact_history,
+    diff_states,
+    encode_history,
+    reconstruct
+)
+
+"""
+Tests of the game state history codec (keyframes plus deltas)
+Run them from the ui folder: python -m pytest tests
+"""
+
+
+def random_states(turns, seed=0):
+    # a party whose HP, items and statuses change a little every turn, with fields and characters coming and going
+    rng = random.Random(seed)
+    # mana comes before hitPoints here, jsonb (sorted keys) puts it after
+    state = {"characters": [{"name": f"Hero{i}", "mana": 10, "hitPoints": 20, "items": ["Torch"]} for i in range(3)]}
+    states = []
+    for turn in range(turns):
+        state = json.loads(json.dumps(state))
+        character = rng.choice(state["characters"])
+        roll = rng.random()
+        if roll < 0.3:
+            character["hitPoints"] = max(0, character["hitPoints"] - rng.randint(0, 6))
+        elif roll < 0.4:
+            # a spell changes two fields of the same character
+            character["mana"] = max(0, character["mana"] - 1)
+            character["hitPoints"] += 1
+        elif roll < 0.6:
+            character["items"].append(f"Loot {turn}")
+        elif roll < 0.7 and character["items"]:
+            character["items"].pop(0)
+        elif roll < 0.8:
+            character["status"] = rng.choice(["Poisoned", "Blessed"])
+        elif roll < 0.85:
+            character.pop("status", None)
+        elif roll < 0.9:
+            state["characters"].append({"name": f"Ally{turn}", "mana": 0, "hitPoints": 10, "items": []})
+        elif roll < 0.95 and len(state["characters"]) > 1:
+            state["characters"].pop()
+        else:
+            state["location"] = f"Room {turn}"
+        states.append(state)
+    return states
+
+
+def as_jsonb(value):
+    # jsonb doesn't keep the order of object keys, a stored row comes back with them sorted
+    return json.loads(json.dumps(value, sort_keys=True))
+
+
+def test_diff_and_apply_round_trip():
+    states = random_states(200)
+    for old, new in zip(states, states[1:]):
+        assert apply_delta(old, diff_states(old, new)) == new
+
+
+def test_apply_delta_leaves_the_state_unchanged():
+    old = {"characters": [{"name": "Hero", "items": ["Torch"]}]}
+    new = {"characters": [{"name": "Hero", "items": []}], "location": "Cave"}
+    apply_delta(old, diff_states(old, new))
+    assert old == {"characters": [{"name": "Hero", "items": ["Torch"]}]}
+
+
+def test_diff_of_equal_states_is_empty():
+    state = random_states(1)[0]
+    assert diff_states(state, as_jsonb(state)) == []
+
+
+def test_encode_history_kinds():
+    entries = encode_history(random_states(2 * KEYFRAME_EVERY + 1))
+    for entry in entries:
+        expected = KEYFRAME if (entry["turn"] - 1) % KEYFRAME_EVERY == 0 else DELTA
+        assert entry["kind"] == expected
+
+
+def test_reconstruct_every_turn():
+    states = random_states(3 * KEYFRAME_EVERY)
+    entries = encode_history(states)
+    for turn, state in enumerate(states, start=1):
+        assert reconstruct(entries, turn=turn) == state
+    assert reconstruct(entries) == states[-1]
+
+
+def test_reconstruct_from_a_later_keyframe():
+    # the service reads a turn's nearest keyframe and the rows after it
+    states = random_states(2 * KEYFRAME_EVERY + 5)
+    entries = encode_history(states)
+    tail = [entry for entry in entries if entry["turn"] >= KEYFRAME_EVERY + 1]
+    assert reconstruct(tail, turn=KEYFRAME_EVERY + 3) == states[KEYFRAME_EVERY + 2]
+
+
+def test_compact_encoded_history_is_unchanged():
+    entries = encode_history(random_states(100))
+    assert compact_history(entries) == []
+
+
+def test_compact_ignores_key_order():
+    # the rows as they come back from jsonb
+    entries = [as_jsonb(entry) for entry in encode_history(random_states(100))]
+    assert compact_history(entries) == []
+
+
+def test_compact_keyframes_only_history():
+    # the full states moved over from the old game_state_history array
+    states = random_states(2 * KEYFRAME_EVERY + 3)
+    entries = [{"turn": turn, "kind": KEYFRAME, "state": state} for turn, state in enumerate(states, start=1)]
+
+    changed = compact_history(entries)
+    assert [entry["turn"] for entry in changed] == [turn for turn in range(1, len(states) + 1) if (turn - 1) % KEYFRAME_EVERY != 0]
+
+    # the compacted rows replace the old ones, compacting again changes nothing
+    by_turn = {entry["turn"]: entry for entry in entries}
+    by_turn.update({entry["turn"]: as_jsonb(entry) for entry in changed})
+    compacted = [by_turn[turn] for turn in sorted(by_turn)]
+    assert compact_history(compacted) == []
+    for turn, state in enumerate(states, start=1):
+        assert reconstruct(compacted, turn=turn) == state